@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+'''
+Stand-ins for motioncor2, aretomo, aretomo3 and the cryoCARE scripts. They accept the same
+command lines the tomo_prepper scripts produce and write correctly shaped MRC outputs, so the
+orchestration can be run and timed without GPUs. sbatch and squeue run the submitted job scripts
+as local subprocesses (array tasks in parallel, afterok dependencies respected), so the slurm
+backend can be tried without a cluster.
+
+The tool is picked from the name it is called with, install() puts symlinks with the real
+names in a folder that can be prepended to PATH. Environment variables:
+FAKE_TOOL_DELAY     seconds to sleep per call (default 0)
+FAKE_FRAME_SHAPE    frame size "ny nx" used for the outputs (default "256 256")
+FAKE_FAIL           calls whose command line contains this text exit with 1 and an error on stderr,
+                    the aretomo3 stand-in skips tilt series whose name contains it
+FAKE_SLURM_DIR      folder with the state of the fake slurm jobs (default: fake_slurm in the temp folder)
+FAKE_SLURM_TASKS    number of array tasks the fake slurm runs at the same time (default 4)
+FAKE_SLURM_HOLD     jobs stay pending while this file exists, like jobs waiting in the queue
+'''
+import fcntl
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import mrcfile
+import numpy as np
+
+
+TOOLS = ['motioncor2', 'aretomo', 'aretomo3', 'cryoCARE_extract_train_data.py', 'cryoCARE_train.py',
+         'cryoCARE_predict.py', 'sbatch', 'squeue']
+
+
+def install(bin_dir):
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    source = pathlib.Path(__file__).resolve()
+    source.chmod(source.stat().st_mode | 0o111)
+    for tool in TOOLS:
+        link = bin_dir.joinpath(tool)
+        if not link.exists():
+            link.symlink_to(source)
+    return bin_dir
+
+
+def parse_options(argv):
+    # '-Key value value' style options, negative numbers are values and not keys
+    options, key = {}, None
+    for x in argv:
+        if x.startswith('-') and x.lstrip('-')[:1].isalpha():
+            key = x.lstrip('-')
+            options[key] = []
+        elif key is not None:
+            options[key].append(x)
+    return options
+
+
+def frame_shape():
+    return tuple(int(x) for x in os.environ.get('FAKE_FRAME_SHAPE', '256 256').split())
+
+
+def write_mrc(path, shape):
+    with mrcfile.new_mmap(path, shape, mrc_mode=2, overwrite=True) as mrc:
+        mrc.data[:] = np.random.default_rng().standard_normal(shape, dtype=np.float32)
+
+
+def motioncor2(options):
+    out = pathlib.Path(options['OutMrc'][0])
+    for x in [out, out.with_name(out.stem + '_EVN.mrc'), out.with_name(out.stem + '_ODD.mrc')]:
+        write_mrc(x, frame_shape())
+
+
+def aretomo(options):
+    with mrcfile.open(options['InMrc'][0], header_only=True) as stack:
+        ny, nx = int(stack.header.ny), int(stack.header.nx)
+    binning = int(options.get('OutBin', ['1'])[0])
+    out = pathlib.Path(options['OutMrc'][0])
+    write_mrc(out, (int(options['VolZ'][0]) // binning, ny // binning, nx // binning))
+    if 'AlnFile' not in options:
+        with open(out.parent.joinpath(pathlib.Path(options['InMrc'][0]).name + '.aln'), 'w') as f:
+            f.write('# fake alignment\n')
+
+
+def aretomo3(options):
+    in_dir = pathlib.Path(options['InPrefix'][0])
+    out_dir = pathlib.Path(options['OutDir'][0])
+    out_dir.mkdir(parents=True, exist_ok=True)
+    binning = int(options.get('AtBin', ['1'])[0])
+    ny, nx = frame_shape()
+    shape = (int(options['VolZ'][0]) // binning, ny // binning, nx // binning)
+    metric = out_dir.joinpath('TiltSeries_Metric.csv')
+    if not metric.exists():
+        with open(metric, 'w') as f:
+            f.write('Tilt_Series,Thickness(Pix),Tilt_Axis,Global_Shift(Pix),Bad_Patch_Low,Bad_Patch_All,'
+                    'CTF_Res(A),CTF_Score,Pix_Size(A),Cs(nm),Kv\n')
+    for mdoc in sorted(in_dir.glob('*' + options.get('InSuffix', ['.mdoc'])[0])):
+        name = mdoc.stem
+        if os.environ.get('FAKE_FAIL', '') != '' and os.environ['FAKE_FAIL'] in name:
+            # like aretomo3, carry on with the next tilt series
+            print(f'aretomo3: simulated failure of {name}', file=sys.stderr)
+            continue
+        for suffix in ['_Vol.mrc', '_EVN_Vol.mrc', '_ODD_Vol.mrc']:
+            write_mrc(out_dir.joinpath(name + suffix), shape)
+        # aligned stacks and ctf power spectra, one plane per tilt
+        with open(mdoc, 'r') as f:
+            n_tilts = sum(1 for x in f if x.startswith('SubFramePath'))
+        for suffix in ['.mrc', '_EVN.mrc', '_ODD.mrc']:
+            write_mrc(out_dir.joinpath(name + suffix), (n_tilts, ny, nx))
+        write_mrc(out_dir.joinpath(name + '_CTF.mrc'), (n_tilts, 64, 64))
+        with open(out_dir.joinpath(name + '.aln'), 'w') as f:
+            f.write('# fake alignment\n')
+        # metrics vary between tilt series (but not between runs), so quality thresholds can be tried
+        quality = zlib.crc32(name.encode()) % 10
+        with open(metric, 'a') as f:
+            f.write(f'{name},{shape[0]},-85.0,{5. + 5 * quality},0.05,{0.02 * quality},8.0,0.05,'
+                    f'{options.get("PixSize", ["1"])[0]},2.7,300\n')
+        with open(out_dir.joinpath(name + '_Log'), 'w') as f:
+            f.write(f'Mean error: {0.5 + 0.2 * quality:.2f}\n')
+        # per tilt ctf fit (ctffind4 columns) and the tilt angles that were kept
+        with open(out_dir.joinpath(name + '_CTF.txt'), 'w') as f:
+            f.write('# Columns: #1 - micrograph number; #2 - defocus 1 [Angstroms]; #3 - defocus 2; '
+                    '#4 - azimuth of astigmatism; #5 - additional phase shift [radian]; '
+                    '#6 - cross correlation; #7 - spacing (in Angstroms) up to which CTF rings were fit successfully\n')
+            for i in range(n_tilts):
+                f.write(f'{i + 1:d} 25000.0 24500.0 45.0 0.0 0.05 8.0\n')
+        with open(out_dir.joinpath(name + '_TLT.txt'), 'w') as f:
+            for i in range(n_tilts):
+                f.write(f'{-60. + 120. * i / max(n_tilts - 1, 1):.2f}\n')
+        with open(out_dir.joinpath('MdocDone.txt'), 'a') as f:
+            f.write(str(mdoc) + '\n')
+
+
+def cryocare(tool, options):
+    with open(options['conf'][0], 'r') as f:
+        config = json.load(f)
+    if tool == 'cryoCARE_extract_train_data.py':
+        path = pathlib.Path(config['path'])
+        path.mkdir(parents=True, exist_ok=True)
+        np.savez(path.joinpath('train_data.npz'), even=np.zeros(1), odd=np.zeros(1))
+    elif tool == 'cryoCARE_train.py':
+        path = pathlib.Path(config['path'])
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path.joinpath(config['model_name'] + '.tar.gz'), 'wb') as f:
+            f.write(b'fake model')
+    else:
+        output = pathlib.Path(config['output'])
+        output.mkdir(parents=True, exist_ok=True)
+        for even in sorted(pathlib.Path(config['even']).glob('*.mrc')):
+            with mrcfile.open(even, header_only=True) as tomo:
+                shape = (int(tomo.header.nz), int(tomo.header.ny), int(tomo.header.nx))
+            write_mrc(output.joinpath(even.name), shape)
+
+
+def slurm_dir():
+    path = pathlib.Path(os.environ.get('FAKE_SLURM_DIR', pathlib.Path(tempfile.gettempdir()).joinpath('fake_slurm')))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def load_job(job_id):
+    with open(slurm_dir().joinpath(f'{job_id}.json'), 'r') as f:
+        return json.load(f)
+
+
+def save_job(job):
+    path = slurm_dir().joinpath(f'{job["id"]}.json')
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(job))
+    tmp.replace(path)
+
+
+def sbatch(argv):
+    script = pathlib.Path(argv[-1]).resolve()
+    with open(script, 'r') as f:
+        directives = [x.split()[1] for x in f if x.startswith('#SBATCH ')]
+    options = dict(x.lstrip('-').split('=', 1) for x in directives + argv[:-1] if '=' in x)
+    array = None
+    if 'array' in options:
+        first, last = options['array'].split('-')
+        array = list(range(int(first), int(last) + 1))
+    with open(slurm_dir().joinpath('next_id'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = str(int(f.read() or '1000'))
+        f.seek(0)
+        f.truncate()
+        f.write(str(int(job_id) + 1))
+    dependency = options.get('dependency', '')
+    save_job({'id': job_id, 'script': str(script), 'cwd': os.getcwd(), 'array': array, 'state': 'PENDING',
+              'dependency': dependency.split(':', 1)[1].split(':') if dependency.startswith('afterok:') else [],
+              'output': options.get('output', f'slurm-{job_id}.out')})
+    subprocess.Popen([sys.executable, str(pathlib.Path(__file__).resolve()), '--run-job', job_id],
+                     start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(job_id if '--parsable' in argv else f'Submitted batch job {job_id}')
+
+
+def run_job(job_id):
+    hold = os.environ.get('FAKE_SLURM_HOLD')
+    while hold is not None and os.path.exists(hold):
+        time.sleep(0.2)
+    job = load_job(job_id)
+    for dependency in job['dependency']:
+        while load_job(dependency)['state'] in ('PENDING', 'RUNNING'):
+            time.sleep(0.2)
+        if load_job(dependency)['state'] != 'COMPLETED':
+            job['state'] = 'CANCELLED'
+            save_job(job)
+            return
+    job['state'] = 'RUNNING'
+    save_job(job)
+
+    def run_task(task):
+        env = dict(os.environ, SLURM_JOB_ID=job_id)
+        output = job['output'].replace('%j', job_id).replace('%A', job_id)
+        if task is not None:
+            env.update(SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(task))
+            output = output.replace('%a', str(task))
+        with open(pathlib.Path(job['cwd']).joinpath(output), 'w') as f:
+            return subprocess.run(['bash', job['script']], cwd=job['cwd'], env=env, stdout=f,
+                                  stderr=subprocess.STDOUT).returncode
+
+    with ThreadPoolExecutor(max_workers=int(os.environ.get('FAKE_SLURM_TASKS', '4'))) as executor:
+        exit_codes = list(executor.map(run_task, job['array'] if job['array'] is not None else [None]))
+    job['state'] = 'COMPLETED' if all(x == 0 for x in exit_codes) else 'FAILED'
+    save_job(job)
+
+
+def squeue(argv):
+    job_ids = argv[argv.index('-j') + 1].split(',') if '-j' in argv else \
+        [x.stem for x in slurm_dir().glob('*.json')]
+    for job_id in job_ids:
+        if not slurm_dir().joinpath(f'{job_id}.json').exists():
+            continue
+        job = load_job(job_id)
+        if job['state'] in ('PENDING', 'RUNNING'):
+            print(f'{job_id} {job["state"]} {pathlib.Path(job["script"]).name}')
+
+
+if __name__ == '__main__':
+    tool = pathlib.Path(sys.argv[0]).name
+    if sys.argv[1:2] == ['--run-job']:
+        run_job(sys.argv[2])
+        sys.exit(0)
+    if tool == 'sbatch':
+        sbatch(sys.argv[1:])
+        sys.exit(0)
+    if tool == 'squeue':
+        squeue(sys.argv[1:])
+        sys.exit(0)
+    # options come in as single shell words ('-InMrc path'), so split them again
+    argv = ' '.join(sys.argv[1:]).split()
+    time.sleep(float(os.environ.get('FAKE_TOOL_DELAY', '0')))
+    if os.environ.get('FAKE_FAIL', '') != '' and os.environ['FAKE_FAIL'] in ' '.join(argv):
+        print(f'{tool}: simulated failure', file=sys.stderr)
+        sys.exit(1)
+    if tool == 'motioncor2':
+        motioncor2(parse_options(argv))
+    elif tool == 'aretomo':
+        aretomo(parse_options(argv))
+    elif tool == 'aretomo3':
+        aretomo3(parse_options(argv))
+    elif tool in TOOLS:
+        cryocare(tool, parse_options(argv))
+    else:
+        print(f'unknown tool {tool}, call through one of the symlinks made by install()')
+        sys.exit(1)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the orchestration code of tomo_prepper.py and tomo_prepper_aretomo3.py on
+synthetic projects, with the external programs replaced by the stand-ins in fake_tools.py.
+
+Every benchmark reports wall time and the peak of python side allocations (tracemalloc, which
+includes numpy arrays). Results can be written to json and compared against an earlier run:
+
+python benchmarks/run_benchmarks.py --output baseline.json
+python benchmarks/run_benchmarks.py --baseline baseline.json --tolerance 0.2
+'''
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import mrcfile
+import numpy as np
+
+BENCHMARK_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR.parent))
+sys.path.insert(0, str(BENCHMARK_DIR))
+
+import tomo_prepper  # noqa: E402
+import tomo_prepper_aretomo3  # noqa: E402
+import fake_tools  # noqa: E402
+from prepper_common import RawWatcher, watch  # noqa: E402
+from synthetic_project import make_project, write_mdoc, write_tiff, dose_symmetric_angles  # noqa: E402
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        func(*args)
+    finally:
+        wall_time = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'wall_time': wall_time, 'peak_mb': peak / 1024 ** 2}
+
+
+@contextlib.contextmanager
+def working_dir(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def write_tilts(folder, n_tilts, shape):
+    rng = np.random.default_rng(0)
+    tilts = []
+    for i in range(n_tilts):
+        tilt = folder.joinpath(f'tilt_{i:03d}.mrc')
+        with mrcfile.new(tilt, overwrite=True) as mrc:
+            mrc.set_data(rng.standard_normal(shape, dtype=np.float32))
+        tilts.append(tilt)
+    return tilts
+
+
+def bench_parse_mdoc(tmp, n_tilts, repeats=200):
+    angles = dose_symmetric_angles(n_tilts)
+    mdoc = tmp.joinpath('bench.mrc.mdoc')
+    write_mdoc(mdoc, 'bench', [f'bench_{i:03d}.tif' for i in range(n_tilts)], angles, (4096, 4096), 1., 3.)
+    return measure(lambda: [tomo_prepper.parse_mdoc(mdoc) for _ in range(repeats)])
+
+
+def bench_create_stack(tmp, n_tilts, shape, streaming):
+    tilts = write_tilts(tmp, n_tilts, shape)
+    outnames = [tmp.joinpath(x) for x in ('full.st', 'even.st', 'odd.st')]
+    if streaming:
+        return measure(tomo_prepper.create_stacks_streaming, [tilts] * 3, outnames, 1.)
+    return measure(lambda: [tomo_prepper.create_stack(tilts, x, 1.) for x in outnames])
+
+
+def bench_normalise(tmp, shape, slab_size):
+    tomo = tmp.joinpath('tomo.mrc')
+    with mrcfile.new_mmap(tomo, shape, mrc_mode=2, overwrite=True) as mrc:
+        for z in range(shape[0]):
+            mrc.data[z] = np.random.default_rng(z).standard_normal(shape[1:], dtype=np.float32) * 5
+    return measure(tomo_prepper.normalise, tomo, slab_size)
+
+
+def bench_create_symlinks(tmp, n_series):
+    make_project(tmp, 0, 0)
+    output = tmp.joinpath('AreTomo3Output')
+    output.mkdir()
+    for i in range(n_series):
+        for suffix in ('_EVN_Vol.mrc', '_ODD_Vol.mrc'):
+            output.joinpath(f'tomo_{i:03d}.mrc{suffix}').touch()
+    project = tomo_prepper_aretomo3.Project(tmp, 1.)
+    project.project_tomograms.mkdir()
+    project.tomos_even.mkdir()
+    project.tomos_odd.mkdir()
+    with working_dir(tmp):
+        return measure(project.create_symlinks)
+
+
+def bench_project_run(tmp, n_series, n_tilts, shape):
+    make_project(tmp, n_series, n_tilts, shape)
+    project = tomo_prepper.Project(tmp, 2., use_cache=False)
+    return measure(project.run, None, None, 400, 400, 4, 0, None, 0, min(2, n_series), 'bench', [0])
+
+
+def bench_failure_rerun(tmp, n_series, n_tilts, shape):
+    # a series that fails in scratch mode is recorded under the pipeline stage that failed, and has to be cleared
+    # from failed_series.json by a plain rerun that reconstructs it, and then be denoised with the others
+    make_project(tmp, n_series, n_tilts, shape)
+    failing = f'tomo_{n_series - 1:03d}'
+    tmp.joinpath('scratch').mkdir()
+    os.environ['FAKE_FAIL'] = failing
+    try:
+        project = tomo_prepper.Project(tmp, 2., retries=0, retry_backoff=0.)
+        project.run(None, None, 400, 400, 4, 0, None, 0, n_series - 1, 'bench', [0],
+                    scratch_dir=str(tmp.joinpath('scratch')))
+    finally:
+        del os.environ['FAKE_FAIL']
+    if project.failures.entries.get(failing, {}).get('stage') not in tomo_prepper.PIPELINE_STAGES:
+        raise RuntimeError(f'{failing} was not recorded under a pipeline stage in scratch mode')
+    project = tomo_prepper.Project(tmp, 2., retries=0, retry_backoff=0.)
+    result = measure(project.run, None, None, 400, 400, 4, 0, None, 0, n_series - 1, 'bench', [0])
+    denoised = sorted(x.stem for x in tmp.joinpath('tomograms', 'denoised').glob('*.mrc'))
+    if denoised != [f'tomo_{i:03d}' for i in range(n_series)] or len(project.failures.entries) > 0:
+        raise RuntimeError(f'after the rerun {denoised} are denoised, failures {sorted(project.failures.entries)}')
+    return result
+
+
+def bench_project_run_aretomo3(tmp, n_series, n_tilts, shape):
+    make_project(tmp, n_series, n_tilts, shape)
+    project = tomo_prepper_aretomo3.Project(tmp, 2., use_cache=False)
+    with working_dir(tmp):
+        return measure(project.run, None, None, 2., 300, 2.7, 3., -85., 400, None, 4, 0, [5, 5],
+                       min(2, n_series), 'bench', [0])
+
+
+def drip_series(raw, n_series, n_tilts, shape, interval, written):
+    # acquisition stand-in: the mdoc of a tilt series first, then its frames one at a time, noting when the
+    # last file of every series was written
+    for i in range(n_series):
+        series_name = f'tomo_{i:03d}'
+        tilt_angles = dose_symmetric_angles(n_tilts)
+        subframes = [f'{series_name}_{j:03d}_{angle}.tif' for j, angle in enumerate(tilt_angles)]
+        write_mdoc(raw.joinpath(series_name + '.mrc.mdoc'), series_name, subframes, tilt_angles, shape, 2., 3.)
+        for subframe in subframes:
+            time.sleep(interval)
+            write_tiff(raw.joinpath(subframe), np.zeros(shape, dtype=np.uint8))
+        written[series_name + '.mrc'] = time.monotonic()
+
+
+def bench_watch_raw(tmp, n_series, n_tilts, shape, settle_time=0.5):
+    # frames trickle in faster than settle_time, so a series may only be handed over settle_time after its
+    # last frame. the last series fails and has to end up in the failure log instead of disappearing
+    raw = make_project(tmp, 0, 0)
+    project = tomo_prepper_aretomo3.Project(tmp, 2., use_cache=False)
+    interval = settle_time / 10
+    written, processed = {}, {}
+    failing = f'tomo_{n_series - 1:03d}.mrc'
+
+    def process_mdocs(mdocs):
+        processed[mdocs[0].stem] = time.monotonic()
+        if mdocs[0].stem == failing:
+            raise RuntimeError('fake aretomo3 failure')
+
+    writer = threading.Thread(target=drip_series, args=(raw, n_series, n_tilts, shape, interval, written))
+    writer.start()
+    try:
+        result = measure(project.watch_raw, process_mdocs, settle_time, interval,
+                         n_tilts * interval + 2 * settle_time)
+    finally:
+        writer.join()
+    early = [x for x in written if x not in processed or processed[x] - written[x] < settle_time]
+    if len(early) > 0:
+        raise RuntimeError(f'watch_raw handed over {", ".join(early)} before its files settled (or never)')
+    if failing not in project.failures.entries:
+        raise RuntimeError(f'the failure of {failing} in watch mode was not recorded')
+    return result
+
+
+def bench_quality_check(tmp):
+    # quality table from AreTomo3 output files in fixtures/aretomo3 (TiltSeries_Metric.csv, _CTF.txt, _TLT.txt and
+    # _Log laid out as aretomo3 writes them), tomo_001 has a large global shift, a poor ctf fit and a large
+    # alignment error
+    raw = make_project(tmp, 3, 3, (64, 64))
+    project = tomo_prepper_aretomo3.Project(tmp, 2., use_cache=False)
+    shutil.copytree(BENCHMARK_DIR.joinpath('fixtures', 'aretomo3'), project.project_AreTomo3, dirs_exist_ok=True)
+    for mdoc in sorted(raw.glob('*.mdoc')):
+        for volume in project.volumes(mdoc):
+            fake_tools.write_mrc(volume, (4, 8, 8))
+    thresholds = {'max_global_shift': 50., 'max_ctf_resolution': 12., 'min_ctf_score': 0.05}
+    result = measure(project.quality_check, thresholds)
+    if sorted(project.rejected) != ['tomo_001.mrc']:
+        raise RuntimeError(f'rejected {sorted(project.rejected)} instead of tomo_001.mrc')
+    # without ctf columns in the csv the median ctf fit of the _CTF.txt counts
+    metric_file = project.project_AreTomo3.joinpath('TiltSeries_Metric.csv')
+    with open(metric_file, 'r') as f:
+        lines = [x.split(', ') for x in f.read().splitlines()]
+    with open(metric_file, 'w') as f:
+        f.writelines(', '.join(x[:6] + x[8:]) + '\n' for x in lines)
+    project.quality_check({'min_ctf_score': 0.05, 'max_ctf_resolution': 12.})
+    reasons = sorted(x.split()[0] for x in project.rejected.get('tomo_001.mrc', []))
+    if reasons != ['CTF_Res(A)', 'CTF_Score'] or len(project.rejected) != 1:
+        raise RuntimeError(f'the _CTF.txt fallback rejected {project.rejected}')
+    # the mean alignment error of the _Log files
+    project.quality_check({'max_align_residual': 3.})
+    if list(project.rejected) != ['tomo_001.mrc'] or project.rejected['tomo_001.mrc'][0].split()[0] != \
+            'Align_Residual':
+        raise RuntimeError(f'--max-align-residual rejected {project.rejected}')
+    # a threshold on a metric that is nowhere (no residual in the _Log files, no Bad_Patch_All column) must stop
+    # the run instead of rejecting every series
+    for log in project.project_AreTomo3.glob('*_Log'):
+        log.write_text('Load tilt series\nReconstruction done\n')
+    with open(metric_file, 'w') as f:
+        f.writelines(', '.join(x[:5] + x[6:]) + '\n' for x in lines)
+    for missing in ('max_align_residual', 'max_bad_patches'):
+        try:
+            project.quality_check({missing: 1.})
+        except SystemExit:
+            continue
+        raise RuntimeError(f'quality_check passed --{missing.replace("_", "-")} without the metric')
+    return result
+
+
+def bench_watch_partial_mdoc(tmp, n_tilts, shape, settle_time=0.5):
+    # serialem writes the mdoc while the tilt series is acquired: first without ImageFile, then cut off in the
+    # middle of a line (ExposureDose = ). such an mdoc is not ready yet, it must neither stop the watch nor be
+    # handed over before it is complete and settled
+    raw = make_project(tmp, 0, 0)
+    interval = settle_time / 10
+    series_name = 'tomo_000'
+    tilt_angles = dose_symmetric_angles(n_tilts)
+    subframes = [f'{series_name}_{j:03d}_{angle}.tif' for j, angle in enumerate(tilt_angles)]
+    for subframe in subframes:
+        write_tiff(raw.joinpath(subframe), np.zeros(shape, dtype=np.uint8))
+    mdoc = raw.joinpath(series_name + '.mrc.mdoc')
+    write_mdoc(mdoc, series_name, subframes, tilt_angles, shape, 2., 3.)
+    text = mdoc.read_text()
+    mdoc.unlink()
+    pieces = [text[:text.index('ImageFile')], text[:text.index('ExposureDose = ') + len('ExposureDose = ')], text]
+    written, processed = {}, []
+
+    def write_pieces():
+        for piece in pieces:
+            time.sleep(2 * interval)
+            mdoc.write_text(piece)
+        written[mdoc.stem] = time.monotonic()
+
+    def process(x):
+        processed.append((x.stem, time.monotonic(), len(tomo_prepper.TiltSeries(x).input_frames())))
+
+    watcher = RawWatcher(raw, lambda x: tomo_prepper.TiltSeries(x).input_frames(), settle_time)
+    writer = threading.Thread(target=write_pieces)
+    writer.start()
+    try:
+        result = measure(watch, watcher, process, interval, len(pieces) * 2 * interval + 2 * settle_time)
+    finally:
+        writer.join()
+    if [(x[0], x[2]) for x in processed] != [(mdoc.stem, n_tilts)] or \
+            processed[0][1] - written[mdoc.stem] < settle_time:
+        raise RuntimeError(f'the mdoc written in pieces was handed over as {processed}')
+    return result
+
+
+def bench_slurm(tmp, n_series, n_tilts, shape):
+    # --backend slurm through the fake sbatch: the jobs are held in the queue while a new tilt series arrives in
+    # raw/, which the array tasks must not pick up. the cryocare job depends on the array (afterok) and has to
+    # find all reconstructions of the submitted series
+    make_project(tmp, n_series, n_tilts, shape)
+    hold = tmp.joinpath('queue_hold')
+    hold.touch()
+    env = dict(os.environ, FAKE_SLURM_DIR=str(tmp.joinpath('fake_slurm')), FAKE_SLURM_HOLD=str(hold))
+    command = [sys.executable, str(BENCHMARK_DIR.parent.joinpath('tomo_prepper.py')), '--project-dir', str(tmp),
+               '--pixel-size', '2', '--aretomo-vol-z', '400', '--aretomo-align-z', '400', '--cryocare-model-name',
+               'bench', '--training-size', str(min(2, n_series)), '--gpu-id', '0', '--no-history',
+               '--backend', 'slurm', '--slurm-wait', '--poll-interval', '0.2']
+
+    def submit_and_wait():
+        submitter = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+        while len(list(tmp.joinpath('fake_slurm').glob('*.json'))) < 2:
+            time.sleep(0.05)
+        late = [f'late_000_{i:03d}.tif' for i in range(n_tilts)]
+        for subframe in late:
+            write_tiff(tmp.joinpath('raw', subframe), np.zeros(shape, dtype=np.uint8))
+        write_mdoc(tmp.joinpath('raw', 'late_000.mrc.mdoc'), 'late_000', late, dose_symmetric_angles(n_tilts),
+                   shape, 2., 3.)
+        hold.unlink()
+        if submitter.wait() != 0:
+            raise RuntimeError('submitting to the fake slurm failed')
+
+    result = measure(submit_and_wait)
+    states = {}
+    for job_file in tmp.joinpath('fake_slurm').glob('*.json'):
+        with open(job_file, 'r') as f:
+            job = json.load(f)
+        states[pathlib.Path(job['script']).name] = job['state']
+    if states != {'series_array.sh': 'COMPLETED', 'cryocare.sh': 'COMPLETED'}:
+        raise RuntimeError(f'slurm jobs did not complete: {states}')
+    denoised = sorted(x.name for x in tmp.joinpath('tomograms', 'denoised').glob('*.mrc'))
+    if denoised != [f'tomo_{i:03d}.mrc' for i in range(n_series)]:
+        raise RuntimeError(f'denoised tomograms of the slurm run are {denoised}')
+    return result
+
+
+def run_all(sizes, n_tilts, shape):
+    benchmarks = {
+        f'parse_mdoc[{n_tilts} tilts x200]': lambda tmp: bench_parse_mdoc(tmp, n_tilts),
+        f'create_stack[{n_tilts}x{shape[0]}x{shape[1]}]': lambda tmp: bench_create_stack(tmp, n_tilts, shape, False),
+        f'create_stack_streaming[{n_tilts}x{shape[0]}x{shape[1]}]':
+            lambda tmp: bench_create_stack(tmp, n_tilts, shape, True),
+        f'normalise[{n_tilts * 4}x{shape[0]}x{shape[1]}]':
+            lambda tmp: bench_normalise(tmp, (n_tilts * 4,) + shape, None),
+        f'normalise_slabs[{n_tilts * 4}x{shape[0]}x{shape[1]}]':
+            lambda tmp: bench_normalise(tmp, (n_tilts * 4,) + shape, 16),
+        f'watch_raw[2 series x{n_tilts} tilts]': lambda tmp: bench_watch_raw(tmp, 2, n_tilts, shape),
+        f'watch_partial_mdoc[{n_tilts} tilts]': lambda tmp: bench_watch_partial_mdoc(tmp, n_tilts, shape),
+        f'slurm[2 series x{n_tilts} tilts]': lambda tmp: bench_slurm(tmp, 2, n_tilts, shape),
+        'quality_check[3 series, aretomo3 fixture]': bench_quality_check,
+        f'failure_rerun[2 series x{n_tilts} tilts]': lambda tmp: bench_failure_rerun(tmp, 2, n_tilts, shape),
+    }
+    for n_series in sizes:
+        benchmarks[f'create_symlinks[{n_series * 10} series]'] = \
+            lambda tmp, n=n_series: bench_create_symlinks(tmp, n * 10)
+        benchmarks[f'tomo_prepper.run[{n_series} series]'] = \
+            lambda tmp, n=n_series: bench_project_run(tmp, n, n_tilts, shape)
+        benchmarks[f'tomo_prepper_aretomo3.run[{n_series} series]'] = \
+            lambda tmp, n=n_series: bench_project_run_aretomo3(tmp, n, n_tilts, shape)
+
+    results = {}
+    for name, benchmark in benchmarks.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            results[name] = benchmark(pathlib.Path(tmp))
+        print(f'{name:<55}{results[name]["wall_time"]:>10.3f} s{results[name]["peak_mb"]:>10.1f} MB')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('wall_time', 'peak_mb'):
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append(f'{name} {metric}: {baseline[name][metric]:.3f} -> {result[metric]:.3f}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tomo_prepper orchestration on synthetic data.')
+    parser.add_argument('--sizes', type=int, required=False, nargs='+', default=[2, 8],
+                        help='project sizes (number of tilt series) for the full run benchmarks')
+    parser.add_argument('--n-tilts', type=int, required=False, default=41,
+                        help='number of tilts per series')
+    parser.add_argument('--frame-shape', type=int, required=False, nargs=2, default=[256, 256],
+                        help='frame size in pixels (y x)')
+    parser.add_argument('--tool-delay', type=float, required=False, default=0.,
+                        help='seconds every fake external program sleeps')
+    parser.add_argument('--output', type=str, required=False,
+                        help='write the results to this json file')
+    parser.add_argument('--baseline', type=str, required=False,
+                        help='json file of an earlier run to compare against, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, required=False, default=0.2,
+                        help='allowed relative increase in wall time or peak memory compared to the baseline')
+    args = parser.parse_args()
+
+    bin_dir = fake_tools.install(pathlib.Path(tempfile.mkdtemp()).joinpath('bin'))
+    os.environ['PATH'] = str(bin_dir) + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_TOOL_DELAY'] = str(args.tool_delay)
+    os.environ['FAKE_FRAME_SHAPE'] = ' '.join(str(x) for x in args.frame_shape)
+
+    results = run_all(args.sizes, args.n_tilts, tuple(args.frame_shape))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print('regressions compared to baseline:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('no regressions compared to baseline')
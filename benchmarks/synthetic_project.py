@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''
+Create a synthetic project folder to benchmark the tomo_prepper scripts without a microscope
+dataset. Every tilt series gets an mdoc (in dose-symmetric tilt order, with windows style
+SubFramePath entries like SerialEM writes them) and one small frame file per tilt:
+
+project/
++- raw/
+¦  +- tomo_000.mrc.mdoc
+¦  +- tomo_000_000_0.0.tif
+¦  +- tomo_000_001_3.0.tif
+¦  +- ...
+'''
+import argparse
+import pathlib
+import struct
+import numpy as np
+
+
+def dose_symmetric_angles(n_tilts, step=3.):
+    angles = [0.]
+    i = 1
+    while len(angles) < n_tilts:
+        angles.append(i * step)
+        if len(angles) < n_tilts:
+            angles.append(-i * step)
+        i += 1
+    return angles
+
+
+def write_tiff(path, image):
+    # minimal single strip, uncompressed 8-bit grayscale tiff
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    ny, nx = image.shape
+    tags = [(256, 4, nx), (257, 4, ny), (258, 3, 8), (259, 3, 1), (262, 3, 1),
+            (273, 4, 8), (277, 3, 1), (278, 4, ny), (279, 4, image.nbytes)]
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<2sHI', b'II', 42, 8 + image.nbytes))
+        f.write(image.tobytes())
+        f.write(struct.pack('<H', len(tags)))
+        for tag, tag_type, value in tags:
+            f.write(struct.pack('<HHII', tag, tag_type, 1, value))
+        f.write(struct.pack('<I', 0))
+
+
+def write_eer(path, image, n_frames):
+    # multi-page tiff with one small 8-bit page per raw frame, enough to count frames like an eer movie
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    ny, nx = image.shape
+    ifd_size = 2 + 9 * 12 + 4
+    page_size = image.nbytes + ifd_size
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<2sHI', b'II', 42, 8 + image.nbytes))
+        for i in range(n_frames):
+            start = 8 + i * page_size
+            tags = [(256, 4, nx), (257, 4, ny), (258, 3, 8), (259, 3, 1), (262, 3, 1),
+                    (273, 4, start), (277, 3, 1), (278, 4, ny), (279, 4, image.nbytes)]
+            f.write(image.tobytes())
+            f.write(struct.pack('<H', len(tags)))
+            for tag, tag_type, value in tags:
+                f.write(struct.pack('<HHII', tag, tag_type, 1, value))
+            f.write(struct.pack('<I', start + page_size + image.nbytes if i < n_frames - 1 else 0))
+
+
+def write_mrc_frame(path, image):
+    import mrcfile
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(image.astype(np.float32))
+
+
+def write_mdoc(path, series_name, subframes, tilt_angles, shape, pixel_size, dose):
+    lines = [f'PixelSpacing = {pixel_size}', f'ImageFile = {series_name}.mrc',
+             f'ImageSize = {shape[1]} {shape[0]}', 'DataMode = 1', '']
+    for i, (subframe, angle) in enumerate(zip(subframes, tilt_angles)):
+        lines += [f'[ZValue = {i}]', f'TiltAngle = {angle}', f'ExposureDose = {dose}',
+                  f'SubFramePath = X:\\frames\\{subframe}', 'NumSubFrames = 10', '']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def make_project(project_dir, n_series, n_tilts, shape=(256, 256), frame_format='tif', pixel_size=2.,
+                 dose=3., seed=0):
+    rng = np.random.default_rng(seed)
+    raw = project_dir.joinpath('raw')
+    raw.mkdir(parents=True, exist_ok=True)
+    for i in range(n_series):
+        series_name = f'tomo_{i:03d}'
+        tilt_angles = dose_symmetric_angles(n_tilts)
+        subframes = [f'{series_name}_{j:03d}_{angle}.{frame_format}' for j, angle in enumerate(tilt_angles)]
+        for subframe in subframes:
+            image = rng.integers(0, 255, size=shape, dtype=np.uint8)
+            if frame_format == 'tif':
+                write_tiff(raw.joinpath(subframe), image)
+            elif frame_format == 'eer':
+                write_eer(raw.joinpath(subframe), image, 40)
+            else:
+                write_mrc_frame(raw.joinpath(subframe), image)
+        write_mdoc(raw.joinpath(series_name + '.mrc.mdoc'), series_name, subframes, tilt_angles, shape,
+                   pixel_size, dose)
+    return raw
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a synthetic raw/ folder with mdocs and small frames.')
+    parser.add_argument('--project-dir', type=str, required=True,
+                        help='project directory to create')
+    parser.add_argument('--n-series', type=int, required=False, default=4,
+                        help='number of tilt series')
+    parser.add_argument('--n-tilts', type=int, required=False, default=41,
+                        help='number of tilts per series')
+    parser.add_argument('--frame-shape', type=int, required=False, nargs=2, default=[256, 256],
+                        help='frame size in pixels (y x)')
+    parser.add_argument('--frame-format', type=str, required=False, default='tif', choices=['tif', 'eer', 'mrc'],
+                        help='file format of the frames')
+    args = parser.parse_args()
+
+    make_project(pathlib.Path(args.project_dir), args.n_series, args.n_tilts, tuple(args.frame_shape),
+                 args.frame_format)
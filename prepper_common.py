@@ -0,0 +1,892 @@
+'''
+Helpers shared by tomo_prepper.py and tomo_prepper_aretomo3.py: stage bookkeeping (manifest, failure log,
+stage log and run history), disk and cryocare prediction planning, the cryocare model registry, watching the
+raw folder, slurm submission and the qc and zarr writers. Keep this file next to the two scripts.
+'''
+import subprocess
+import os
+import resource
+import contextlib
+import fcntl
+import shlex
+import pathlib
+import sys
+import tempfile
+import json
+import sqlite3
+import hashlib
+import shutil
+import struct
+import threading
+import collections
+import time
+import html
+import zlib
+import mrcfile
+import numpy as np
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+
+SBATCH_CMD = 'sbatch'
+SQUEUE_CMD = 'squeue'
+
+
+# training settings that have to match before a registered model is reused
+REGISTRY_TRAIN_KEYS = ['unet_kern_size', 'unet_n_depth', 'unet_n_first']
+
+
+# number of extracted cryocare training sets kept for reuse
+TRAIN_DATA_CACHE_SIZE = 3
+
+
+def mdoc_image_size(mdoc_file):
+    # (ny, nx) of the tilt images from the 'ImageSize = nx ny' header line, None when it is not there
+    with open(mdoc_file, 'r') as infile:
+        for x in infile.readlines():
+            line = x.strip()
+            if '=' in line and line.split('=')[0].strip() == 'ImageSize':
+                nx, ny = (int(v) for v in line.split('=')[1].split()[:2])
+                return ny, nx
+    return None
+
+
+class RunningStats:
+    # accumulates min/max/mean/std chunk by chunk, so header stats can be set without loading a full volume
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.minimum = None
+        self.maximum = None
+
+    def update(self, chunk):
+        n = chunk.size
+        if n == 0:
+            return
+        chunk_mean = chunk.mean(dtype=np.float64)
+        chunk_m2 = chunk.var(dtype=np.float64) * n
+        delta = chunk_mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += chunk_m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        chunk_min, chunk_max = chunk.min(), chunk.max()
+        self.minimum = chunk_min if self.minimum is None else min(self.minimum, chunk_min)
+        self.maximum = chunk_max if self.maximum is None else max(self.maximum, chunk_max)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count > 0 else 0.
+
+    def set_header(self, mrc):
+        if self.count == 0:
+            mrc.reset_header_stats()
+            return
+        mrc.header.dmin = self.minimum
+        mrc.header.dmax = self.maximum
+        mrc.header.dmean = np.float32(self.mean)
+        mrc.header.rms = np.float32(self.std)
+
+
+def bin_volume(data, binning):
+    nz, ny, nx = (x - x % binning for x in data.shape)
+    data = data[:nz, :ny, :nx].astype(np.float32)
+    return data.reshape(nz // binning, binning, ny // binning, binning, nx // binning, binning).mean(axis=(1, 3, 5))
+
+
+def tomogram_statistics(even_path, odd_path, binning=4, slab_size=32):
+    # even/odd correlation, contrast and a thickness proxy from a binned copy that is read slab by slab
+    # through memory maps, thickness counts the z-slices where even and odd still correlate
+    slab_size -= slab_size % binning
+    slice_corr, averages = [], RunningStats()
+    sums = np.zeros(5)
+    with mrcfile.mmap(even_path, mode='r') as even, mrcfile.mmap(odd_path, mode='r') as odd:
+        for z in range(0, even.data.shape[0], slab_size):
+            e = bin_volume(even.data[z:z + slab_size], binning)
+            o = bin_volume(odd.data[z:z + slab_size], binning)
+            if e.size == 0:
+                continue
+            sums += [e.sum(dtype=np.float64), o.sum(dtype=np.float64), (e * o).sum(dtype=np.float64),
+                     (e * e).sum(dtype=np.float64), (o * o).sum(dtype=np.float64)]
+            averages.update((e + o) / 2)
+            for e_slice, o_slice in zip(e, o):
+                e_slice, o_slice = e_slice - e_slice.mean(), o_slice - o_slice.mean()
+                slice_corr.append((e_slice * o_slice).sum() /
+                                  (np.sqrt((e_slice ** 2).sum() * (o_slice ** 2).sum()) + 1e-12))
+    n = averages.count
+    e_sum, o_sum, eo_sum, ee_sum, oo_sum = sums
+    covariance = eo_sum / n - e_sum * o_sum / n ** 2
+    correlation = covariance / np.sqrt((ee_sum / n - (e_sum / n) ** 2) * (oo_sum / n - (o_sum / n) ** 2) + 1e-12)
+    slice_corr = np.array(slice_corr)
+    thickness = int((slice_corr > 0.5 * slice_corr.max()).sum()) * binning if len(slice_corr) > 0 else 0
+    return {'correlation': float(correlation), 'contrast': float(averages.std), 'thickness': thickness}
+
+
+def write_png(path, image):
+    # 8-bit grayscale png, contrast stretched between the 1st and 99th percentile
+    image = np.asarray(image, dtype=np.float32)
+    low, high = np.percentile(image, [1, 99]) if image.size > 0 else (0., 1.)
+    scaled = np.clip((image - low) / (high - low + 1e-12) * 255, 0, 255).astype(np.uint8)
+    ny, nx = scaled.shape
+    rows = b''.join(b'\x00' + scaled[y].tobytes() for y in range(ny))
+    
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', nx, ny, 8, 0, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def make_preview(mrc_path, preview_path, binning=4, slab_size=32):
+    # binned copy of a volume plus png thumbnails of the central xy and xz slices and the projections along
+    # z and y. the volume is read slab by slab through a memory map, only the binned copy is ever in memory
+    slab_size = max(binning, slab_size - slab_size % binning)
+    with mrcfile.mmap(mrc_path, mode='r') as tomo:
+        nz, ny, nx = (x // binning for x in tomo.data.shape)
+        if min(nz, ny, nx) == 0:
+            raise ValueError(f'volume {tomo.data.shape} is smaller than the binning {binning}')
+        projection_xy, projection_xz = np.zeros((ny, nx)), np.zeros((nz, nx))
+        with mrcfile.new_mmap(preview_path, (nz, ny, nx), mrc_mode=2, overwrite=True) as preview:
+            for z in range(0, nz * binning, slab_size):
+                slab = bin_volume(tomo.data[z:z + slab_size], binning)
+                preview.data[z // binning:z // binning + slab.shape[0]] = slab
+                projection_xy += slab.sum(axis=0)
+                projection_xz[z // binning:z // binning + slab.shape[0]] = slab.sum(axis=1)
+            preview.voxel_size = float(tomo.voxel_size.x) * binning
+            preview.update_header_stats()
+            # flipped so y and z point up, as in imod
+            views = {'xy': preview.data[nz // 2], 'xz': preview.data[:, ny // 2, :],
+                     'proj_xy': projection_xy, 'proj_xz': projection_xz}
+            for view, image in views.items():
+                write_png(preview_path.with_name(f'{preview_path.stem}_{view}.png'), np.flipud(image))
+
+
+def write_qc_index(qc_dir, series_names, kinds=('full', 'even', 'denoised')):
+    # html page with a row of thumbnails per tilt series, linking to the binned previews
+    rows = []
+    for name in series_names:
+        cells = []
+        for kind in kinds:
+            if not qc_dir.joinpath(name, kind + '.mrc').exists():
+                cells.append('<td></td>')
+                continue
+            images = ''.join(f'<img src="{html.escape(name)}/{kind}_{view}.png" title="{kind} {view}">'
+                             for view in ('xy', 'xz', 'proj_xy', 'proj_xz'))
+            cells.append(f'<td><a href="{html.escape(name)}/{kind}.mrc">{kind}</a><br>{images}</td>')
+        rows.append(f'<tr><th>{html.escape(name)}</th>{"".join(cells)}</tr>')
+    with open(qc_dir.joinpath('index.html'), 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>tomogram previews</title>'
+                '<style>img {height: 160px; margin: 2px} td, th {vertical-align: top; text-align: left}</style>'
+                '</head><body>\n<table>\n' + '\n'.join(rows) + '\n</table>\n</body></html>\n')
+
+
+def select_training_subset(pairs, max_size, coverage_radius=1., names=None):
+    # pick the smallest set of tomograms that covers the spread of the statistics: start at the most
+    # typical tomogram and keep adding the one furthest from the current selection until every
+    # tomogram is within coverage_radius (in standard deviations) of a selected one, or max_size
+    with ThreadPoolExecutor() as executor:
+        stats = list(executor.map(lambda x: tomogram_statistics(*x), pairs))
+    features = np.array([[x['correlation'], x['contrast'], x['thickness']] for x in stats], dtype=np.float64)
+    features = (features - features.mean(axis=0)) / (features.std(axis=0) + 1e-12)
+    distance = np.linalg.norm(features - np.median(features, axis=0), axis=1)
+    subset = [int(np.argmin(distance))]
+    distance = np.linalg.norm(features - features[subset[0]], axis=1)
+    while len(subset) < max_size and distance.max() > coverage_radius:
+        subset.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, np.linalg.norm(features - features[subset[-1]], axis=1))
+    names = names if names is not None else [str(x[0]) for x in pairs]
+    print(f'{"tomogram":<30}{"even/odd corr":>15}{"contrast":>10}{"thickness":>11}')
+    for i, x in enumerate(stats):
+        print(f'{names[i]:<30}{x["correlation"]:>15.3f}{x["contrast"]:>10.3f}{x["thickness"]:>11}'
+              + (' (training)' if i in subset else ''))
+    return subset
+
+
+def downsample_2x(volume):
+    # mean of 2x2x2 blocks, an odd last plane/row/column is dropped (as in the level shapes below)
+    nz, ny, nx = (x // 2 * 2 for x in volume.shape)
+    blocks = volume[:nz, :ny, :nx].reshape(nz // 2, 2, ny // 2, 2, nx // 2, 2)
+    return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+def write_ome_zarr(mrc_path, zarr_path, n_levels=4, chunk_size=64):
+    # chunked OME-Zarr (ngff 0.4) with a 1x/2x/4x/8x pyramid, built while streaming through z-slabs of the mrc.
+    # a slab is a multiple of 2**(n_levels-1) planes, so every level gets whole planes from it
+    import zarr
+    slab_size = max(chunk_size, 2 ** (n_levels - 1))
+    with mrcfile.mmap(mrc_path, mode='r') as tomo:
+        shape, dtype = tomo.data.shape, tomo.data.dtype
+        voxel_size = float(tomo.voxel_size.x) if tomo.voxel_size.x > 0 else 1.
+        part = zarr_path.with_name(zarr_path.name + '.part')
+        shutil.rmtree(part, ignore_errors=True)
+        group = zarr.open_group(str(part), mode='w')
+        levels = [group.create_dataset(str(i), shape=tuple(x // 2 ** i for x in shape),
+                                       chunks=(chunk_size,) * 3, dtype=dtype) for i in range(n_levels)]
+        for z in range(0, shape[0], slab_size):
+            slab = np.asarray(tomo.data[z:z + slab_size])
+            for i, level in enumerate(levels):
+                if i > 0:
+                    slab = downsample_2x(slab)
+                start = z // 2 ** i
+                level[start:start + slab.shape[0]] = slab.astype(dtype)
+    group.attrs['multiscales'] = [{
+        'version': '0.4', 'name': zarr_path.stem, 'type': 'mean',
+        'axes': [{'name': x, 'type': 'space', 'unit': 'angstrom'} for x in 'zyx'],
+        'datasets': [{'path': str(i), 'coordinateTransformations': [
+            {'type': 'scale', 'scale': [voxel_size * 2 ** i] * 3},
+            {'type': 'translation', 'translation': [voxel_size * (2 ** i - 1) / 2] * 3}]}
+            for i in range(n_levels)]}]
+    shutil.rmtree(zarr_path, ignore_errors=True)
+    part.rename(zarr_path)
+
+
+def file_fingerprint(path):
+    # name, size and modification time stand in for the content of (large) input files
+    if path is None or not pathlib.Path(path).exists():
+        return None
+    stat = pathlib.Path(path).stat()
+    return [pathlib.Path(path).name, stat.st_size, stat.st_mtime_ns]
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    # read in chunks, stacks and tomograms can be larger than the memory
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    # exclusive lock between processes, slurm array tasks share the project folder
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StageManifest:
+    # keeps, per tilt series and stage, the hash of the inputs and parameters the stage last ran with
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.entries = self.load()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def is_done(self, name, stage, key, outputs):
+        return (self.enabled and self.entries.get(name, {}).get(stage) == key and
+                all(pathlib.Path(x).exists() for x in outputs))
+
+    def record(self, name, stage, key):
+        # also recorded without the cache, later jobs (cryocare after a slurm array) read what ran.
+        # the file is reread under a lock so entries written by other processes are kept
+        with self._lock, file_lock(self.path.with_suffix('.lock')):
+            self.entries = self.load()
+            self.entries.setdefault(name, {})[stage] = key
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(self.entries, indent=2))
+            tmp.replace(self.path)
+
+
+class FailureLog:
+    # tilt series whose last attempt at a stage failed, with the error (exit status and stderr tail). kept
+    # in a json file so later runs and jobs (the cryocare job after a slurm array) leave them out
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.load()
+        self.failed_this_run = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def save(self):
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.entries, indent=2))
+        tmp.replace(self.path)
+
+    def record(self, series, stage, error, attempts):
+        with self._lock, file_lock(self.path.with_suffix('.lock')):
+            self.failed_this_run.add(series)
+            self.entries = self.load()
+            self.entries[series] = {'stage': stage, 'error': error, 'attempts': attempts,
+                                    'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self.save()
+
+    def report(self):
+        if len(self.failed_this_run) > 0:
+            print(f'failed tilt series: {", ".join(sorted(self.failed_this_run))} (errors are in {self.path})')
+
+    def clear(self, series, stage=None):
+        # the stage that failed before succeeded now. without a stage the entry goes whatever stage it names:
+        # the series was reconstructed after all, which stage name the failure was recorded under (scratch,
+        # write_back, watch, ...) does not matter any more
+        if series not in self.entries or stage not in (None, self.entries[series].get('stage')):
+            return
+        with self._lock, file_lock(self.path.with_suffix('.lock')):
+            self.entries = self.load()
+            self.entries.pop(series, None)
+            self.save()
+
+
+class StageError(Exception):
+    # a command (or the check of its inputs and outputs) failed for one stage of one tilt series
+    def __init__(self, stage, series, message):
+        super().__init__(f'{stage} failed' + (f' for {series}' if series is not None else '') + f': {message}')
+        self.stage = stage
+        self.series = series
+
+
+class StageLog:
+    # records wall time, cpu time, peak rss, bytes read/written and exit status of every stage as json
+    # lines, child processes are measured with wait4 and python side work with the usage of its thread
+    def __init__(self):
+        self.path = None
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.records = []
+        self._lock = threading.Lock()
+        self.history = None
+        self.sizes = {}
+        self.context = {}
+
+    def open(self, path):
+        self.path = path
+
+    def stderr_path(self):
+        # stderr of the external programs, next to the stage records
+        return self.path.with_name(self.path.stem + '_stderr.log') if self.path is not None else None
+
+    def stream_stderr(self, pipe, prefix, tail):
+        # pass stderr on line by line while the command runs, so a program that hangs still shows what it did
+        log = open(self.stderr_path(), 'a') if self.path is not None else None
+        try:
+            for line in iter(pipe.readline, b''):
+                line = line.decode(errors='replace')
+                tail.append(line)
+                sys.stderr.write(line)
+                sys.stderr.flush()
+                if log is not None:
+                    log.write(f'{prefix} {line}')
+                    log.flush()
+        finally:
+            pipe.close()
+            if log is not None:
+                log.close()
+
+    def describe(self, sizes, **context):
+        # input sizes {tilt series: (n_tilts, ny, nx)} and parameters of this run, stored with every stage in
+        # the run history
+        self.sizes = sizes
+        self.context = context
+
+    def add(self, stage, series, start, wall_time, cpu_time, max_rss_kb, read_bytes, write_bytes, exit_status,
+            covers=None, gpus=1):
+        record = {'run_id': self.run_id, 'stage': stage, 'series': series, 'start': start,
+                  'wall_time': wall_time, 'cpu_time': cpu_time, 'max_rss_kb': max_rss_kb,
+                  'read_bytes': read_bytes, 'write_bytes': write_bytes, 'exit_status': exit_status}
+        with self._lock:
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            if self.history is not None:
+                # the tilt series a record is about: its own, the ones it was given, or all of the run
+                names = covers if covers is not None else [series] if series in self.sizes else list(self.sizes)
+                self.history.add(record, [self.sizes[x] for x in names if x in self.sizes], gpus, self.context)
+        return record
+
+    def run(self, command, stage, series=None, check=False, covers=None, gpus=1):
+        # stderr is read by a thread while we wait (so the pipe cannot fill up) and passed on as it arrives,
+        # the last lines are kept for the error message
+        start, t0 = time.time(), time.monotonic()
+        tail = collections.deque(maxlen=200)
+        process = subprocess.Popen(command, shell=True, stderr=subprocess.PIPE)
+        reader = threading.Thread(target=self.stream_stderr, daemon=True,
+                                  args=(process.stderr, f'[{stage}{"" if series is None else " " + series}]', tail))
+        reader.start()
+        _, status, usage = os.wait4(process.pid, 0)
+        reader.join()
+        stderr = ''.join(tail)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        self.add(stage, series, start, time.monotonic() - t0, usage.ru_utime + usage.ru_stime, usage.ru_maxrss,
+                 usage.ru_inblock * 512, usage.ru_oublock * 512, process.returncode, covers, gpus)
+        if check and process.returncode != 0:
+            raise StageError(stage, series, f'exit status {process.returncode}\n{stderr[-2000:]}')
+        return subprocess.CompletedProcess(command, process.returncode, stderr=stderr)
+
+    @contextlib.contextmanager
+    def measure(self, stage, series=None):
+        who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+        start, t0, before = time.time(), time.monotonic(), resource.getrusage(who)
+        exit_status = 1
+        try:
+            yield
+            exit_status = 0
+        finally:
+            after = resource.getrusage(who)
+            self.add(stage, series, start, time.monotonic() - t0,
+                     after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     (after.ru_inblock - before.ru_inblock) * 512, (after.ru_oublock - before.ru_oublock) * 512,
+                     exit_status)
+
+    def summary(self):
+        records = [x for x in self.records if x['run_id'] == self.run_id]
+        if len(records) == 0:
+            return
+        print('------------- stage summary ----------------')
+        print(f'{"stage":<20}{"n":>5}{"wall (s)":>12}{"max (s)":>10}{"cpu (s)":>12}{"max rss (GB)":>14}'
+              f'{"read (GB)":>11}{"write (GB)":>12}{"failed":>8}')
+        for stage in dict.fromkeys(x['stage'] for x in records):
+            rows = [x for x in records if x['stage'] == stage]
+            print(f'{stage:<20}{len(rows):>5}{sum(x["wall_time"] for x in rows):>12.1f}'
+                  f'{max(x["wall_time"] for x in rows):>10.1f}{sum(x["cpu_time"] for x in rows):>12.1f}'
+                  f'{max(x["max_rss_kb"] for x in rows) / 1024 ** 2:>14.2f}'
+                  f'{sum(x["read_bytes"] for x in rows) / 1024 ** 3:>11.2f}'
+                  f'{sum(x["write_bytes"] for x in rows) / 1024 ** 3:>12.2f}'
+                  f'{sum(x["exit_status"] != 0 for x in rows):>8}')
+        per_series = {}
+        for x in records:
+            if x['series'] is not None:
+                per_series[x['series']] = per_series.get(x['series'], 0.) + x['wall_time']
+        if len(per_series) > 0:
+            slowest = sorted(per_series.items(), key=itemgetter(1), reverse=True)[:5]
+            print('slowest tilt series: ' + ', '.join(f'{name} ({wall:.0f} s)' for name, wall in slowest))
+        if self.path is not None:
+            print(f'per stage records are in {self.path}')
+
+
+stage_log = StageLog()
+
+
+def default_history_path():
+    cache = os.environ.get('XDG_CACHE_HOME', pathlib.Path.home().joinpath('.cache'))
+    return pathlib.Path(cache).joinpath('tomo_prepper', 'run_history.sqlite')
+
+
+def work_sizes(sizes, binning, vol_z):
+    # frame pixels, reconstructed voxels and voxels times tilts, summed over tilt series of (n_tilts, ny, nx)
+    work = {'pixels': 0, 'voxels': 0, 'projections': 0}
+    for n_tilts, ny, nx in sizes:
+        voxels = (vol_z // binning) * (ny // binning) * (nx // binning) if None not in (binning, vol_z) else 0
+        work['pixels'] += n_tilts * ny * nx
+        work['voxels'] += voxels
+        work['projections'] += n_tilts * voxels
+    return work
+
+
+class RunHistory:
+    # sqlite store, shared between projects, of every stage that ran with the sizes of its inputs and the run
+    # parameters, so the planner can predict the wall time and memory of a new project from earlier ones
+    columns = ['run_id', 'script', 'project', 'stage', 'series', 'start', 'wall_time', 'cpu_time', 'max_rss_kb',
+               'read_bytes', 'write_bytes', 'exit_status', 'gpus', 'n_series', 'n_tilts', 'frame_ny', 'frame_nx',
+               'binning', 'vol_z', 'pixels', 'voxels', 'projections', 'parameters']
+
+    def __init__(self, path, script):
+        self.path = path
+        self.script = script
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(self.connect()) as db, db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS stage_runs ({", ".join(self.columns)})')
+
+    def connect(self):
+        # slurm array tasks and concurrent projects write to the same file
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add(self, record, sizes, gpus, context):
+        row = dict(record, script=self.script, project=context.get('project'), gpus=gpus, n_series=len(sizes),
+                   n_tilts=sum(x[0] for x in sizes), frame_ny=max((x[1] for x in sizes), default=None),
+                   frame_nx=max((x[2] for x in sizes), default=None), binning=context.get('binning'),
+                   vol_z=context.get('vol_z'), parameters=json.dumps(context.get('parameters'), default=str),
+                   **work_sizes(sizes, context.get('binning'), context.get('vol_z')))
+        try:
+            with contextlib.closing(self.connect()) as db, db:
+                db.execute(f'INSERT INTO stage_runs ({", ".join(self.columns)}) '
+                           f'VALUES ({", ".join(":" + x for x in self.columns)})', row)
+        except sqlite3.Error as e:
+            print(f'could not add {record["stage"]} to the run history {self.path}: {e}')
+
+    def stage_runs(self):
+        # successful stage runs of this script
+        with contextlib.closing(self.connect()) as db:
+            db.row_factory = sqlite3.Row
+            return [dict(x) for x in db.execute('SELECT * FROM stage_runs WHERE script = ? AND exit_status = 0',
+                                                (self.script,))]
+
+
+def fit_history(work, values, new_work):
+    # straight line through the (work, value) pairs of earlier runs, proportional to the work when they all
+    # had the same work, and their mean when the stage does not depend on the work
+    work, values = np.asarray(work, dtype=float), np.asarray(values, dtype=float)
+    if len(np.unique(work)) >= 2:
+        slope, intercept = np.polyfit(work, values, 1)
+        if slope > 0:
+            return max(0., slope * new_work + intercept)
+    return float(values.mean() * new_work / work.mean()) if work.mean() > 0 else float(values.mean())
+
+
+def plan_stages(rows, work, stage_work):
+    # predicted seconds (gpu seconds for runs on more than one gpu) and peak rss in bytes of every stage in the
+    # history, for a project with the given work sizes. records of the same stage, tilt series and size in one
+    # run are parts of the same work (motioncor2 runs per tilt) and are added up first. stage_work maps a stage to
+    # the size ('pixels', 'voxels' or 'projections') its time scales with
+    parts = {}
+    for x in rows:
+        key = (x['run_id'], x['stage'], x['series'], x['pixels'], x['voxels'], x['projections'])
+        seconds, rss = parts.get(key, (0., 0))
+        parts[key] = (seconds + x['wall_time'] * max(1, x['gpus'] or 1), max(rss, x['max_rss_kb'] * 1024))
+    stages = {}
+    for stage in dict.fromkeys(key[1] for key in parts):
+        kind = stage_work.get(stage)
+        column = {'pixels': 3, 'voxels': 4, 'projections': 5}.get(kind)
+        runs = [(1. if column is None else key[column], value) for key, value in parts.items()
+                if key[1] == stage and (column is None or key[column] > 0)]
+        if len(runs) == 0:
+            continue
+        new_work = 1. if kind is None else work[kind]
+        stages[stage] = (len(runs), fit_history([x for x, _ in runs], [v[0] for _, v in runs], new_work),
+                         fit_history([x for x, _ in runs], [v[1] for _, v in runs], new_work))
+    return stages
+
+
+def recommend_workers(peak_bytes):
+    # copies of a stage that fit in 80% of the memory of this machine, at most one per cpu
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return max(1, min(os.cpu_count() or 1, int(0.8 * memory // max(peak_bytes, 1))))
+
+
+def print_plan(stages, max_gpus, gpu_stages):
+    # predicted time per stage and of the whole run on 1..max_gpus gpus, returns the recommended number of
+    # gpus: the fewest that are within 10% of the fastest. the time of gpu_stages is spread over the gpus
+    print(f'{"stage":<20}{"runs":>6}{"time (s)":>12}{"peak rss (GB)":>15}')
+    for stage, (n_runs, seconds, memory) in stages.items():
+        print(f'{stage + (" *" if stage in gpu_stages else ""):<20}{n_runs:>6}{seconds:>12.0f}'
+              f'{memory / 1024 ** 3:>15.2f}')
+    print('* gpu seconds, spread over the gpus')
+    wall = {}
+    for n_gpus in range(1, max_gpus + 1):
+        wall[n_gpus] = sum(seconds / n_gpus if stage in gpu_stages else seconds
+                           for stage, (_, seconds, _) in stages.items())
+        print(f'{n_gpus:>3} gpu{"s" if n_gpus > 1 else " "}  {wall[n_gpus] / 3600:>8.2f} h')
+    return min(n for n in wall if wall[n] <= 1.1 * wall[max_gpus])
+
+
+def mrc_size(shape, bytes_per_voxel=4):
+    return 1024 + int(np.prod(shape, dtype=np.int64)) * bytes_per_voxel
+
+
+def train_data_size(train_data_config, n_tomograms):
+    # cryocare extracts num_slices even and odd patches from every training tomogram
+    return 2 * n_tomograms * train_data_config['num_slices'] * mrc_size(train_data_config['patch_shape'])
+
+
+def peak_disk_usage(changes):
+    # highest point of a running total of bytes written (positive) and deleted (negative)
+    total, peak = 0, 0
+    for x in changes:
+        total += x
+        peak = max(peak, total)
+    return peak
+
+
+def print_disk_plan(totals, peak, available):
+    print('------------- disk plan ----------------')
+    for stage, size in totals.items():
+        print(f'{stage:<20}{size / 1024 ** 3:>10.1f} GB')
+    print(f'{"peak":<20}{peak / 1024 ** 3:>10.1f} GB')
+    print(f'{"available":<20}{available / 1024 ** 3:>10.1f} GB')
+
+
+def estimate_predict_memory(tile_shape, n_depth, n_first, bytes_per_value=4):
+    # u-net activations for one tile: every level keeps about three feature maps (two convolutions and
+    # the skip connection) with n_first * 2**level channels at 1/2**level of the resolution
+    voxels = float(np.prod(tile_shape))
+    return voxels * bytes_per_value * (1 + sum(3 * n_first * 2 ** level / 8 ** level for level in range(n_depth + 1)))
+
+
+def plan_n_tiles(shape, memory_budget, n_depth, n_first, kern_size, max_tiles=16, name=None):
+    # smallest number of tiles (most even split first) whose padded tile fits in the memory budget. a
+    # budget that not even the finest tiling fits is an error, cryocare would run out of gpu memory
+    margin = kern_size * 2 ** n_depth
+    candidates = sorted(((z, y, x) for z in range(1, max_tiles + 1) for y in range(1, max_tiles + 1)
+                         for x in range(1, max_tiles + 1)), key=lambda t: (np.prod(t), max(t)))
+    for n_tiles in candidates:
+        tile = [min(s, -(-s // n) + (2 * margin if n > 1 else 0)) for s, n in zip(shape, n_tiles)]
+        if estimate_predict_memory(tile, n_depth, n_first) <= memory_budget:
+            return n_tiles
+    smallest = estimate_predict_memory(tile, n_depth, n_first)
+    raise StageError('cryocare_predict', name, f'no tiling up to {list(n_tiles)} of a {list(shape)} volume fits '
+                     f'in {memory_budget / 1024 ** 3:.3g} GB, the finest needs about {smallest / 1024 ** 3:.3g} GB. '
+                     'raise --predict-memory-gb')
+
+
+def plan_prediction_groups(tomogram_dir, memory_budget, train_config):
+    # read the volume shapes from the mrc headers and group the tomograms that need the same tiling
+    groups = {}
+    for tomo in sorted(tomogram_dir.glob('*.mrc')):
+        with mrcfile.open(tomo, header_only=True, permissive=True) as mrc:
+            shape = (int(mrc.header.nz), int(mrc.header.ny), int(mrc.header.nx))
+        n_tiles = plan_n_tiles(shape, memory_budget, train_config['unet_n_depth'], train_config['unet_n_first'],
+                               train_config['unet_kern_size'], name=tomo.name)
+        groups.setdefault(n_tiles, []).append(tomo.name)
+    return groups
+
+
+def link_tomograms(names, source_dir, target_dir):
+    if target_dir.exists():
+        shutil.rmtree(target_dir)
+    target_dir.mkdir(parents=True)
+    for name in names:
+        target_dir.joinpath(name).symlink_to(source_dir.joinpath(name).resolve())
+
+
+class TrainDataCache:
+    # extracted cryocare training data, kept in a folder per set of tomograms (name and fingerprint of the even
+    # and odd tomogram, and the manifest key of the reconstruction, which changes when a tomogram is rebuilt
+    # with other content) and extraction settings, so a later run with the same selection reuses it. the
+    # tomograms are given as (tilt series name, even, odd, reconstruction key)
+    def __init__(self, path, manifest, train_data_config):
+        self.path = path
+        self.manifest = manifest
+        self.train_data_config = train_data_config
+
+    @staticmethod
+    def entry(even, odd, key):
+        return [file_fingerprint(even), file_fingerprint(odd), key]
+
+    def previous(self):
+        # selection entries, by tilt series name, of the training data extracted last
+        key = self.manifest.entries.get('_project', {}).get('cryocare_extract')
+        selection = self.path.joinpath(str(key), 'selection.json')
+        if key is None or not selection.exists():
+            return {}
+        with open(selection, 'r') as f:
+            return json.load(f)
+
+    def draw(self, tomograms, size):
+        # random training subset: the tilt series of the last extraction whose tomograms did not change are
+        # kept, so the training data extracted from them is reused, and only the rest of the subset is drawn
+        previous = self.previous()
+        kept = [i for i, (name, *x) in enumerate(tomograms) if previous.get(name) == self.entry(*x)][:size]
+        rest = [i for i in range(len(tomograms)) if i not in kept]
+        return kept + list(np.random.choice(rest, size - len(kept), replace=False))
+
+    def folder(self, tomograms):
+        # folder of the training data of these tomograms with the current settings, and their selection entries
+        selection = {name: self.entry(even, odd, key) for name, even, odd, key in tomograms}
+        settings = {k: v for k, v in self.train_data_config.items() if k not in ('even', 'odd', 'path', 'overwrite')}
+        return self.path.joinpath(stage_key(selection, settings)[:16]), selection
+
+    def extract(self, train_data, selection, train_data_file):
+        if self.manifest.enabled and train_data.joinpath('selection.json').exists():
+            print(f'reusing cryocare training data extracted before in {train_data}')
+            os.utime(train_data)
+        else:
+            stage_log.run(f'cryoCARE_extract_train_data.py --conf {train_data_file}', 'cryocare_extract', check=True)
+            # written last, a folder without it is an extraction that did not finish
+            with open(train_data.joinpath('selection.json'), 'w') as f:
+                f.write(json.dumps(selection, indent=2))
+            # only the most recently used extractions are kept
+            cached = sorted(self.path.iterdir(), key=lambda x: x.stat().st_mtime, reverse=True)
+            for folder in cached[TRAIN_DATA_CACHE_SIZE:]:
+                shutil.rmtree(folder)
+        self.manifest.record('_project', 'cryocare_extract', train_data.name)
+
+
+class ModelRegistry:
+    # local store of trained cryocare models together with the acquisition parameters and training
+    # settings they were trained with, so later projects can predict with a compatible model
+    def __init__(self, path, train_config, train_data_config, pixel_tolerance=0.02):
+        # the cryocare configs of the calling script, a model only matches when its u-net and patches do
+        self.path = path
+        self.train_config = train_config
+        self.train_data_config = train_data_config
+        self.pixel_tolerance = pixel_tolerance
+
+    def entries(self):
+        for metadata_file in sorted(self.path.glob('*/metadata.json')):
+            with open(metadata_file, 'r') as f:
+                yield metadata_file.parent, json.load(f)
+
+    def register(self, model_file, model_name, acquisition):
+        metadata = dict(acquisition, model_name=model_name, created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                        train_config={k: self.train_config[k] for k in REGISTRY_TRAIN_KEYS},
+                        patch_shape=self.train_data_config['patch_shape'])
+        entry = self.path.joinpath(f'{model_name}-{file_digest(model_file)[:8]}')
+        entry.mkdir(parents=True, exist_ok=True)
+        shutil.copy(model_file, entry.joinpath('model.tar.gz'))
+        with open(entry.joinpath('metadata.json'), 'w') as f:
+            f.write(json.dumps(metadata, indent=2))
+        print(f'registered cryocare model in {entry}')
+
+    def compatible(self, metadata, acquisition):
+        if any(metadata.get(k) != acquisition.get(k) for k in ('binning', 'vol_z', 'sample_type')):
+            return False
+        if None not in (metadata.get('kV'), acquisition.get('kV')) and metadata['kV'] != acquisition['kV']:
+            return False
+        if abs(metadata['pixel_size'] - acquisition['pixel_size']) > self.pixel_tolerance * acquisition['pixel_size']:
+            return False
+        return (metadata['train_config'] == {k: self.train_config[k] for k in REGISTRY_TRAIN_KEYS} and
+                metadata['patch_shape'] == self.train_data_config['patch_shape'])
+
+    def find(self, acquisition):
+        # most recent compatible model, or None
+        found = [(metadata['created'], entry) for entry, metadata in self.entries()
+                 if self.compatible(metadata, acquisition)]
+        return max(found)[1].joinpath('model.tar.gz') if len(found) > 0 else None
+
+
+class RawWatcher:
+    # polls the raw folder and reports each mdoc once all of its subframes exist and neither the mdoc
+    # nor the frames changed size for settle_time seconds
+    def __init__(self, raw_dir, frame_files, settle_time=60., clock=time.monotonic):
+        self.raw_dir = raw_dir
+        self.frame_files = frame_files
+        self.settle_time = settle_time
+        self.clock = clock
+        self.reported = set()
+        self._snapshots = {}
+
+    def snapshot(self, mdoc):
+        # an mdoc that does not parse yet (no ImageFile, a line cut off at 'ExposureDose = ') is still being
+        # written, it is not ready like one whose frames are missing
+        try:
+            frames = self.frame_files(mdoc)
+        except Exception:
+            return None
+        if len(frames) == 0 or not all(x.exists() for x in frames):
+            return None
+        return tuple(x.stat().st_size for x in [mdoc] + frames)
+
+    def poll(self):
+        ready = []
+        for mdoc in sorted(self.raw_dir.glob('*.mdoc')):
+            if mdoc in self.reported:
+                continue
+            snapshot = self.snapshot(mdoc)
+            previous = self._snapshots.get(mdoc)
+            now = self.clock()
+            if snapshot is None or previous is None or previous[0] != snapshot:
+                self._snapshots[mdoc] = (snapshot, now)
+            elif now - previous[1] >= self.settle_time:
+                self.reported.add(mdoc)
+                ready.append(mdoc)
+        return ready
+
+
+def watch(watcher, process, poll_interval=30., idle_timeout=None):
+    # hand every completed mdoc to process() until nothing new arrived for idle_timeout seconds
+    # (or forever if not given, stop with ctrl+c)
+    last_arrival = time.monotonic()
+    try:
+        while True:
+            ready = watcher.poll()
+            for mdoc in ready:
+                print(f'{mdoc.name} is complete, start processing')
+                process(mdoc)
+            if len(ready) > 0:
+                last_arrival = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - last_arrival > idle_timeout:
+                print(f'no new tilt series for {idle_timeout} seconds, stop watching')
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print('stopped watching')
+
+
+def record_watch_failures(futures, failures, stage):
+    # wait for the tilt series process() handed to an executor, one that raised is recorded as failed so it
+    # is left out of cryocare like in a batch run
+    for series, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            print(f'{stage} for {series} failed: {type(e).__name__}: {e}')
+            failures.record(series, stage, f'{type(e).__name__}: {e}', 1)
+
+
+def submit_slurm_job(script, sbatch_options='', dependency=None):
+    command = [SBATCH_CMD, '--parsable'] + shlex.split(sbatch_options)
+    if dependency is not None:
+        command.append(f'--dependency=afterok:{dependency}')
+    result = subprocess.run(command + [str(script)], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f'sbatch failed: {result.stderr.strip()}')
+        sys.exit(1)
+    # --parsable prints "jobid" or "jobid;cluster"
+    return result.stdout.strip().split(';')[0]
+
+
+def wait_for_slurm_jobs(job_ids, poll_interval=30.):
+    # squeue lists nothing (or fails on an unknown id) once the jobs are no longer pending or running
+    while True:
+        result = subprocess.run([SQUEUE_CMD, '-h', '-j', ','.join(job_ids)], capture_output=True, text=True)
+        if result.stdout.strip() == '':
+            return
+        time.sleep(poll_interval)
+
+
+def read_series_list(path):
+    # names of the mdocs a slurm submission was made for, one per line
+    with open(path, 'r') as f:
+        return [x for x in f.read().splitlines() if x != '']
+
+
+def submit_to_slurm(script, project_path, mdocs, n_tasks, sbatch_options='', wait=False, poll_interval=30.,
+                    task_args=()):
+    # every array task reruns the script with the same arguments on one tilt series (or shard), the
+    # cryocare job reruns it on the reconstructions of all tasks once the whole array finished without errors.
+    # the tasks index into the list of mdocs written here, so tilt series that arrive in raw/ while the jobs
+    # are queued do not shift them
+    if n_tasks == 0:
+        print('no tilt series to submit')
+        return None
+    slurm_dir = project_path.resolve().joinpath('slurm')
+    slurm_dir.mkdir(exist_ok=True)
+    fd, series_list = tempfile.mkstemp(prefix='series_', suffix='.txt', dir=slurm_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(f'{x.name}\n' for x in mdocs)
+    command = ' '.join(shlex.quote(x) for x in [sys.executable, str(pathlib.Path(script).resolve())] +
+                       sys.argv[1:] + ['--backend', 'local', '--series-list', series_list] + list(task_args))
+    array_script = slurm_dir.joinpath('series_array.sh')
+    with open(array_script, 'w') as f:
+        f.write('#!/bin/bash\n'
+                f'#SBATCH --job-name={project_path.resolve().name}_series\n'
+                f'#SBATCH --array=0-{n_tasks - 1}\n'
+                f'#SBATCH --output={slurm_dir}/series_%A_%a.out\n'
+                f'{command} --series-index $SLURM_ARRAY_TASK_ID\n')
+    cryocare_script = slurm_dir.joinpath('cryocare.sh')
+    with open(cryocare_script, 'w') as f:
+        f.write('#!/bin/bash\n'
+                f'#SBATCH --job-name={project_path.resolve().name}_cryocare\n'
+                f'#SBATCH --output={slurm_dir}/cryocare_%j.out\n'
+                f'{command} --cryocare-only\n')
+    array_id = submit_slurm_job(array_script, sbatch_options)
+    cryocare_id = submit_slurm_job(cryocare_script, sbatch_options, array_id)
+    print(f'submitted array job {array_id} ({n_tasks} tasks) and cryocare job {cryocare_id}, '
+          f'logs are in {slurm_dir}')
+    if wait:
+        wait_for_slurm_jobs([array_id, cryocare_id], poll_interval)
+        print('slurm jobs finished')
+    return array_id, cryocare_id
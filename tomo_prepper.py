@@ -58,10 +58,23 @@ import subprocess
 import argparse
 import pathlib
 import sys
+import tempfile
 import json
+import queue
+import shutil
+import struct
+import threading
+import time
 import mrcfile
 import numpy as np
 from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from prepper_common import (mdoc_image_size, RunningStats, make_preview, write_qc_index, select_training_subset,
+                            write_ome_zarr, file_fingerprint, file_digest, stage_key, StageManifest, FailureLog,
+                            TrainDataCache, StageError, stage_log, default_history_path, work_sizes, RunHistory,
+                            plan_stages, recommend_workers, print_plan, mrc_size, train_data_size, peak_disk_usage,
+                            print_disk_plan, plan_prediction_groups, link_tomograms, ModelRegistry, RawWatcher, watch,
+                            record_watch_failures, submit_to_slurm, read_series_list)
 
 
 MOTIONCOR2_CMD = 'motioncor2'
@@ -98,6 +111,18 @@ cryocare_train_config = {
   "gpu_id": None
 }
 
+
+# what the run time and memory of a stage grow with, for the planner: the frames of its tilt series ('pixels'),
+# the reconstructed volume ('voxels') or that times the tilts it is made from ('projections'). stages that are
+# not listed take about the same time for every project (cryocare training)
+STAGE_WORK = {'motioncor2': 'pixels', 'stage_in': 'pixels', 'stacks': 'pixels', 'write_back': 'pixels',
+              'aretomo_full': 'projections', 'aretomo_even': 'projections', 'aretomo_odd': 'projections',
+              'normalise': 'voxels', 'cryocare_predict': 'voxels', 'qc_previews': 'voxels', 'zarr': 'voxels'}
+# stages the planner spreads over the gpus, they go through the gpu pool one tilt series (or tilt) at a time
+GPU_STAGES = ['motioncor2', 'aretomo_full', 'aretomo_even', 'aretomo_odd']
+# stages a failure is recorded under in failed_series.json, every way of running goes through them
+PIPELINE_STAGES = ['motioncor2', 'stacks', 'aretomo']
+
 cryocare_predict_config = {
   "path": None,
   "even": None,
@@ -126,37 +151,194 @@ def parse_mdoc(mdoc_file):
     return tilt_series_name, subframe_list, tilt_angle_list
 
 
-def create_stack(tilt_images, outname, pixel_size):
+def mdoc_value(mdoc_file, key):
+    # first value of a key in the mdoc as float, or None when it is not there
+    with open(mdoc_file, 'r') as infile:
+        for x in infile.readlines():
+            line = x.strip()
+            if line.startswith(key) and '=' in line and line.split('=')[0].strip() == key:
+                return float(line.split('=')[1].split()[0])
+    return None
+
+
+def mdoc_section_values(mdoc_file, key):
+    # value of a key for every tilt ([ZValue] section) as float, None for sections without it
+    values = []
+    with open(mdoc_file, 'r') as infile:
+        for x in infile.readlines():
+            line = x.strip()
+            if line.startswith('[ZValue'):
+                values.append(None)
+            elif len(values) > 0 and '=' in line and line.split('=')[0].strip() == key:
+                values[-1] = float(line.split('=')[1].split()[0])
+    return values
+
+
+def eer_frame_count(eer_file):
+    # an eer movie is a tiff with one image file directory per frame, only the chain of directories is read
+    with open(eer_file, 'rb') as f:
+        order = '<' if f.read(2) == b'II' else '>'
+        bigtiff = struct.unpack(order + 'H', f.read(2))[0] == 43
+        if bigtiff:
+            f.read(4)
+        offset = struct.unpack(order + ('Q' if bigtiff else 'I'), f.read(8 if bigtiff else 4))[0]
+        n_frames = 0
+        while offset != 0:
+            n_frames += 1
+            f.seek(offset)
+            if bigtiff:
+                n_entries = struct.unpack(order + 'Q', f.read(8))[0]
+                f.seek(offset + 8 + n_entries * 20)
+                offset = struct.unpack(order + 'Q', f.read(8))[0]
+            else:
+                n_entries = struct.unpack(order + 'H', f.read(2))[0]
+                f.seek(offset + 2 + n_entries * 12)
+                offset = struct.unpack(order + 'I', f.read(4))[0]
+    return n_frames
+
+
+def eer_fractions(n_frames, exposure_dose, fraction_dose):
+    # line of a motioncor2 FmIntFile: raw frames, raw frames summed per fraction, dose per raw frame.
+    # the group size brings each fraction as close as possible to the target dose
+    frame_dose = exposure_dose / n_frames
+    group = int(min(n_frames, max(1, round(fraction_dose / frame_dose))))
+    return f'{n_frames} {group} {frame_dose:.6g}\n'
+
+
+def create_stack(tilt_images, outname, pixel_size, float16=False):
+    if float16:
+        # converted tilt by tilt, a float16 copy of the whole stack is never held in memory
+        create_stacks_streaming([tilt_images], [outname], pixel_size, mrc_mode=12)
+        return
     with mrcfile.new(outname, overwrite=True) as newstack:
         images = [mrcfile.read(x) for x in tilt_images]
         newstack.set_data(np.stack(images, axis=0))
         newstack.voxel_size = pixel_size
 
 
+def create_stacks_streaming(tilt_image_lists, outnames, pixel_size, mrc_mode=None):
+    # write one or more stacks in a single pass over the tilts, each stack is created at its final
+    # shape and filled through a memory map so only one tilt is held in memory at a time. the mode
+    # is that of the tilts unless given (12 for float16)
+    with mrcfile.open(tilt_image_lists[0][0], header_only=True) as first:
+        shape = (len(tilt_image_lists[0]), int(first.header.ny), int(first.header.nx))
+        mrc_mode = int(first.header.mode) if mrc_mode is None else mrc_mode
+    stacks = [mrcfile.new_mmap(x, shape, mrc_mode=mrc_mode, overwrite=True) for x in outnames]
+    stats = [RunningStats() for _ in outnames]
+    try:
+        for i, tilts in enumerate(zip(*tilt_image_lists)):
+            for stack, stat, tilt in zip(stacks, stats, tilts):
+                with mrcfile.mmap(tilt, mode='r') as image:
+                    stack.data[i] = image.data
+                stat.update(stack.data[i])
+        for stack, stat in zip(stacks, stats):
+            stack.voxel_size = pixel_size
+            stat.set_header(stack)
+    finally:
+        for stack in stacks:
+            stack.close()
+
+
 def create_tilt_file(tilt_angles, outname):
     with open(outname, 'w') as f:
         f.writelines([str(x) + '\n' for x in tilt_angles])
         
         
-def normalise(mrc_path):
+def normalise(mrc_path, slab_size=None, float16=False):
+    if float16:
+        normalise_to_float16(mrc_path, slab_size if slab_size is not None else 32)
+        return
+    if slab_size is not None:
+        normalise_streaming(mrc_path, slab_size)
+        return
     with mrcfile.open(mrc_path, mode='r+') as tomo:
         tomo.data[:] = tomo.data / tomo.data.std()
         tomo.update_header_from_data()
         tomo.update_header_stats()
 
 
+def normalise_streaming(mrc_path, slab_size):
+    # two passes over z-slabs of a memory map: first the std, then rescale in place
+    with mrcfile.mmap(mrc_path, mode='r+') as tomo:
+        nz = tomo.data.shape[0]
+        stats = RunningStats()
+        for z in range(0, nz, slab_size):
+            stats.update(tomo.data[z:z + slab_size])
+        std = stats.std
+        stats = RunningStats()
+        for z in range(0, nz, slab_size):
+            slab = tomo.data[z:z + slab_size]
+            slab[:] = slab / std
+            stats.update(slab)
+        stats.set_header(tomo)
+
+
+def normalise_to_float16(mrc_path, slab_size):
+    # like normalise_streaming, but the rescaled slabs go into a new mode 12 (float16) file that then
+    # replaces the original, so only one slab is converted in memory at a time
+    part = mrc_path.with_name(mrc_path.name + '.part')
+    with mrcfile.mmap(mrc_path, mode='r') as tomo:
+        nz = tomo.data.shape[0]
+        stats = RunningStats()
+        for z in range(0, nz, slab_size):
+            stats.update(tomo.data[z:z + slab_size])
+        std = stats.std
+        with mrcfile.new_mmap(part, tomo.data.shape, mrc_mode=12, overwrite=True) as out:
+            out.voxel_size = tomo.voxel_size
+            out.header.origin = tomo.header.origin
+            stats = RunningStats()
+            for z in range(0, nz, slab_size):
+                out.data[z:z + slab_size] = tomo.data[z:z + slab_size] / std
+                stats.update(out.data[z:z + slab_size])
+            stats.set_header(out)
+    part.replace(mrc_path)
+
+
+def copy_file(source, target):
+    # copy through a temporary name, so an interrupted copy never looks like a finished file
+    part = target.with_name(target.name + '.part')
+    shutil.copyfile(source, part)
+    part.replace(target)
+
+
+class GpuPool:
+    # hands out gpu ids to concurrent jobs, each gpu runs one job at a time
+    def __init__(self, gpu_ids):
+        self.gpu_ids = list(gpu_ids)
+        self._free = queue.Queue()
+        for gpu_id in self.gpu_ids:
+            self._free.put(gpu_id)
+
+    def run(self, args, stage, series=None):
+        gpu_id = self._free.get()
+        try:
+            return stage_log.run(' '.join(args + [f'-Gpu {gpu_id}']), stage, series, check=True)
+        finally:
+            self._free.put(gpu_id)
+
+    def map(self, jobs):
+        # jobs are (args, stage, series) tuples
+        with ThreadPoolExecutor(max_workers=len(self.gpu_ids)) as executor:
+            return list(executor.map(lambda x: self.run(*x), jobs))
+
+
 class TiltSeries:
-    def __init__(self, mdoc_path):
+    def __init__(self, mdoc_path, eer=None):
         self.mdoc_path = mdoc_path
+        # (sampling, dose per fraction, dose per tilt when the mdoc has none) to give eer movies to motioncor2
+        # directly, None if they were converted to tif
+        self.eer = eer
         self.series_name, subframes, self.tilt_angles = parse_mdoc(self.mdoc_path)
+        self.exposure_doses = mdoc_section_values(self.mdoc_path, 'ExposureDose')
         self.series_name = self.series_name.strip('.mrc')
         self.subframes = []
         for subframe in subframes:
             # make pure windows path to find tif or eer file name
             self.subframes.append(self.mdoc_path.parent.joinpath(pathlib.PureWindowsPath(subframe).name))
-        self.corrected_frames = []
-        self.corrected_frames_even = []
-        self.corrected_frames_odd = []
+        # motioncor2 sums (and even/odd sums) of every tilt, in the acquisition order of the mdoc
+        self.corrected_frames = [x.with_name(x.stem + '_motcor.mrc') for x in self.input_frames()]
+        self.corrected_frames_even = [x.with_name(x.stem + '_motcor_EVN.mrc') for x in self.input_frames()]
+        self.corrected_frames_odd = [x.with_name(x.stem + '_motcor_ODD.mrc') for x in self.input_frames()]
         self.full_stack = None
         self.even_stack = None
         self.odd_stack = None
@@ -165,76 +347,152 @@ class TiltSeries:
         self.tomo_even = None
         self.tomo_odd = None
         self.tilt_alignment = None
+        self.stage_keys = {}
             
-    def motion_correction(self, gain_file, gpu_id):
-        for subframe in self.subframes:
-            if subframe.suffix == '.eer':
-                subframe = subframe.with_suffix('.tif')
-            if not subframe.exists():
-                print(f'tif does not exist {subframe}, cannot continue')
-                sys.exit(0)
+    def input_frames(self):
+        if self.eer is not None:
+            return list(self.subframes)
+        return [x.with_suffix('.tif') if x.suffix == '.eer' else x for x in self.subframes]
+    
+    def native_eer(self, subframe):
+        return subframe.suffix == '.eer' and self.eer is not None
+    
+    def write_fraction_files(self):
+        # frame grouping of the eer movies, written right before motioncor2 runs on them
+        for i, subframe in enumerate(self.input_frames()):
+            if not self.native_eer(subframe):
+                continue
+            dose = self.exposure_doses[i] if i < len(self.exposure_doses) else None
+            # serialem writes ExposureDose = 0 when the dose is not calibrated
+            if dose is None or dose <= 0:
+                dose = self.eer[2]
+            if dose is None or dose <= 0:
+                raise StageError('motioncor2', self.series_name,
+                                 f'no ExposureDose above 0 in the mdoc for {subframe.name}, needed to group the eer '
+                                 'frames. give the dose per tilt with --eer-total-dose, or use --eer-input tif')
+            with open(subframe.with_name(subframe.stem + '_fmint.txt'), 'w') as f:
+                f.write(eer_fractions(eer_frame_count(subframe), dose, self.eer[1]))
             
-            raw_dir, frame_id = subframe.parent, subframe.stem
-            frame_sum = raw_dir.joinpath(frame_id + '_motcor.mrc')
-            frame_sum_even = raw_dir.joinpath(frame_id + '_motcor_EVN.mrc')
-            frame_sum_odd = raw_dir.joinpath(frame_id + '_motcor_ODD.mrc')
+    def motioncor2_commands(self, gain_file):
+        # one command per tilt, writing to corrected_frames. the gpu is assigned by the GpuPool, the eer
+        # fraction files are written by write_fraction_files
+        commands = []
+        for subframe, frame_sum in zip(self.input_frames(), self.corrected_frames):
+            if not subframe.exists():
+                raise StageError('motioncor2', self.series_name, f'{subframe.suffix[1:]} does not exist {subframe}')
+            if self.native_eer(subframe):
+                # eer is read directly, frames are grouped to the target dose per fraction and super
+                # resolution sampling is binned back to the physical pixel size
+                input_args = [f'-InEer {subframe}', f'-EerSampling {self.eer[0]}', f'-FtBin {2 ** (self.eer[0] - 1)}',
+                              f'-FmIntFile {subframe.with_name(subframe.stem + "_fmint.txt")}']
+            else:
+                input_args = [f'-InTiff {subframe}']
+            commands.append([MOTIONCOR2_CMD] + input_args + [f'-OutMrc {frame_sum}', '-SplitSum 1'] +
+                            ([f'-Gain {gain_file} '] if gain_file is not None else []))
+        return commands
             
-            args = [MOTIONCOR2_CMD, f'-InTiff {subframe}', f'-OutMrc {frame_sum}', f'-Gpu {gpu_id}', 
-                    '-SplitSum 1'] + ([f'-Gain {gain_file} '] if gain_file is not None else [])
-            subprocess.run(' '.join(args), shell=True)
-                
-            self.corrected_frames.append(frame_sum)
-            self.corrected_frames_even.append(frame_sum_even)
-            self.corrected_frames_odd.append(frame_sum_odd)
+    def motion_correction(self, gain_file, gpu_pool):
+        commands = self.motioncor2_commands(gain_file)
+        self.write_fraction_files()
+        gpu_pool.map([(x, 'motioncor2', self.series_name) for x in commands])
+    
+    def sorted_tilts(self):
+        # tilt angles with their full/even/odd sums, ordered by tilt angle for the stacks
+        return zip(*sorted(zip(self.tilt_angles, self.corrected_frames, self.corrected_frames_even,
+                               self.corrected_frames_odd), key=itemgetter(0)))
             
-    def to_stacks(self, stacks_path, pixel_size):
-        # order stacks by tilt angle first
-        l = sorted(zip(self.tilt_angles, self.corrected_frames, 
-                       self.corrected_frames_even, self.corrected_frames_odd), key=itemgetter(0))
-        self.tilt_angles, self.corrected_frames, self.corrected_frames_even, self.corrected_frames_odd = zip(*l)
-        
-        # then write everything
+    def stack_paths(self, stacks_path):
         self.full_stack = stacks_path.joinpath(self.series_name + '.st')
         self.even_stack = stacks_path.joinpath(self.series_name + '_even.st')
         self.odd_stack = stacks_path.joinpath(self.series_name + '_odd.st')
         self.rawtlt_file = stacks_path.joinpath(self.series_name + '.rawtlt')
-        create_stack(self.corrected_frames, self.full_stack, pixel_size)
-        create_stack(self.corrected_frames_even, self.even_stack, pixel_size)
-        create_stack(self.corrected_frames_odd, self.odd_stack, pixel_size)
-        create_tilt_file(self.tilt_angles, self.rawtlt_file)
+        return [self.full_stack, self.even_stack, self.odd_stack, self.rawtlt_file]
+            
+    def to_stacks(self, stacks_path, pixel_size, streaming=False, float16=False):
+        self.stack_paths(stacks_path)
+        tilt_angles, frames, frames_even, frames_odd = self.sorted_tilts()
         
-    def reconstruction(self, full_path, even_path, odd_path, tilt_axis, 
-                       vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_id):
+        # then write everything
+        with stage_log.measure('stacks', self.series_name):
+            if streaming:
+                create_stacks_streaming([frames, frames_even, frames_odd],
+                                        [self.full_stack, self.even_stack, self.odd_stack], pixel_size,
+                                        12 if float16 else None)
+            else:
+                create_stack(frames, self.full_stack, pixel_size, float16)
+                create_stack(frames_even, self.even_stack, pixel_size, float16)
+                create_stack(frames_odd, self.odd_stack, pixel_size, float16)
+            create_tilt_file(tilt_angles, self.rawtlt_file)
+        
+    def tomogram_paths(self, full_path, even_path, odd_path):
         self.tomo_full = full_path.joinpath(self.series_name + '.mrc')
         self.tilt_alignment = full_path.joinpath(self.series_name + '.st.aln')
         self.tomo_even = even_path.joinpath(self.series_name + '.mrc')
         self.tomo_odd = odd_path.joinpath(self.series_name + '.mrc')
+        return [self.tomo_full, self.tomo_even, self.tomo_odd]
         
+    def reconstruct_full(self, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_pool):
         args = [ARETOMO_CMD, f'-InMrc {self.full_stack}', f'-AngFile {self.rawtlt_file}',
                 f'-OutMrc {self.tomo_full}', f'-VolZ {vol_z}', f'-AlignZ {align_z}', f'-OutBin {binning}', 
                 '-DarkTol 0.01', '-FlipVol 1', '-Wbp 1', f'-OutImod {out_imod}',
-                f'-TiltCor {tiltcor} ' + (str(tiltcor_angle) if tiltcor_angle is not None else ''),
-                f'-Gpu {gpu_id}'] + ([f'-TiltAxis {tilt_axis}'] if tilt_axis is not None else [])
-        subprocess.run(' '.join(args), shell=True)
+                f'-TiltCor {tiltcor} ' + (str(tiltcor_angle) if tiltcor_angle is not None else '')
+                ] + ([f'-TiltAxis {tilt_axis}'] if tilt_axis is not None else [])
+        gpu_pool.run(args, 'aretomo_full', self.series_name)
         
+    def reconstruct_even_odd(self, vol_z, binning, gpu_pool):
+        # both only depend on the alignment of the full reconstruction, so they run side by side
+        # when the pool has more than one gpu
         args_even = [ARETOMO_CMD, f'-InMrc {self.even_stack}', f'-OutMrc {self.tomo_even}', 
                      f'-VolZ {vol_z}', f'-OutBin {binning}', '-FlipVol 1', '-Wbp 1', 
-                     f'-AlnFile {self.tilt_alignment}', f'-Gpu {gpu_id}']
-        subprocess.run(' '.join(args_even), shell=True)
-        
+                     f'-AlnFile {self.tilt_alignment}']
         args_odd = [ARETOMO_CMD, f'-InMrc {self.odd_stack}', f'-OutMrc {self.tomo_odd}', 
                      f'-VolZ {vol_z}', f'-OutBin {binning}', '-FlipVol 1', '-Wbp 1', 
-                     f'-AlnFile {self.tilt_alignment}', f'-Gpu {gpu_id}']
-        subprocess.run(' '.join(args_odd), shell=True)
+                     f'-AlnFile {self.tilt_alignment}']
+        gpu_pool.map([(args_even, 'aretomo_even', self.series_name), (args_odd, 'aretomo_odd', self.series_name)])
         
+    def normalise_tomograms(self, slab_size=None, float16=False):
         # normalise tomograms after aretomo to std=1
-        normalise(self.tomo_full)
-        normalise(self.tomo_even)
-        normalise(self.tomo_odd)
+        def measured_normalise(mrc_path):
+            with stage_log.measure('normalise', self.series_name):
+                normalise(mrc_path, slab_size, float16)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(measured_normalise, [self.tomo_full, self.tomo_even, self.tomo_odd]))
+        
+    def reconstruction(self, full_path, even_path, odd_path, tilt_axis, 
+                       vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_ids, slab_size=None,
+                       float16=False):
+        self.tomogram_paths(full_path, even_path, odd_path)
+        gpu_pool = GpuPool(gpu_ids)
+        self.reconstruct_full(tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_pool)
+        self.reconstruct_even_odd(vol_z, binning, gpu_pool)
+        self.normalise_tomograms(slab_size, float16)
+
+
+class StageScheduler:
+    # runs the stage chain of every tilt series concurrently, each stage waits for the previous stage
+    # of its own series and for a free slot of its resource type (gpu, cpu or io)
+    def __init__(self, gpu_slots, cpu_slots, io_slots):
+        self.slots = {'gpu': threading.Semaphore(gpu_slots), 'cpu': threading.Semaphore(cpu_slots),
+                      'io': threading.Semaphore(io_slots)}
+        self.max_workers = gpu_slots + cpu_slots + io_slots
+
+    def run_chain(self, chain):
+        for resource, func, args in chain:
+            with self.slots[resource]:
+                # a stage returning False (failed) ends the chain of its tilt series
+                if func(*args) is False:
+                    return
+
+    def run(self, chains):
+        # each chain blocks a worker while waiting for a slot, so keep enough workers to fill all slots
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chains), self.max_workers))) as executor:
+            list(executor.map(self.run_chain, chains))
 
 
 class Project:
-    def __init__(self, project_path, pixel_size):
+    def __init__(self, project_path, pixel_size, use_cache=True, model_registry=None, retries=2, retry_backoff=30.,
+                 eer=None, float16_stacks=False, float16_tomograms=False, cleanup_intermediates=False,
+                 disk_budget_gb=None):
         self.project_main = project_path
         self.project_raw = project_path.joinpath('raw')
         self.pixel_size = pixel_size
@@ -242,39 +500,432 @@ class Project:
             print('no folder with raw data in project')
             sys.exit(0)
         # list mdoc files
-        self.mdocs = [x for x in self.project_raw.iterdir() if x.is_file() and x.suffix == '.mdoc']
-        self.tilt_series = [TiltSeries(x) for x in self.mdocs]
+        self.mdocs = sorted(x for x in self.project_raw.iterdir() if x.is_file() and x.suffix == '.mdoc')
+        self.eer = eer
+        self.float16_stacks = float16_stacks
+        self.float16_tomograms = float16_tomograms
+        # intermediates are deleted as soon as the stage that reads them finished
+        self.cleanup = cleanup_intermediates
+        self.disk_budget_gb = disk_budget_gb
+        self.tilt_series = [TiltSeries(x, eer) for x in self.mdocs]
         
         # other dirs
         self.project_stacks = project_path.joinpath('stacks')
+        self.project_qc = project_path.joinpath('qc')
         self.project_tomograms = project_path.joinpath('tomograms')
         self.tomos_full = self.project_tomograms.joinpath('full')
         self.tomos_even = self.project_tomograms.joinpath('even')
         self.tomos_odd = self.project_tomograms.joinpath('odd')
         self.tomos_denoised = self.project_tomograms.joinpath('denoised')
+        self.tomos_zarr = self.project_tomograms.joinpath('zarr')
         self.cryocare_folder = self.project_tomograms.joinpath('cryocare_training')
+        
+        # stages whose inputs and parameters did not change since the last run are skipped
+        self.manifest = StageManifest(project_path.joinpath('stage_manifest.json'), use_cache)
+        self.train_data_cache = TrainDataCache(self.cryocare_folder.joinpath('train_data'), self.manifest,
+                                               cryocare_train_data_config)
+        self.registry = None
+        if model_registry is not None:
+            self.registry = ModelRegistry(model_registry, cryocare_train_config, cryocare_train_data_config)
+        # failing tilt series are retried and then left out, instead of stopping the whole project
+        self.failures = FailureLog(project_path.joinpath('failed_series.json'))
+        self.retries = retries
+        self.retry_backoff = retry_backoff
     
-    def motioncor2(self, gain_file, gpu_id):
-        for ts in self.tilt_series:
-            print(f'motioncor2 for {ts.series_name}')
-            ts.motion_correction(gain_file, gpu_id)
+    def attempt(self, stage, ts, func, *args):
+        # runs one stage of one tilt series, retried with exponential backoff. a series that keeps failing
+        # is recorded in failed_series.json and skipped by its later stages and by cryocare
+        if ts.series_name in self.failures.failed_this_run:
+            return False
+        for attempt in range(self.retries + 1):
+            try:
+                func(*args)
+                self.failures.clear(ts.series_name, stage)
+                return True
+            except Exception as e:
+                error = str(e) if isinstance(e, StageError) else f'{type(e).__name__}: {e}'
+                # recorded under the pipeline stage that failed, when it says which one
+                failed_stage = e.stage if isinstance(e, StageError) and e.stage in PIPELINE_STAGES else stage
+                print(f'{stage} for {ts.series_name} failed (attempt {attempt + 1} of {self.retries + 1}): {error}')
+            if attempt < self.retries:
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        self.failures.record(ts.series_name, failed_stage, error, self.retries + 1)
+        print(f'{ts.series_name} is left out of the remaining stages')
+        return False
+    
+    def usable_series(self):
+        return [ts for ts in self.tilt_series if ts.series_name not in self.failures.entries]
+    
+    def motioncor2_key(self, ts, gain_file):
+        commands = ts.motioncor2_commands(gain_file)
+        key = stage_key(file_digest(ts.mdoc_path), [file_fingerprint(x) for x in ts.subframes],
+                        file_fingerprint(gain_file), commands, ts.eer)
+        ts.stage_keys['motioncor2'] = key
+        return commands, key
+    
+    def pending_motioncor2(self, ts, gain_file):
+        # returns the motioncor2 commands of a tilt series, or nothing if its frames are up to date
+        commands, key = self.motioncor2_key(ts, gain_file)
+        outputs = ts.corrected_frames + ts.corrected_frames_even + ts.corrected_frames_odd
+        if self.manifest.is_done(ts.series_name, 'motioncor2', key, outputs):
+            print(f'motioncor2 for {ts.series_name} is up to date')
+            return []
+        print(f'motioncor2 for {ts.series_name}')
+        return commands
+    
+    def series_motioncor2(self, ts, gain_file, gpu_pool):
+        commands = self.pending_motioncor2(ts, gain_file)
+        if len(commands) > 0:
+            ts.write_fraction_files()
+            gpu_pool.map([(x, 'motioncor2', ts.series_name) for x in commands])
+            missing = [x for x in ts.corrected_frames + ts.corrected_frames_even + ts.corrected_frames_odd
+                       if not x.exists()]
+            if len(missing) > 0:
+                raise StageError('motioncor2', ts.series_name, f'no output {missing[0]}')
+            self.manifest.record(ts.series_name, 'motioncor2', ts.stage_keys['motioncor2'])
+    
+    def motioncor2(self, gain_file, gpu_ids, tilt_series=None):
+        # subframes of all tilt series go into a single pool with one slot per gpu, one series per gpu
+        # feeds it so a failing series does not hold up the others
+        gpu_pool = GpuPool(gpu_ids)
+        with ThreadPoolExecutor(max_workers=len(gpu_ids)) as executor:
+            list(executor.map(lambda ts: self.attempt('motioncor2', ts, self.series_motioncor2, ts, gain_file,
+                                                      gpu_pool),
+                              self.tilt_series if tilt_series is None else tilt_series))
+    
+    def stacks_key(self, ts):
+        # float16 only enters the key when used, so the keys of earlier runs stay valid
+        return stage_key(ts.stage_keys['motioncor2'], self.pixel_size, *(['float16'] if self.float16_stacks else []))
+    
+    def series_stacks(self, ts, streaming=False):
+        key = self.stacks_key(ts)
+        ts.stage_keys['stacks'] = key
+        if self.manifest.is_done(ts.series_name, 'stacks', key, ts.stack_paths(self.project_stacks)):
+            print(f'stacks for {ts.series_name} are up to date')
+        else:
+            ts.to_stacks(self.project_stacks, self.pixel_size, streaming, self.float16_stacks)
+            self.manifest.record(ts.series_name, 'stacks', key)
+        self.remove_intermediates(ts, 'stacks')
             
-    def create_stacks(self):
+    def create_stacks(self, streaming=False, tilt_series=None):
         print('------------- creating stacks ----------------')
         self.project_stacks.mkdir(exist_ok=True)
-        for ts in self.tilt_series:
-            ts.to_stacks(self.project_stacks, self.pixel_size)
-            
-    def aretomo(self, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_id):
+        for ts in self.tilt_series if tilt_series is None else tilt_series:
+            self.attempt('stacks', ts, self.series_stacks, ts, streaming)
+    
+    def reconstruction_up_to_date(self, ts, recon_params):
+        key = stage_key(ts.stage_keys['stacks'], *recon_params, *(['float16'] if self.float16_tomograms else []))
+        ts.stage_keys['aretomo'] = key
+        outputs = ts.tomogram_paths(self.tomos_full, self.tomos_even, self.tomos_odd)
+        if self.manifest.is_done(ts.series_name, 'aretomo', key, outputs):
+            self.failures.clear(ts.series_name)
+            return True
+        return False
+    
+    def record_reconstruction(self, ts):
+        # a current reconstruction settles any failure recorded for the series before
+        self.manifest.record(ts.series_name, 'aretomo', ts.stage_keys['aretomo'])
+        self.failures.clear(ts.series_name)
+    
+    def series_reconstruct_full(self, ts, recon_params, gpu_pool):
+        if self.reconstruction_up_to_date(ts, recon_params):
+            print(f'reconstruction for {ts.series_name} is up to date')
+            return
+        ts.reconstruct_full(*recon_params, gpu_pool)
+    
+    def series_reconstruct_even_odd(self, ts, recon_params, gpu_pool):
+        if self.reconstruction_up_to_date(ts, recon_params):
+            return
+        _, vol_z, _, binning, _, _, _ = recon_params
+        ts.reconstruct_even_odd(vol_z, binning, gpu_pool)
+    
+    def series_normalise(self, ts, recon_params, slab_size=None):
+        if not self.reconstruction_up_to_date(ts, recon_params):
+            ts.normalise_tomograms(slab_size, self.float16_tomograms)
+            self.record_reconstruction(ts)
+        self.remove_intermediates(ts, 'aretomo')
+    
+    def remove_intermediates(self, ts, finished_stage):
+        # with cleanup, the motion corrected frames go once the stacks are made and the stacks once aretomo
+        # reconstructed them, nothing else reads them. the .rawtlt is kept with the alignment
+        if not self.cleanup:
+            return
+        if finished_stage == 'stacks':
+            paths = ts.corrected_frames + ts.corrected_frames_even + ts.corrected_frames_odd
+        else:
+            paths = [x for x in ts.stack_paths(self.project_stacks) if x.suffix == '.st']
+        for x in paths:
+            x.unlink(missing_ok=True)
+    
+    def make_tomogram_dirs(self):
         self.project_tomograms.mkdir(exist_ok=True)
         self.tomos_full.mkdir(exist_ok=True)
         self.tomos_odd.mkdir(exist_ok=True)
         self.tomos_even.mkdir(exist_ok=True)
+            
+    def restore_reconstructions(self):
+        # tomogram paths and stage keys of reconstructions made by another process, as recorded in the manifest
+        self.make_tomogram_dirs()
         for ts in self.tilt_series:
-            ts.reconstruction(self.tomos_full, self.tomos_even, self.tomos_odd, tilt_axis, 
-                              vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_id)
+            ts.tomogram_paths(self.tomos_full, self.tomos_even, self.tomos_odd)
+            ts.stage_keys['aretomo'] = self.manifest.entries.get(ts.series_name, {}).get('aretomo', '')
+    
+    def aretomo(self, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_ids,
+                slab_size=None, tilt_series=None):
+        self.make_tomogram_dirs()
+        recon_params = (tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod)
+        for ts in self.tilt_series if tilt_series is None else tilt_series:
+            self.attempt('aretomo', ts, self.series_reconstruction, ts, recon_params, gpu_ids, slab_size)
+    
+    def series_reconstruction(self, ts, recon_params, gpu_ids, slab_size=None):
+        if self.reconstruction_up_to_date(ts, recon_params):
+            print(f'reconstruction for {ts.series_name} is up to date')
+        else:
+            ts.reconstruction(self.tomos_full, self.tomos_even, self.tomos_odd, *recon_params, gpu_ids, slab_size,
+                              self.float16_tomograms)
+            self.record_reconstruction(ts)
+        self.remove_intermediates(ts, 'aretomo')
+    
+    def overlapped_stages(self, gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle,
+                          out_imod, gpu_ids, streaming=False, slab_size=None, cpu_slots=1, io_slots=1):
+        # motion correction, stacks and reconstruction as a chain per tilt series, so series N can be
+        # reconstructed while series N+1 is still being motion corrected
+        print('------------- running stages per tilt series ----------------')
+        gpu_pool = GpuPool(gpu_ids)
+        scheduler = StageScheduler(len(gpu_ids), cpu_slots, io_slots)
+        self.project_stacks.mkdir(exist_ok=True)
+        self.make_tomogram_dirs()
+        recon_params = (tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod)
+        scheduler.run([self.series_chain(ts, gain_file, recon_params, gpu_pool, streaming, slab_size)
+                       for ts in self.tilt_series if not self.series_up_to_date(ts, gain_file, recon_params)])
+    
+    def scratch_stages(self, scratch_dir, gain_file, recon_params, gpu_ids, streaming=False, slab_size=None):
+        # every tilt series is copied to node local scratch and all its stages run there. the final artifacts
+        # are copied back in the background while the next series is already being copied in
+        print(f'------------- running stages in scratch {scratch_dir} ----------------')
+        self.project_stacks.mkdir(exist_ok=True)
+        self.make_tomogram_dirs()
+        todo = [ts for ts in self.tilt_series if not self.series_up_to_date(ts, gain_file, recon_params)]
+        gpu_pool = GpuPool(gpu_ids)
+        scratch_root = pathlib.Path(tempfile.mkdtemp(prefix='tomo_prepper_', dir=scratch_dir))
+        prefetched = {}
+        try:
+            with ThreadPoolExecutor(max_workers=1) as stage_in, ThreadPoolExecutor(max_workers=1) as write_back:
+                def prefetch(i):
+                    if i < len(todo):
+                        prefetched[todo[i].series_name] = stage_in.submit(self.stage_in, todo[i], gain_file,
+                                                                          scratch_root)
+                prefetch(0)
+                for i, ts in enumerate(todo):
+                    prefetch(i + 1)
+                    # all stages of the series at once, a failure is recorded under the pipeline stage it names
+                    # (aretomo otherwise), so a later run in any mode clears it
+                    if self.attempt('aretomo', ts, self.scratch_series, ts, prefetched, gain_file, scratch_root,
+                                    recon_params, gpu_pool, streaming, slab_size):
+                        write_back.submit(self.write_back, ts, scratch_root.joinpath(ts.series_name))
+                    else:
+                        shutil.rmtree(scratch_root.joinpath(ts.series_name), ignore_errors=True)
+        finally:
+            shutil.rmtree(scratch_root, ignore_errors=True)
+    
+    def series_up_to_date(self, ts, gain_file, recon_params, verbose=True):
+        # the reconstruction is current, so the frames and stacks (which may have been cleaned up) are not needed.
+        # the stage keys are the same in scratch and in the project, so either way of running reuses the other
+        try:
+            self.motioncor2_key(ts, gain_file)
+        except StageError:
+            return False  # missing frames are reported by the stage that reads them
+        ts.stage_keys['stacks'] = self.stacks_key(ts)
+        if self.reconstruction_up_to_date(ts, recon_params):
+            if verbose:
+                print(f'reconstruction for {ts.series_name} is up to date')
+            return True
+        return False
+    
+    def series_disk_usage(self, ts, binning, vol_z, export_zarr=False):
+        # estimated bytes every stage writes for a tilt series, from the image size and number of tilts in the mdoc
+        ny, nx = mdoc_image_size(ts.mdoc_path) or (0, 0)
+        n_tilts = len(ts.tilt_angles)
+        tomogram = (vol_z // binning, ny // binning, nx // binning)
+        tomogram_bytes = 2 if self.float16_tomograms else 4
+        return {'motioncor2': 3 * n_tilts * mrc_size((ny, nx)),
+                'stacks': 3 * mrc_size((n_tilts, ny, nx), 2 if self.float16_stacks else 4),
+                'aretomo': 3 * mrc_size(tomogram, tomogram_bytes),
+                'cryocare': mrc_size(tomogram),
+                # uncompressed, the pyramid levels add at most 1/7
+                'zarr': (mrc_size(tomogram) + mrc_size(tomogram, tomogram_bytes)) * 8 // 7 if export_zarr else 0}
+    
+    def plan_disk(self, series, binning, vol_z, batch_size=None, frames_in_project=True, export_zarr=False,
+                  n_training=1):
+        # estimated disk use per stage, and the highest point when the series go through the stages in
+        # batches of batch_size (None: all at once), with intermediates removed when cleanup is on. cryocare
+        # extracts training data from n_training tomograms
+        usage = [self.series_disk_usage(ts, binning, vol_z, export_zarr) for ts in series]
+        if not frames_in_project:
+            for x in usage:
+                x['motioncor2'] = 0
+        step = max(1, len(usage) if batch_size is None else batch_size)
+        changes = []
+        for i in range(0, len(usage), step):
+            batch = usage[i:i + step]
+            changes += [x['motioncor2'] for x in batch]
+            for x in batch:
+                changes += [x['stacks'], -x['motioncor2'] if self.cleanup else 0]
+            for x in batch:
+                changes += [x['aretomo'], -x['stacks'] if self.cleanup else 0]
+        train_data = train_data_size(cryocare_train_data_config, n_training)
+        changes += [train_data] + [x['cryocare'] for x in usage] + [x['zarr'] for x in usage]
+        totals = {stage: sum(x[stage] for x in usage)
+                  for stage in ('motioncor2', 'stacks', 'aretomo', 'cryocare', 'zarr')}
+        totals['cryocare'] += train_data
+        return peak_disk_usage(changes), totals
+    
+    def check_disk_space(self, gain_file, recon_params, batch_size=None, frames_in_project=True, export_zarr=False,
+                         can_throttle=False, training_size=None):
+        # refuses a run that does not fit in the free space of the project filesystem (or --disk-budget-gb).
+        # with cleanup the batch path can be throttled instead: the series then go through all stages in
+        # groups, and the intermediates of a group are deleted before the next one starts. returns the group size
+        pending = [ts for ts in self.tilt_series if not self.series_up_to_date(ts, gain_file, recon_params, False)]
+        if len(pending) == 0:
+            return batch_size
+        _, vol_z, _, binning, _, _, _ = recon_params
+        available = shutil.disk_usage(self.project_main).free
+        if self.disk_budget_gb is not None:
+            available = min(available, int(self.disk_budget_gb * 1024 ** 3))
+        n_training = len(self.tilt_series) if training_size is None else min(training_size, len(self.tilt_series))
+        peak, totals = self.plan_disk(pending, binning, vol_z, batch_size, frames_in_project, export_zarr,
+                                      n_training)
+        print_disk_plan(totals, peak, available)
+        if peak <= available:
+            return batch_size
+        if can_throttle and self.cleanup:
+            for size in range(len(pending) - 1, 0, -1):
+                if self.plan_disk(pending, binning, vol_z, size, frames_in_project, export_zarr,
+                                  n_training)[0] <= available:
+                    print(f'running {size} tilt series at a time to stay within the available disk space')
+                    return size
+        print('not enough disk space for this run, free up space, add --cleanup-intermediates '
+              'or skip this check with --no-disk-check')
+        sys.exit(1)
+    
+    def stage_in(self, ts, gain_file, scratch_root):
+        # copies the mdoc, frames and gain of a tilt series to scratch, returns the tilt series as read from there
+        local_raw = scratch_root.joinpath(ts.series_name, 'raw')
+        local_raw.mkdir(parents=True, exist_ok=True)
+        with stage_log.measure('stage_in', ts.series_name):
+            for x in ts.input_frames():
+                if not x.exists():
+                    raise StageError('motioncor2', ts.series_name, f'{x.suffix[1:]} does not exist {x}')
+                copy_file(x, local_raw.joinpath(x.name))
+            copy_file(ts.mdoc_path, local_raw.joinpath(ts.mdoc_path.name))
+            local_gain = None
+            if gain_file is not None:
+                local_gain = scratch_root.joinpath(gain_file.name)
+                if not local_gain.exists():
+                    copy_file(gain_file, local_gain)
+        return TiltSeries(local_raw.joinpath(ts.mdoc_path.name), self.eer), local_gain
+    
+    def scratch_series(self, ts, prefetched, gain_file, scratch_root, recon_params, gpu_pool, streaming=False,
+                       slab_size=None):
+        future = prefetched.pop(ts.series_name, None)
+        local_ts, local_gain = future.result() if future is not None else self.stage_in(ts, gain_file, scratch_root)
+        local_dir = scratch_root.joinpath(ts.series_name)
+        local_ts.motion_correction(local_gain, gpu_pool)
+        missing = [x for x in local_ts.corrected_frames + local_ts.corrected_frames_even +
+                   local_ts.corrected_frames_odd if not x.exists()]
+        if len(missing) > 0:
+            raise StageError('motioncor2', ts.series_name, f'no output {missing[0]}')
+        local_dir.joinpath('stacks').mkdir(exist_ok=True)
+        local_ts.to_stacks(local_dir.joinpath('stacks'), self.pixel_size, streaming, self.float16_stacks)
+        tomogram_dirs = [local_dir.joinpath('tomograms', x) for x in ('full', 'even', 'odd')]
+        for x in tomogram_dirs:
+            x.mkdir(parents=True, exist_ok=True)
+        local_ts.tomogram_paths(*tomogram_dirs)
+        local_ts.reconstruct_full(*recon_params, gpu_pool)
+        _, vol_z, _, binning, _, _, _ = recon_params
+        local_ts.reconstruct_even_odd(vol_z, binning, gpu_pool)
+        local_ts.normalise_tomograms(slab_size, self.float16_tomograms)
+    
+    def write_back(self, ts, local_dir):
+        # stacks, alignment and tomograms (with whatever else aretomo wrote next to them) go back to the
+        # project, the motion corrected frames are removed with the rest of the scratch folder
+        try:
+            with stage_log.measure('write_back', ts.series_name):
+                for local, target in [(local_dir.joinpath('stacks'), self.project_stacks),
+                                      (local_dir.joinpath('tomograms', 'full'), self.tomos_full),
+                                      (local_dir.joinpath('tomograms', 'even'), self.tomos_even),
+                                      (local_dir.joinpath('tomograms', 'odd'), self.tomos_odd)]:
+                    for x in sorted(local.iterdir()):
+                        # with cleanup the stacks stay behind, aretomo has read them
+                        if x.is_file() and not (self.cleanup and x.suffix == '.st'):
+                            copy_file(x, target.joinpath(x.name))
+            self.manifest.record(ts.series_name, 'stacks', ts.stage_keys['stacks'])
+            self.record_reconstruction(ts)
+        except OSError as e:
+            print(f'copying {ts.series_name} back from scratch failed: {e}')
+            self.failures.record(ts.series_name, 'aretomo', f'write_back: {type(e).__name__}: {e}', 1)
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+    
+    def series_chain(self, ts, gain_file, recon_params, gpu_pool, streaming=False, slab_size=None):
+        return [('gpu', self.attempt, ('motioncor2', ts, self.series_motioncor2, ts, gain_file, gpu_pool)),
+                ('io', self.attempt, ('stacks', ts, self.series_stacks, ts, streaming)),
+                ('gpu', self.attempt, ('aretomo', ts, self.series_reconstruct_full, ts, recon_params, gpu_pool)),
+                ('gpu', self.attempt, ('aretomo', ts, self.series_reconstruct_even_odd, ts, recon_params, gpu_pool)),
+                ('cpu', self.attempt, ('aretomo', ts, self.series_normalise, ts, recon_params, slab_size))]
+    
+    def watch_raw(self, gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod,
+                  gpu_ids, streaming=False, slab_size=None, cpu_slots=1, io_slots=1, settle_time=60.,
+                  poll_interval=30., idle_timeout=None):
+        # live mode: each tilt series goes through the stage chain as soon as its acquisition is complete
+        print(f'------------- watching {self.project_raw} for new tilt series ----------------')
+        self.mdocs, self.tilt_series = [], []
+        gpu_pool = GpuPool(gpu_ids)
+        scheduler = StageScheduler(len(gpu_ids), cpu_slots, io_slots)
+        self.project_stacks.mkdir(exist_ok=True)
+        self.make_tomogram_dirs()
+        recon_params = (tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod)
+        watcher = RawWatcher(self.project_raw, lambda x: TiltSeries(x, self.eer).input_frames(), settle_time)
+        
+        futures = {}
+        try:
+            with ThreadPoolExecutor(max_workers=scheduler.max_workers) as executor:
+                def process(mdoc):
+                    ts = TiltSeries(mdoc, self.eer)
+                    self.mdocs.append(mdoc)
+                    self.tilt_series.append(ts)
+                    futures[ts.series_name] = executor.submit(
+                        scheduler.run_chain,
+                        self.series_chain(ts, gain_file, recon_params, gpu_pool, streaming, slab_size))
+                watch(watcher, process, poll_interval, idle_timeout)
+        finally:
+            # also when watching stopped with an error, the series handed over so far are reported
+            record_watch_failures(futures, self.failures, 'aretomo')
+            
+    def predict(self, predict_file, memory_budget_gb=None):
+        if memory_budget_gb is None:
+            stage_log.run(f'cryoCARE_predict.py --conf {predict_file}', 'cryocare_predict', check=True)
+            return
+        # plan n_tiles from the volume shapes, tomograms that need a different tiling are predicted in
+        # separate runs from folders with symlinks
+        even_dir, odd_dir = pathlib.Path(cryocare_predict_config['even']), pathlib.Path(cryocare_predict_config['odd'])
+        groups = plan_prediction_groups(even_dir, memory_budget_gb * 1024 ** 3, cryocare_train_config)
+        for i, (n_tiles, names) in enumerate(groups.items()):
+            config = dict(cryocare_predict_config, n_tiles=list(n_tiles))
+            if len(groups) > 1:
+                group_dir = self.project_tomograms.joinpath('predict_groups', f'group_{i}')
+                link_tomograms(names, even_dir, group_dir.joinpath('even'))
+                link_tomograms(names, odd_dir, group_dir.joinpath('odd'))
+                config['even'] = str(group_dir.joinpath('even'))
+                config['odd'] = str(group_dir.joinpath('odd'))
+                predict_file = self.project_main.joinpath(f'predict_config_group_{i}.json')
+            print(f'cryocare prediction with n_tiles {list(n_tiles)} for {len(names)} tomograms')
+            with open(predict_file, 'w') as js_file:
+                js_file.write(json.dumps(config, indent=2))
+            stage_log.run(f'cryoCARE_predict.py --conf {predict_file}', 'cryocare_predict', check=True)
             
-    def cryocare(self, training_subset_size, cryocare_model_name, gpu_id):
+    def cryocare(self, training_subset_size, cryocare_model_name, gpu_id, training_selection='random',
+                 coverage_radius=1., predict_memory_gb=None, acquisition=None, reuse_model='never'):
         self.cryocare_folder.mkdir(exist_ok=True)
         self.tomos_denoised.mkdir(exist_ok=True)
         
@@ -290,16 +941,39 @@ class Project:
         train_file = self.project_main.joinpath('train_config.json')
         predict_file = self.project_main.joinpath('predict_config.json')
         
+        # tilt series that failed are neither trained nor predicted on
+        series = self.usable_series()
+        if len(series) == 0:
+            print('no reconstructed tilt series for cryocare')
+            return
+        if training_subset_size > len(series):
+            print(f'only {len(series)} reconstructed tilt series, training on all of them')
+            training_subset_size = len(series)
+        even_dir, odd_dir = self.tomos_even, self.tomos_odd
+        if len(series) < len(self.tilt_series):
+            even_dir = self.project_tomograms.joinpath('predict_usable', 'even')
+            odd_dir = self.project_tomograms.joinpath('predict_usable', 'odd')
+            link_tomograms([ts.tomo_even.name for ts in series], self.tomos_even, even_dir)
+            link_tomograms([ts.tomo_odd.name for ts in series], self.tomos_odd, odd_dir)
+        
         # select subset size indices
-        subset = np.random.choice(len(self.tilt_series), training_subset_size, replace=False)
-        cryocare_train_data_config['path'] = str(self.cryocare_folder)
-        cryocare_train_data_config['even'] = [str(self.tilt_series[i].tomo_even) for i in subset]
-        cryocare_train_data_config['odd'] = [str(self.tilt_series[i].tomo_odd) for i in subset]
+        tomograms = [(ts.series_name, ts.tomo_even, ts.tomo_odd, ts.stage_keys.get('aretomo', '')) for ts in series]
+        if training_selection == 'coverage':
+            subset = select_training_subset([(ts.tomo_even, ts.tomo_odd) for ts in series],
+                                            training_subset_size, coverage_radius,
+                                            [ts.series_name for ts in series])
+        else:
+            subset = self.train_data_cache.draw(tomograms, training_subset_size)
+        subset = sorted(subset)
+        train_data, selection = self.train_data_cache.folder([tomograms[i] for i in subset])
+        cryocare_train_data_config['path'] = str(train_data)
+        cryocare_train_data_config['even'] = [str(series[i].tomo_even) for i in subset]
+        cryocare_train_data_config['odd'] = [str(series[i].tomo_odd) for i in subset]
         with open(train_data_file, 'w') as js_file:
             js_file.write(json.dumps(cryocare_train_data_config, indent=2))
             
         # create training json
-        cryocare_train_config['train_data'] = str(self.cryocare_folder)
+        cryocare_train_config['train_data'] = str(train_data)
         cryocare_train_config['path'] = str(self.cryocare_folder)
         cryocare_train_config['model_name'] = cryocare_model_name
         cryocare_train_config['gpu_id'] = gpu_id
@@ -308,32 +982,219 @@ class Project:
         
         # create predict config
         cryocare_predict_config['path'] = str(self.cryocare_folder.joinpath(cryocare_model_name + '.tar.gz'))
-        cryocare_predict_config['even'] = str(self.tomos_even)
-        cryocare_predict_config['odd'] = str(self.tomos_odd)
+        cryocare_predict_config['even'] = str(even_dir)
+        cryocare_predict_config['odd'] = str(odd_dir)
         cryocare_predict_config['output'] = str(self.tomos_denoised)
         cryocare_predict_config['gpu_id'] = gpu_id
         with open(predict_file, 'w') as js_file:
             js_file.write(json.dumps(cryocare_predict_config, indent=2))
             
-        # run cryocare
-        subprocess.run(f'cryoCARE_extract_train_data.py --conf {train_data_file}', shell=True)
-        subprocess.run(f'cryoCARE_train.py --conf {train_file}', shell=True)
-        subprocess.run(f'cryoCARE_predict.py --conf {predict_file}', shell=True)
+        # the model only depends on the set of reconstructions and the training parameters, so it is
+        # reused as long as those did not change. where the training data was extracted to does not count
+        tomo_keys = sorted(ts.stage_keys['aretomo'] for ts in series)
+        train_key = stage_key(tomo_keys, training_subset_size, training_selection, coverage_radius,
+                              {k: v for k, v in cryocare_train_data_config.items() if k not in ('even', 'odd', 'path')},
+                              {k: v for k, v in cryocare_train_config.items() if k not in ('gpu_id', 'train_data')})
+        predict_key = stage_key(train_key, cryocare_predict_config['n_tiles'], predict_memory_gb)
+        model = self.cryocare_folder.joinpath(cryocare_model_name + '.tar.gz')
+        denoised = [self.tomos_denoised.joinpath(ts.series_name + '.mrc') for ts in series]
+            
+        # run cryocare, a compatible model from the registry replaces training
+        registered = None
+        if self.registry is not None and reuse_model != 'never':
+            registered = self.registry.find(acquisition)
+        if registered is not None:
+            print(f'reusing registered cryocare model {registered}')
+            cryocare_predict_config['path'] = str(registered)
+            with open(predict_file, 'w') as js_file:
+                js_file.write(json.dumps(cryocare_predict_config, indent=2))
+            predict_key = stage_key(file_digest(registered), cryocare_predict_config['n_tiles'], predict_memory_gb)
+        elif self.manifest.is_done('_project', 'cryocare_train', train_key, [model]):
+            print('cryocare model is up to date')
+        else:
+            self.train_data_cache.extract(train_data, selection, train_data_file)
+            stage_log.run(f'cryoCARE_train.py --conf {train_file}', 'cryocare_train', check=True)
+            self.manifest.record('_project', 'cryocare_train', train_key)
+            if self.registry is not None and model.exists():
+                self.registry.register(model, cryocare_model_name, acquisition)
+        if self.manifest.is_done('_project', 'cryocare_predict', predict_key, denoised):
+            print('denoised tomograms are up to date')
+        else:
+            self.predict(predict_file, predict_memory_gb)
+            self.manifest.record('_project', 'cryocare_predict', predict_key)
         
             
-    def run(self, gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, 
-            out_imod, training_subset_size, cryocare_model_name, gpu_id):
-        # run motioncor2
-        self.motioncor2(gain_file, gpu_id)
+    def qc_previews(self, binning=4, n_workers=4):
+        # binned previews and thumbnails of the full, even and denoised tomograms with an html index, to pick the
+        # series worth keeping without opening every tomogram. binning and png encoding are cpu bound, so the
+        # tomograms are spread over worker processes
+        jobs = []
+        for ts in self.usable_series():
+            full, even, _ = ts.tomogram_paths(self.tomos_full, self.tomos_even, self.tomos_odd)
+            denoised = self.tomos_denoised.joinpath(ts.series_name + '.mrc')
+            for kind, source in (('full', full), ('even', even), ('denoised', denoised)):
+                target = self.project_qc.joinpath(ts.series_name, kind + '.mrc')
+                key = stage_key(file_fingerprint(source), binning)
+                if source.exists() and not self.manifest.is_done(ts.series_name, f'qc_{kind}', key, [target]):
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    jobs.append((ts.series_name, kind, key, source, target))
+        if len(jobs) > 0:
+            print(f'------------- making {len(jobs)} previews ----------------')
+            with stage_log.measure('qc_previews'), ProcessPoolExecutor(max_workers=max(1, n_workers)) as executor:
+                futures = [executor.submit(make_preview, source, target, binning) for *_, source, target in jobs]
+                for (series_name, kind, key, source, _), future in zip(jobs, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'preview of {source} failed: {e}')
+                        continue
+                    self.manifest.record(series_name, f'qc_{kind}', key)
+        if self.project_qc.exists():
+            write_qc_index(self.project_qc, [ts.series_name for ts in self.usable_series()])
+    
+    def export_zarr(self, n_workers=4, n_levels=4, chunk_size=64):
+        # chunked OME-Zarr copies of the denoised and full tomograms, for viewers and pickers that only need
+        # a slice or a binned overview
+        exports = []
+        for ts in self.usable_series():
+            full = ts.tomogram_paths(self.tomos_full, self.tomos_even, self.tomos_odd)[0]
+            denoised = self.tomos_denoised.joinpath(ts.series_name + '.mrc')
+            for kind, source in (('denoised', denoised), ('full', full)):
+                if source.exists():
+                    exports.append((ts.series_name, kind, source,
+                                    self.tomos_zarr.joinpath(kind, ts.series_name + '.zarr')))
         
-        # combine to stacks
-        self.create_stacks()        
+        def export(series_name, kind, source, target):
+            key = stage_key(file_fingerprint(source), n_levels, chunk_size)
+            if self.manifest.is_done(series_name, f'zarr_{kind}', key, [target]):
+                print(f'{kind} zarr for {series_name} is up to date')
+                return
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with stage_log.measure('zarr', series_name):
+                    write_ome_zarr(source, target, n_levels, chunk_size)
+            except Exception as e:
+                # the mrc is still there, so a failed export does not fail the tilt series
+                print(f'zarr export of {source} failed: {e}')
+                return
+            self.manifest.record(series_name, f'zarr_{kind}', key)
         
-        # run aretomo
-        self.aretomo(tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_id)        
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+            list(executor.map(lambda x: export(*x), exports))
+    
+    def select_series(self, mdoc_names):
+        # only these tilt series, in this order (a slurm job works on the list it was submitted with)
+        self.mdocs = [self.project_raw.joinpath(x) for x in mdoc_names]
+        self.tilt_series = [TiltSeries(x, self.eer) for x in self.mdocs]
+    
+    def series_sizes(self):
+        # (number of tilts, ny, nx) per tilt series, from the mdocs
+        return {ts.series_name: (len(ts.tilt_angles), *(mdoc_image_size(ts.mdoc_path) or (0, 0)))
+                for ts in self.tilt_series}
+
+    def plan(self, history, binning, vol_z, gpu_ids):
+        # predicts wall time and peak memory of every stage from the run history, and recommends how many gpus
+        # and parallel cpu/io stages to use
+        rows = history.stage_runs()
+        if len(rows) == 0:
+            print(f'no earlier runs in {history.path} to plan from')
+            return
+        sizes = self.series_sizes()
+        work = work_sizes(sizes.values(), binning, vol_z)
+        print(f'------------- plan from {len(rows)} earlier stage runs ----------------')
+        print(f'{len(sizes)} tilt series, {sum(x[0] for x in sizes.values())} tilts, binning {binning}, vol-z {vol_z}')
+        stages = plan_stages(rows, work, STAGE_WORK)
+        n_gpus = print_plan(stages, len(gpu_ids), GPU_STAGES)
+        options = [f'--gpu-id {" ".join(str(x) for x in gpu_ids[:n_gpus])}']
+        for stage, option in (('normalise', '--cpu-slots'), ('stacks', '--io-slots'), ('qc_previews', '--qc-workers'),
+                              ('zarr', '--zarr-workers')):
+            if stage in stages:
+                options.append(f'{option} {recommend_workers(stages[stage][2])}')
+        print('recommended: ' + ' '.join(options))
+
+    def run(self, gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, 
+            out_imod, training_subset_size, cryocare_model_name, gpu_ids, streaming_stacks=False,
+            normalise_slab_size=None, overlap_stages=False, cpu_slots=1, io_slots=1, watch_raw=False,
+            settle_time=60., poll_interval=30., idle_timeout=None, training_selection='random',
+            coverage_radius=1., predict_memory_gb=None, reuse_model='never', sample_type=None,
+            series_index=None, cryocare_only=False, scratch_dir=None, export_zarr=False, zarr_workers=4,
+            disk_check=True, qc_previews=False, qc_binning=4, qc_workers=4):
+        # sizes and parameters that go into the run history with every stage
+        stage_log.describe(self.series_sizes(), project=str(self.project_main), binning=binning, vol_z=vol_z,
+                           parameters={k: v for k, v in locals().items() if k != 'self'})
+        recon_params = (tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod)
+        batch_size = None
+        if disk_check and series_index is None and not cryocare_only and not watch_raw:
+            # slurm array tasks were checked when they were submitted, watched series are not known yet
+            if scratch_dir is not None:
+                batch_size = self.check_disk_space(gain_file, recon_params, 1, False, export_zarr,
+                                                   training_size=training_subset_size)
+            elif overlap_stages:
+                batch_size = self.check_disk_space(gain_file, recon_params, len(gpu_ids), True, export_zarr,
+                                                   training_size=training_subset_size)
+            else:
+                batch_size = self.check_disk_space(gain_file, recon_params, None, True, export_zarr, True,
+                                                   training_size=training_subset_size)
+        if series_index is not None:
+            # slurm array task: only this tilt series, cryocare runs in a separate job
+            self.tilt_series = [self.tilt_series[series_index]]
+        if cryocare_only:
+            # slurm cryocare job: the reconstructions were made by the array tasks
+            self.restore_reconstructions()
+        elif watch_raw:
+            # process tilt series while they are being acquired
+            self.watch_raw(gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod,
+                           gpu_ids, streaming_stacks, normalise_slab_size, cpu_slots, io_slots, settle_time,
+                           poll_interval, idle_timeout)
+        elif scratch_dir is not None:
+            # motioncor2, stacks and aretomo per tilt series in node local scratch
+            self.scratch_stages(scratch_dir, gain_file, recon_params, gpu_ids, streaming_stacks, normalise_slab_size)
+        elif overlap_stages:
+            # motioncor2, stacks and aretomo per tilt series through the scheduler
+            self.overlapped_stages(gain_file, tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle,
+                                   out_imod, gpu_ids, streaming_stacks, normalise_slab_size, cpu_slots, io_slots)
+        else:
+            # series whose reconstruction is current need neither frames nor stacks (which may have been cleaned
+            # up), the others go through the stages all at once or, when throttled for disk space, in batches
+            todo = [ts for ts in self.tilt_series if not self.series_up_to_date(ts, gain_file, recon_params)]
+            step = max(1, len(todo) if batch_size is None else batch_size)
+            for i in range(0, len(todo), step):
+                batch = todo[i:i + step]
+                
+                # run motioncor2
+                self.motioncor2(gain_file, gpu_ids, batch)
+                
+                # combine to stacks
+                self.create_stacks(streaming_stacks, batch)        
+                
+                # run aretomo
+                self.aretomo(tilt_axis, vol_z, align_z, binning, tiltcor, tiltcor_angle, out_imod, gpu_ids,
+                             normalise_slab_size, batch)        
         
-        # run cryocare
-        self.cryocare(training_subset_size, cryocare_model_name, gpu_id)
+        if series_index is None:
+            # previews of the reconstructions, to look at while cryocare runs
+            if qc_previews:
+                self.qc_previews(qc_binning, qc_workers)
+            
+            # run cryocare
+            voltages = [mdoc_value(x, 'Voltage') for x in self.mdocs]
+            acquisition = {'pixel_size': self.pixel_size, 'kV': voltages[0] if len(voltages) > 0 else None,
+                           'binning': binning, 'vol_z': vol_z, 'sample_type': sample_type}
+            try:
+                self.cryocare(training_subset_size, cryocare_model_name, gpu_ids[0], training_selection,
+                              coverage_radius, predict_memory_gb, acquisition, reuse_model)
+            except StageError as e:
+                print(e)
+            
+            # and of the denoised tomograms
+            if qc_previews:
+                self.qc_previews(qc_binning, qc_workers)
+            
+            if export_zarr:
+                self.export_zarr(zarr_workers)
+        
+        self.failures.report()
+        stage_log.summary()
 
 
 if __name__ == '__main__':
@@ -368,9 +1229,135 @@ if __name__ == '__main__':
                         help='number of tomograms to pass to cryocare for training')
     parser.add_argument('--cryocare-model-name', type=str, required=True,
                         help='give a name to your cryocare model, for example arctica_er_microsomes or krios_lamellae_yeast')
-    parser.add_argument('--gpu-id', type=int, required=False, default=0,
-                        help='specify the gpu index to run on')
+    parser.add_argument('--gpu-id', type=int, required=False, default=[0], nargs='+',
+                        help='specify the gpu index to run on, you can specify more than one with a space in between. '
+                        'MotionCor2 will spread the frames over all gpus and aretomo runs the even and odd '
+                        'reconstructions on separate gpus, cryocare uses the first one')
+    parser.add_argument('--streaming-stacks', action='store_true',
+                        help='write the full/even/odd stacks in one pass through memory maps, '
+                        'peak memory is about one tilt instead of the whole stack')
+    parser.add_argument('--normalise-slab-size', type=int, required=False,
+                        help='normalise tomograms out-of-core in slabs of this many z-slices, '
+                        'by default the full volume is loaded into memory')
+    parser.add_argument('--no-stage-cache', action='store_true',
+                        help='rerun every stage, even when its inputs and parameters did not change since the last run')
+    parser.add_argument('--overlap-stages', action='store_true',
+                        help='run motioncor2, stacks and aretomo as a chain per tilt series, so reconstructions '
+                        'start while other series are still being motion corrected')
+    parser.add_argument('--cpu-slots', type=int, required=False, default=2,
+                        help='with --overlap-stages, number of cpu stages (normalisation) that run at the same time')
+    parser.add_argument('--io-slots', type=int, required=False, default=1,
+                        help='with --overlap-stages, number of io stages (stack creation) that run at the same time')
+    parser.add_argument('--watch', action='store_true',
+                        help='live mode: watch the raw folder and process every tilt series as soon as its '
+                        'acquisition is complete, cryocare runs after watching stops (ctrl+c or --idle-timeout)')
+    parser.add_argument('--settle-time', type=float, required=False, default=60.,
+                        help='with --watch, seconds the mdoc and all its frames must be unchanged to count as complete')
+    parser.add_argument('--poll-interval', type=float, required=False, default=30.,
+                        help='with --watch, seconds between checks of the raw folder')
+    parser.add_argument('--idle-timeout', type=float, required=False,
+                        help='with --watch, stop watching when no new tilt series arrived for this many seconds')
+    parser.add_argument('--stage-log', type=str, required=False,
+                        help='json lines file with timing and resource use of every stage '
+                        '(default: stage_log.jsonl in the project directory)')
+    parser.add_argument('--training-selection', type=str, required=False, default='random',
+                        choices=['random', 'coverage'],
+                        help='random: draw --training-size tomograms at random. coverage: compute even/odd correlation, '
+                        'contrast and thickness on binned tomograms and pick the smallest set (at most --training-size) '
+                        'that covers the range of the dataset')
+    parser.add_argument('--coverage-radius', type=float, required=False, default=1.,
+                        help='with --training-selection coverage, every tomogram must be within this many standard '
+                        'deviations (of the statistics) of a training tomogram')
+    parser.add_argument('--predict-memory-gb', type=float, required=False,
+                        help='gpu memory budget for cryocare prediction, n_tiles is then planned from the tomogram '
+                        f'shapes and the u-net size instead of the fixed {cryocare_predict_config["n_tiles"]}')
+    parser.add_argument('--model-registry', type=str, required=False,
+                        help='folder with previously trained cryocare models, newly trained models are added to it')
+    parser.add_argument('--reuse-model', type=str, required=False, default='never',
+                        choices=['never', 'predict'],
+                        help='with --model-registry, predict with a registered model trained on the same pixel size, '
+                        'kV, binning, vol-z and sample type instead of training a new one (default: never)')
+    parser.add_argument('--sample-type', type=str, required=False,
+                        help='free text sample type stored with the model in the registry, '
+                        'only models with the same sample type are reused')
+    parser.add_argument('--eer-input', type=str, required=False, default='tif', choices=['tif', 'native'],
+                        help='tif: use .tif files with the same name that were converted from the .eer movies '
+                        'beforehand (default). native: give .eer movies to MotionCor2 directly (-InEer)')
+    parser.add_argument('--eer-sampling', type=int, required=False, default=1, choices=[1, 2, 3],
+                        help='MotionCor2 -EerSampling (1: 4k, 2: 8k, 3: 16k), the output is binned back to the '
+                        'physical pixel size')
+    parser.add_argument('--eer-fraction-dose', type=float, required=False, default=0.3,
+                        help='target dose per fraction in e/A2, eer frames are grouped to it using the ExposureDose '
+                        'of every tilt in the mdoc')
+    parser.add_argument('--eer-total-dose', type=float, required=False,
+                        help='dose per tilt in e/A2 to group the eer frames with, for tilts whose ExposureDose in the '
+                        'mdoc is missing or 0 (dose not calibrated)')
+    parser.add_argument('--float16-stacks', action='store_true',
+                        help='write the full/even/odd stacks as mrc mode 12 (float16), half the size on disk. '
+                        'check that your aretomo version reads mode 12')
+    parser.add_argument('--float16-tomograms', action='store_true',
+                        help='write the normalised full/even/odd tomograms as mrc mode 12 (float16), half the size '
+                        'on disk and half the reading time for cryocare')
+    parser.add_argument('--export-zarr', action='store_true',
+                        help='after cryocare, write the denoised and full tomograms as chunked OME-Zarr with a '
+                        '1x/2x/4x/8x pyramid to tomograms/zarr (needs zarr<3)')
+    parser.add_argument('--zarr-workers', type=int, required=False, default=4,
+                        help='number of tomograms converted to OME-Zarr at the same time')
+    parser.add_argument('--cleanup-intermediates', action='store_true',
+                        help='delete the motion corrected frames once the stacks are made, and the stacks once '
+                        'aretomo reconstructed them')
+    parser.add_argument('--disk-budget-gb', type=float, required=False,
+                        help='disk space the run may use (e.g. what is left of the project quota), by default the '
+                        'free space of the project filesystem. runs that do not fit are refused, or with '
+                        '--cleanup-intermediates run in smaller batches')
+    parser.add_argument('--no-disk-check', action='store_true',
+                        help='start the run without estimating its disk use first')
+    parser.add_argument('--qc-previews', action='store_true',
+                        help='write binned previews and png thumbnails (central xy/xz slices and projections) of the '
+                        'full, even and denoised tomograms to qc/, with an overview page qc/index.html')
+    parser.add_argument('--qc-binning', type=int, required=False, default=4, choices=[4, 8],
+                        help='binning of the previews, on top of the tomogram binning')
+    parser.add_argument('--qc-workers', type=int, required=False, default=4,
+                        help='number of processes making previews')
+    parser.add_argument('--scratch-dir', type=str, required=False,
+                        help='node local folder (for example $TMPDIR on a cluster node) to copy each tilt series to '
+                        'and run all its stages in. stacks, alignments and tomograms are copied back to the project '
+                        'in the background while the next tilt series is copied in')
+    parser.add_argument('--retries', type=int, required=False, default=2,
+                        help='number of times a failed stage of a tilt series is retried before the series is '
+                        'left out of the remaining stages and of cryocare')
+    parser.add_argument('--retry-backoff', type=float, required=False, default=30.,
+                        help='seconds before the first retry, doubled for every next retry')
+    parser.add_argument('--backend', type=str, required=False, default='local', choices=['local', 'slurm'],
+                        help='local: run everything in this process. slurm: submit a job array with one task per '
+                        'tilt series (motioncor2, stacks, aretomo) and a cryocare job that starts when all tasks '
+                        'succeeded. --gpu-id then refers to the gpus slurm gives each job')
+    parser.add_argument('--sbatch-options', type=str, required=False, default='',
+                        help='with --backend slurm, extra sbatch options for both jobs, '
+                        'for example "--partition=gpu --gres=gpu:1 --time=04:00:00"')
+    parser.add_argument('--slurm-wait', action='store_true',
+                        help='with --backend slurm, wait (polling squeue) until the jobs finished')
+    parser.add_argument('--history', type=str, required=False,
+                        help='sqlite file in which every stage run is recorded with its input sizes, parameters and '
+                        f'duration, can be shared between projects (default: {default_history_path()})')
+    parser.add_argument('--no-history', action='store_true',
+                        help='do not record this run in the run history')
+    parser.add_argument('--plan', action='store_true',
+                        help='only read the mdocs of the project and predict the wall time and peak memory of every '
+                        'stage from the run history, with a recommended number of gpus and parallel workers')
+    parser.add_argument('--series-index', type=int, required=False, help=argparse.SUPPRESS)
+    parser.add_argument('--cryocare-only', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--series-list', type=str, required=False, help=argparse.SUPPRESS)
     args = parser.parse_args()
+    if args.backend == 'slurm' and args.watch:
+        parser.error('--backend slurm can not be combined with --watch')
+    if args.scratch_dir is not None and args.watch:
+        parser.error('--scratch-dir can not be combined with --watch')
+    if args.export_zarr:
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            parser.error('--export-zarr needs the zarr package (pip install "zarr<3")')
     
     project_path = pathlib.Path(args.project_dir)
     if not project_path.is_dir():
@@ -385,8 +1372,44 @@ if __name__ == '__main__':
     else:
         gain_file = None
     
-    project = Project(project_path, args.pixel_size)
+    history = None
+    if args.plan or not args.no_history:
+        history = RunHistory(pathlib.Path(args.history).expanduser() if args.history is not None
+                             else default_history_path(), pathlib.Path(__file__).stem)
+    stage_log.open(pathlib.Path(args.stage_log) if args.stage_log is not None
+                   else project_path.joinpath('stage_log.jsonl'))
+    if not args.plan:
+        stage_log.history = history
+    project = Project(project_path, args.pixel_size, not args.no_stage_cache,
+                      pathlib.Path(args.model_registry).expanduser() if args.model_registry is not None else None,
+                      args.retries, args.retry_backoff,
+                      (args.eer_sampling, args.eer_fraction_dose, args.eer_total_dose)
+                      if args.eer_input == 'native' else None,
+                      args.float16_stacks, args.float16_tomograms, args.cleanup_intermediates, args.disk_budget_gb)
+    if args.series_list is not None:
+        # slurm job: the tilt series of the submission, not whatever raw/ holds by now
+        project.select_series(read_series_list(pathlib.Path(args.series_list)))
+    if args.plan:
+        project.plan(history, args.tomogram_binning, args.aretomo_vol_z, args.gpu_id)
+        sys.exit(0)
+    if args.backend == 'slurm':
+        if not args.no_disk_check:
+            # the array tasks run at the same time, so the whole project has to fit
+            project.check_disk_space(gain_file, (args.tilt_axis, args.aretomo_vol_z, args.aretomo_align_z,
+                                                 args.tomogram_binning, args.aretomo_tiltcor,
+                                                 args.aretomo_tiltcor_angle, args.aretomo_outimod),
+                                     None, True, args.export_zarr, training_size=args.training_size)
+        submit_to_slurm(__file__, project_path, project.mdocs, len(project.tilt_series), args.sbatch_options,
+                        args.slurm_wait, args.poll_interval)
+        sys.exit(0)
     project.run(gain_file, args.tilt_axis, args.aretomo_vol_z, args.aretomo_align_z,
                 args.tomogram_binning, args.aretomo_tiltcor, args.aretomo_tiltcor_angle,
-                args.aretomo_outimod, args.training_size, args.cryocare_model_name, args.gpu_id)
+                args.aretomo_outimod, args.training_size, args.cryocare_model_name, args.gpu_id,
+                args.streaming_stacks, args.normalise_slab_size, args.overlap_stages, args.cpu_slots,
+                args.io_slots, args.watch, args.settle_time, args.poll_interval, args.idle_timeout,
+                args.training_selection, args.coverage_radius, args.predict_memory_gb,
+                args.reuse_model, args.sample_type, args.series_index, args.cryocare_only,
+                pathlib.Path(args.scratch_dir).expanduser() if args.scratch_dir is not None else None,
+                args.export_zarr, args.zarr_workers, not args.no_disk_check, args.qc_previews, args.qc_binning,
+                args.qc_workers)
 	
@@ -76,7 +76,20 @@ import argparse
 import pathlib
 import sys
 import json
+import csv
+import re
+import shutil
+import time
+import mrcfile
 import numpy as np
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from prepper_common import (mdoc_image_size, make_preview, write_qc_index, select_training_subset, write_ome_zarr,
+                            file_fingerprint, file_digest, stage_key, file_lock, StageManifest, FailureLog,
+                            TrainDataCache, StageError, stage_log, default_history_path, work_sizes, RunHistory,
+                            plan_stages, recommend_workers, print_plan, mrc_size, train_data_size, peak_disk_usage,
+                            print_disk_plan, plan_prediction_groups, link_tomograms, ModelRegistry, RawWatcher, watch,
+                            record_watch_failures, submit_to_slurm, read_series_list)
 
 ARETOMO_CMD = 'aretomo3'
 
@@ -111,6 +124,27 @@ cryocare_train_config = {
   "gpu_id": None
 }
 
+
+# what the run time and memory of a stage grow with, for the planner: the frames of its tilt series ('pixels'),
+# the reconstructed volume ('voxels') or that times the tilts it is made from ('projections'). stages that are
+# not listed take about the same time for every project (cryocare training)
+STAGE_WORK = {'aretomo3': 'pixels', 'cryocare_predict': 'voxels', 'qc_previews': 'voxels', 'zarr': 'voxels'}
+# stages the planner spreads over the gpus: aretomo3 shards and the cryocare prediction shards
+GPU_STAGES = ['aretomo3', 'cryocare_predict']
+
+# tilt series quality thresholds: option -> (metric, True when the threshold is an upper limit). the metrics
+# are the columns of TiltSeries_Metric.csv, CTF_Res(A) and CTF_Score fall back to the _CTF.txt of the tilt
+# series, and Align_Residual comes from its _Log
+QUALITY_THRESHOLDS = {
+    'max_align_residual': ('Align_Residual', True),
+    'max_global_shift': ('Global_Shift(Pix)', True),
+    'max_bad_patches': ('Bad_Patch_All', True),
+    'min_thickness': ('Thickness(Pix)', False),
+    'max_thickness': ('Thickness(Pix)', True),
+    'max_ctf_resolution': ('CTF_Res(A)', True),
+    'min_ctf_score': ('CTF_Score', False),
+}
+
 cryocare_predict_config = {
   "path": None,
   "even": None,
@@ -122,8 +156,130 @@ cryocare_predict_config = {
 }
 
 
+def parse_mdoc_subframes(mdoc_file):
+    subframe_list = []
+    with open(mdoc_file, 'r') as infile:
+        for x in infile.readlines():
+            line = x.strip()
+            if line.startswith('SubFramePath'):
+                # make pure windows path to find tif or eer file name
+                subframe_list.append(pathlib.PureWindowsPath(line.split('=')[1].strip()).name)
+    return subframe_list
+
+
+def plan_prediction_shards(tomogram_dir, n_shards):
+    # split the tomograms into at most n_shards lists of about the same total volume (voxels from the mrc
+    # headers), the largest tomograms go first, each onto the shard with the least volume so far
+    sizes = []
+    for tomo in sorted(tomogram_dir.glob('*.mrc')):
+        with mrcfile.open(tomo, header_only=True, permissive=True) as mrc:
+            sizes.append((int(mrc.header.nz) * int(mrc.header.ny) * int(mrc.header.nx), tomo.name))
+    shards = [[0, []] for _ in range(min(n_shards, len(sizes)))]
+    for size, name in sorted(sizes, reverse=True):
+        shard = min(shards, key=itemgetter(0))
+        shard[0] += size
+        shard[1].append(name)
+    return [sorted(names) for _, names in shards]
+
+
+def read_tilt_series_metrics(metric_file):
+    # TiltSeries_Metric.csv of aretomo3 as {tilt series: {column: value}} and its columns. the header can start
+    # with '#' and have spaces after the commas, a rerun appends rows (and maybe the header) so the last one counts
+    metrics, columns = {}, []
+    if not metric_file.exists():
+        return metrics, columns
+    with open(metric_file, 'r', newline='') as f:
+        for row in csv.reader(f, skipinitialspace=True):
+            row = [x.strip() for x in row]
+            if len(row) == 0:
+                continue
+            if row[0].lstrip('#').strip() == 'Tilt_Series':
+                columns = [x.lstrip('#').strip() for x in row]
+                continue
+            values = {}
+            for key, value in zip(columns, row):
+                try:
+                    values[key] = float(value)
+                except ValueError:
+                    values[key] = value
+            metrics[pathlib.Path(str(values.get('Tilt_Series', ''))).name] = values
+    return metrics, columns
+
+
+def read_ctf_fit(ctf_file):
+    # median CTF_Res(A) and CTF_Score over the tilts in the _CTF.txt of a tilt series, which has the ctffind4
+    # columns: image, defocus 1, defocus 2, astigmatism azimuth, phase shift, cross correlation and the
+    # resolution up to which the ctf rings were fit. empty when the file is not there
+    if not ctf_file.exists():
+        return {}
+    with open(ctf_file, 'r') as f:
+        fits = [x.split() for x in f if x.strip() != '' and not x.lstrip().startswith('#')]
+    fits = [x for x in fits if len(x) >= 7]
+    if len(fits) == 0:
+        return {}
+    return {'CTF_Res(A)': float(np.median([float(x[6]) for x in fits])),
+            'CTF_Score': float(np.median([float(x[5]) for x in fits]))}
+
+
+def count_tilts(tlt_file):
+    # tilts aretomo3 kept for the reconstruction, one line per tilt in the _TLT.txt
+    if not tlt_file.exists():
+        return None
+    with open(tlt_file, 'r') as f:
+        return sum(1 for x in f if x.strip() != '' and not x.lstrip().startswith('#'))
+
+
+def read_alignment_residual(log_path):
+    # last 'mean error' or 'mean residual' value in the aretomo3 log of a tilt series (a file, or a folder
+    # of log files), None when there is none
+    files = sorted(log_path.iterdir()) if log_path.is_dir() else [log_path] if log_path.exists() else []
+    residual = None
+    for x in files:
+        if not x.is_file():
+            continue
+        with open(x, 'r', errors='replace') as f:
+            for line in f:
+                match = re.search(r'(?:mean|average)\s+(?:residual|error)\D*?(\d+(?:\.\d+)?)', line, re.IGNORECASE)
+                if match is not None:
+                    residual = float(match.group(1))
+    return residual
+
+
+def link_series_inputs(mdocs, input_dir):
+    # aretomo3 processes every mdoc in its input prefix, so a subset is run from a folder of symlinks
+    if input_dir.exists():
+        for x in input_dir.iterdir():
+            x.unlink()
+    input_dir.mkdir(exist_ok=True)
+    for mdoc in mdocs:
+        for name in [mdoc.name] + parse_mdoc_subframes(mdoc):
+            source = mdoc.parent.joinpath(name)
+            if source.exists() and not input_dir.joinpath(name).exists():
+                input_dir.joinpath(name).symlink_to(source.resolve())
+
+
+def merge_aretomo3_output(shard_dir, out_dir):
+    # move the per tilt series files of a shard into the main output folder, the session wide
+    # MdocDone.txt and TiltSeries_Metric.csv are appended to the merged ones
+    for x in sorted(shard_dir.iterdir()):
+        target = out_dir.joinpath(x.name)
+        if x.name in ('MdocDone.txt', 'TiltSeries_Metric.csv'):
+            with open(x, 'r') as f:
+                lines = f.readlines()
+            if x.name == 'TiltSeries_Metric.csv' and target.exists():
+                lines = lines[1:]  # header is already there
+            with open(target, 'a') as f:
+                f.writelines(lines)
+            x.unlink()
+        else:
+            if target.is_dir():
+                shutil.rmtree(target)
+            x.replace(target)
+
+
 class Project:
-    def __init__(self, project_path, pixel_size):
+    def __init__(self, project_path, pixel_size, use_cache=True, model_registry=None, retries=2, retry_backoff=30.,
+                 cleanup_intermediates=False, disk_budget_gb=None):
         self.project_main = project_path
         self.project_raw = project_path.joinpath('raw')
         self.pixel_size = pixel_size
@@ -131,7 +287,7 @@ class Project:
             print('no folder with raw data in project')
             sys.exit(0)
         # list mdoc files
-        self.mdocs = [x for x in self.project_raw.iterdir() if x.is_file() and x.suffix == '.mdoc']
+        self.mdocs = sorted(x for x in self.project_raw.iterdir() if x.is_file() and x.suffix == '.mdoc')
         
         # other dirs
         self.project_AreTomo3 = project_path.joinpath('AreTomo3Output')
@@ -139,10 +295,101 @@ class Project:
         self.tomos_even = self.project_tomograms.joinpath('even')
         self.tomos_odd = self.project_tomograms.joinpath('odd')
         self.tomos_denoised = self.project_tomograms.joinpath('denoised')
+        self.tomos_zarr = self.project_tomograms.joinpath('zarr')
         self.cryocare_folder = self.project_tomograms.joinpath('cryocare_model')
+        self.aretomo_input = project_path.joinpath('AreTomo3Input')
+        self.project_qc = project_path.joinpath('qc')
+        self.project_shards = project_path.joinpath('AreTomo3Shards')
+        
+        # stages whose inputs and parameters did not change since the last run are skipped
+        self.manifest = StageManifest(project_path.joinpath('stage_manifest.json'), use_cache)
+        self.train_data_cache = TrainDataCache(self.cryocare_folder.joinpath('train_data'), self.manifest,
+                                               cryocare_train_data_config)
+        self.registry = None
+        if model_registry is not None:
+            self.registry = ModelRegistry(model_registry, cryocare_train_config, cryocare_train_data_config)
+        self.stage_keys = {}
+        # tilt series aretomo3 did not reconstruct are retried and then left out, instead of stopping the project
+        self.failures = FailureLog(project_path.joinpath('failed_series.json'))
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # intermediates are deleted as soon as the volumes made from them are there
+        self.cleanup = cleanup_intermediates
+        self.disk_budget_gb = disk_budget_gb
+        # tilt series rejected on their aretomo3 metrics, with the reasons
+        self.rejected = {}
+    
+    def volumes(self, mdoc):
+        # use the fact that the stem of tomoXXX.mrc.mdoc is tomoXXX.mrc
+        return [self.project_AreTomo3.joinpath(mdoc.stem + x) for x in ('_Vol.mrc', '_EVN_Vol.mrc', '_ODD_Vol.mrc')]
+    
+    def remove_intermediates(self, mdoc):
+        # with cleanup, the even/odd stacks go once aretomo3 reconstructed them, and the ctf power spectra
+        # once the ctf is estimated (the _CTF.txt results are kept)
+        if not self.cleanup:
+            return
+        for x in ('_EVN.mrc', '_ODD.mrc', '_CTF.mrc'):
+            self.project_AreTomo3.joinpath(mdoc.stem + x).unlink(missing_ok=True)
+    
+    def series_disk_usage(self, mdoc, binning, vol_z, export_zarr=False):
+        # estimated bytes aretomo3 and cryocare write for a tilt series, from the image size and number of tilts
+        ny, nx = mdoc_image_size(mdoc) or (0, 0)
+        n_tilts = len(parse_mdoc_subframes(mdoc))
+        tomogram = (vol_z // binning, ny // binning, nx // binning)
+        stack = mrc_size((n_tilts, ny, nx))
+        # power spectra of 512x512 pixels per tilt
+        ctf = mrc_size((n_tilts, 512, 512))
+        return {'stacks': 3 * stack, 'ctf': ctf, 'volumes': 3 * mrc_size(tomogram),
+                'intermediates': 2 * stack + ctf,
+                'cryocare': mrc_size(tomogram),
+                # uncompressed, the pyramid levels add at most 1/7
+                'zarr': 2 * mrc_size(tomogram) * 8 // 7 if export_zarr else 0}
+    
+    def plan_disk(self, mdocs, binning, vol_z, batch_size=None, export_zarr=False, n_training=1):
+        # estimated disk use per stage, and the highest point when aretomo3 gets the tilt series in batches of
+        # batch_size (None: all at once), with intermediates removed after every batch when cleanup is on.
+        # cryocare extracts training data from n_training tomograms
+        usage = [self.series_disk_usage(x, binning, vol_z, export_zarr) for x in mdocs]
+        step = max(1, len(usage) if batch_size is None else batch_size)
+        changes = []
+        for i in range(0, len(usage), step):
+            batch = usage[i:i + step]
+            changes += [x['stacks'] + x['ctf'] + x['volumes'] for x in batch]
+            changes += [-x['intermediates'] if self.cleanup else 0 for x in batch]
+        train_data = train_data_size(cryocare_train_data_config, n_training)
+        changes += [train_data] + [x['cryocare'] for x in usage] + [x['zarr'] for x in usage]
+        totals = {stage: sum(x[stage] for x in usage) for stage in ('stacks', 'ctf', 'volumes', 'cryocare', 'zarr')}
+        totals['cryocare'] += train_data
+        return peak_disk_usage(changes), totals
+    
+    def check_disk_space(self, binning, vol_z, batch_size=None, export_zarr=False, can_throttle=False,
+                         training_size=None):
+        # refuses a run that does not fit in the free space of the project filesystem (or --disk-budget-gb).
+        # with cleanup it can be throttled instead: aretomo3 then gets the tilt series in batches, and the
+        # intermediates of a batch are deleted before the next one starts. returns the batch size
+        pending = [x for x in self.mdocs if not all(y.exists() for y in self.volumes(x))]
+        if len(pending) == 0:
+            return batch_size
+        available = shutil.disk_usage(self.project_main).free
+        if self.disk_budget_gb is not None:
+            available = min(available, int(self.disk_budget_gb * 1024 ** 3))
+        n_training = len(self.mdocs) if training_size is None else min(training_size, len(self.mdocs))
+        peak, totals = self.plan_disk(pending, binning, vol_z, batch_size, export_zarr, n_training)
+        print_disk_plan(totals, peak, available)
+        if peak <= available:
+            return batch_size
+        if can_throttle and self.cleanup:
+            for size in range(len(pending) - 1, 0, -1):
+                if self.plan_disk(pending, binning, vol_z, size, export_zarr, n_training)[0] <= available:
+                    print(f'running {size} tilt series at a time to stay within the available disk space')
+                    return size
+        print('not enough disk space for this run, free up space, add --cleanup-intermediates '
+              'or skip this check with --no-disk-check')
+        sys.exit(1)
     
     def aretomo(self, pixel_size, kV, cs, fm_dose, gpu_ids, gain_ref, mc_patch,
-                tilt_axis, vol_z, binning, out_imod=0, defect_file=None, align_z=None):
+                tilt_axis, vol_z, binning, out_imod=0, defect_file=None, align_z=None, mdocs=None, shards=1,
+                shard_index=None):
         self.project_AreTomo3.mkdir(exist_ok=True)
         self.project_tomograms.mkdir(exist_ok=True)
         self.tomos_odd.mkdir(exist_ok=True)
@@ -161,31 +408,216 @@ class Project:
         # binning
         # out_imod (default 0)
         # (optional) defect_file
-        args = [ARETOMO_CMD,
-                '-InPrefix raw/', #look in raw directory
-                '-InSuffix .mdoc', # look for .mdoc files
-                '-OutDir AreTomo3Output', # output dir
-                f'-PixSize {pixel_size}', # pixel size of input
-                f'-kV {kV}', # voltage
-                f'-Cs {cs}', # Spherical Aberration
-                f'-FmDose {fm_dose}', #Dose per frame
-                '-Cmd 0', # do full reconstructions from tilts
-                f'-Gpu {" ".join(str(i) for i in gpu_ids)}',
-                f'-DefectFile {defect_file}' if defect_file is not None else '',
-                f'-Gain {gain_ref}',
-                f'-McPatch {" ".join(str(i) for i in mc_patch)}',
-                '-InFmMotion 1', # account for inframe motion
-                f'-TiltAxis {tilt_axis}', #Tilt axis 
-                f'-AlignZ {align_z}' if align_z is not None else '', # Alignment z-shape
-                f'-VolZ {vol_z}', # reconstructed volume z-height
-                f'-AtBin {binning}', # reconstruction binning
-                '-FlipVol 1', # make output vol xyz instead of xzy
-                '-Wbp 1', # enable weighted back projection
-                #'-DarkTol 0.01', # make dark tolerance less restrictive
-                f'-OutImod {out_imod}', # see aretomo3 --help
-                ]
-        subprocess.run(' '.join(args), shell=True)
+        if mdocs is None:
+            mdocs = self.mdocs
+        if shard_index is not None:
+            # a single shard of a slurm job array, every task takes every shards-th tilt series
+            mdocs = sorted(mdocs)[shard_index::shards]
+        pending = []
+        for mdoc in mdocs:
+            key = stage_key(file_digest(mdoc), [file_fingerprint(mdoc.parent.joinpath(x))
+                                                for x in parse_mdoc_subframes(mdoc)],
+                            file_fingerprint(gain_ref), file_fingerprint(defect_file), pixel_size, kV, cs,
+                            fm_dose, mc_patch, tilt_axis, vol_z, binning, out_imod, align_z)
+            self.stage_keys[mdoc.stem] = key
+            if self.manifest.is_done(mdoc.stem, 'aretomo3', key, self.volumes(mdoc)):
+                print(f'aretomo3 for {mdoc.stem} is up to date')
+                self.failures.clear(mdoc.stem)
+                self.remove_intermediates(mdoc)
+            elif (self.manifest.enabled and mdoc.stem not in self.manifest.entries and
+                  self.finished_in_output(mdoc)):
+                # finished by an earlier run that did not get to record it (e.g. killed halfway)
+                print(f'aretomo3 for {mdoc.stem} was already finished')
+                self.manifest.record(mdoc.stem, 'aretomo3', key)
+                self.failures.clear(mdoc.stem)
+                self.remove_intermediates(mdoc)
+            else:
+                pending.append(mdoc)
+        if len(pending) == 0:
+            return
+        
+        def aretomo3_args(input_prefix, out_dir, gpu_group):
+            return [ARETOMO_CMD,
+                    f'-InPrefix {input_prefix}', #look in raw directory (or only the mdocs that need to be redone)
+                    '-InSuffix .mdoc', # look for .mdoc files
+                    f'-OutDir {out_dir}', # output dir
+                    f'-PixSize {pixel_size}', # pixel size of input
+                    f'-kV {kV}', # voltage
+                    f'-Cs {cs}', # Spherical Aberration
+                    f'-FmDose {fm_dose}', #Dose per frame
+                    '-Cmd 0', # do full reconstructions from tilts
+                    f'-Gpu {" ".join(str(i) for i in gpu_group)}',
+                    f'-DefectFile {defect_file}' if defect_file is not None else '',
+                    f'-Gain {gain_ref}',
+                    f'-McPatch {" ".join(str(i) for i in mc_patch)}',
+                    '-InFmMotion 1', # account for inframe motion
+                    f'-TiltAxis {tilt_axis}', #Tilt axis 
+                    f'-AlignZ {align_z}' if align_z is not None else '', # Alignment z-shape
+                    f'-VolZ {vol_z}', # reconstructed volume z-height
+                    f'-AtBin {binning}', # reconstruction binning
+                    '-FlipVol 1', # make output vol xyz instead of xzy
+                    '-Wbp 1', # enable weighted back projection
+                    #'-DarkTol 0.01', # make dark tolerance less restrictive
+                    f'-OutImod {out_imod}', # see aretomo3 --help
+                    ]
+        
+        # aretomo3 carries on with the next tilt series when one fails, the ones without volumes afterwards
+        # are retried with backoff and finally recorded as failed
+        for attempt in range(self.retries + 1):
+            errors = self.dispatch_aretomo(pending, gpu_ids, shards, shard_index, aretomo3_args)
+            failed = [x for x in pending if not all(y.exists() for y in self.volumes(x))]
+            for mdoc in pending:
+                if mdoc not in failed:
+                    self.failures.clear(mdoc.stem)
+            if len(failed) == 0:
+                return
+            print(f'aretomo3 did not reconstruct {", ".join(x.stem for x in failed)} '
+                  f'(attempt {attempt + 1} of {self.retries + 1})')
+            pending = failed
+            if attempt < self.retries:
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        for mdoc in pending:
+            self.failures.record(mdoc.stem, 'aretomo3', errors.get(mdoc, 'no volumes written'), self.retries + 1)
+            print(f'{mdoc.stem} is left out of the remaining stages')
+    
+    def dispatch_aretomo(self, pending, gpu_ids, shards, shard_index, aretomo3_args):
+        # one aretomo3 run over the pending tilt series, returns the stderr of failed processes per mdoc
+        if shard_index is not None:
+            return self.run_shard(shard_index, pending, gpu_ids, aretomo3_args)
+        n_shards = min(shards, len(gpu_ids), len(pending))
+        if n_shards > 1:
+            return self.sharded_aretomo(pending, gpu_ids, n_shards, aretomo3_args)
+        
+        if set(pending) == set(self.project_raw.glob('*.mdoc')):
+            input_prefix = str(self.project_raw) + '/'
+        else:
+            link_series_inputs(pending, self.aretomo_input)
+            input_prefix = str(self.aretomo_input) + '/'
+        result = stage_log.run(' '.join(aretomo3_args(input_prefix, self.project_AreTomo3, gpu_ids)), 'aretomo3',
+                               pending[0].stem if len(pending) == 1 else None, covers=[x.stem for x in pending],
+                               gpus=len(gpu_ids))
+        for mdoc in pending:
+            if all(x.exists() for x in self.volumes(mdoc)):
+                self.manifest.record(mdoc.stem, 'aretomo3', self.stage_keys[mdoc.stem])
+                self.remove_intermediates(mdoc)
+        return self.aretomo3_errors(pending, result)
+    
+    def aretomo3_errors(self, mdocs, result):
+        error = f'exit status {result.returncode}\n{result.stderr[-2000:]}'
+        return {x: error for x in mdocs if not all(y.exists() for y in self.volumes(x))}
+    
+    def finished_in_output(self, mdoc):
+        done_file = self.project_AreTomo3.joinpath('MdocDone.txt')
+        if not done_file.exists():
+            return False
+        with open(done_file, 'r') as f:
+            done = [pathlib.Path(x.strip()).name for x in f.readlines() if x.strip() != '']
+        return mdoc.name in done and self.volumes(mdoc)[0].exists()
+    
+    def sharded_aretomo(self, mdocs, gpu_ids, n_shards, aretomo3_args):
+        # one aretomo3 process per shard and gpu group, each with its own input and output folder
+        # so a crash only loses its own shard, finished shards are merged into AreTomo3Output
+        self.project_shards.mkdir(exist_ok=True)
+        shards = [[] for _ in range(n_shards)]
+        frames = [0] * n_shards
+        # balance shards on number of tilts, biggest series first
+        for mdoc in sorted(mdocs, key=lambda x: len(parse_mdoc_subframes(x)), reverse=True):
+            i = frames.index(min(frames))
+            shards[i].append(mdoc)
+            frames[i] += len(parse_mdoc_subframes(mdoc))
+        errors = {}
+        with ThreadPoolExecutor(max_workers=n_shards) as executor:
+            for shard_errors in executor.map(lambda i: self.run_shard(i, shards[i], gpu_ids[i::n_shards],
+                                                                      aretomo3_args), range(n_shards)):
+                errors.update(shard_errors)
+        return errors
+
+    def run_shard(self, i, mdocs, gpu_group, aretomo3_args):
+        input_dir = self.project_shards.joinpath(f'input_{i}')
+        output_dir = self.project_shards.joinpath(f'output_{i}')
+        output_dir.mkdir(parents=True, exist_ok=True)
+        link_series_inputs(mdocs, input_dir)
+        print(f'aretomo3 shard {i} with {len(mdocs)} tilt series on gpu {gpu_group}')
+        result = stage_log.run(' '.join(aretomo3_args(str(input_dir) + '/', output_dir, gpu_group)), 'aretomo3',
+                               f'shard_{i}', covers=[x.stem for x in mdocs], gpus=len(gpu_group))
+        # shards of other threads or slurm array tasks merge into the same folder
+        with file_lock(self.project_shards.joinpath('merge.lock')):
+            merge_aretomo3_output(output_dir, self.project_AreTomo3)
+        for mdoc in mdocs:
+            if all(x.exists() for x in self.volumes(mdoc)):
+                self.manifest.record(mdoc.stem, 'aretomo3', self.stage_keys[mdoc.stem])
+                self.remove_intermediates(mdoc)
+        return self.aretomo3_errors(mdocs, result)
+
+    def watch_raw(self, process_mdocs, settle_time=60., poll_interval=30., idle_timeout=None):
+        # live mode: run aretomo3 for each tilt series as soon as its acquisition is complete, one
+        # series at a time in the background so the raw folder keeps being watched
+        print(f'------------- watching {self.project_raw} for new tilt series ----------------')
+        self.mdocs = []
+        watcher = RawWatcher(self.project_raw, lambda x: [x.parent.joinpath(y) for y in parse_mdoc_subframes(x)],
+                             settle_time)
+        futures = {}
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                def process(mdoc):
+                    self.mdocs.append(mdoc)
+                    futures[mdoc.stem] = executor.submit(process_mdocs, [mdoc])
+                watch(watcher, process, poll_interval, idle_timeout)
+        finally:
+            # also when watching stopped with an error, the series handed over so far are reported
+            record_watch_failures(futures, self.failures, 'aretomo3')
 
+    def quality_check(self, thresholds=None):
+        # per tilt series quality table from TiltSeries_Metric.csv and the _CTF.txt, _TLT.txt and _Log files,
+        # written to tilt_series_quality.csv. series outside the thresholds are rejected: not linked for
+        # cryocare, so neither trained nor predicted on. a series without a value for a threshold is rejected
+        # too, and a threshold on a metric aretomo3 did not write at all stops the run
+        metrics, columns = read_tilt_series_metrics(self.project_AreTomo3.joinpath('TiltSeries_Metric.csv'))
+        thresholds = {k: v for k, v in (thresholds or {}).items() if v is not None}
+        table, self.rejected = [], {}
+        for mdoc in self.mdocs:
+            if not self.volumes(mdoc)[0].exists():
+                continue
+            # use the fact that the stem of tomoXXX.mrc.mdoc is tomoXXX.mrc
+            row = dict(metrics.get(mdoc.stem, metrics.get(pathlib.Path(mdoc.stem).stem, {})))
+            row['Tilt_Series'] = mdoc.stem
+            for metric, value in read_ctf_fit(self.project_AreTomo3.joinpath(mdoc.stem + '_CTF.txt')).items():
+                row.setdefault(metric, value)
+            row['Tilts'] = count_tilts(self.project_AreTomo3.joinpath(mdoc.stem + '_TLT.txt'))
+            row['Align_Residual'] = read_alignment_residual(self.project_AreTomo3.joinpath(mdoc.stem + '_Log'))
+            table.append(row)
+        found = set(columns) | {k for row in table for k, v in row.items() if v is not None}
+        missing = sorted({QUALITY_THRESHOLDS[x][0] for x in thresholds} - found)
+        if len(table) > 0 and len(missing) > 0:
+            print(f'cannot apply the quality thresholds, aretomo3 wrote no {", ".join(missing)} (columns of '
+                  f'TiltSeries_Metric.csv: {", ".join(columns) if len(columns) > 0 else "no such file"})')
+            if 'Align_Residual' in missing:
+                print("the alignment residual is read from a 'Mean error' or 'Mean residual' line in the _Log of "
+                      'each tilt series, none of them has one')
+            sys.exit(1)
+        for row in table:
+            reasons = []
+            for option, limit in thresholds.items():
+                metric, upper = QUALITY_THRESHOLDS[option]
+                value = row.get(metric)
+                if not isinstance(value, float):
+                    reasons.append(f'no {metric}')
+                elif value > limit if upper else value < limit:
+                    reasons.append(f'{metric} {value:g} {">" if upper else "<"} {limit:g}')
+            if len(reasons) > 0:
+                self.rejected[row['Tilt_Series']] = reasons
+                print(f'rejected {row["Tilt_Series"]}: {", ".join(reasons)}')
+            row['Rejected'] = '; '.join(reasons)
+        if len(table) == 0:
+            return
+        columns = list(dict.fromkeys(k for row in table for k in row))
+        with open(self.project_main.joinpath('tilt_series_quality.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(table)
+        if len(self.rejected) > 0:
+            print(f'{len(self.rejected)} of {len(table)} tilt series rejected (see tilt_series_quality.csv)')
+    
     def create_symlinks(self): 
         # Symlink the odd and even tomograms to the correct folder
         args = ['ln', '-rs', 'AreTomo3Output/*EVN_Vol.mrc', 'tomograms/even']
@@ -197,21 +629,98 @@ class Project:
         subprocess.run(' '.join(args), shell=True)
         args = ['rename', 'mrc_ODD_Vol.mrc', 'mrc', 'tomograms/odd/*']
         subprocess.run(' '.join(args), shell=True)
+        # rejected tilt series are left out, also when they were linked by an earlier run
+        for name in self.rejected:
+            for x in (self.tomos_even.joinpath(name), self.tomos_odd.joinpath(name)):
+                if x.is_symlink():
+                    x.unlink()
  
             
-    def cryocare(self, training_subset_size, cryocare_model_name, gpu_id):
+    def predict(self, predict_file, memory_budget_gb=None, gpu_ids=None):
+        # cryocare predicts on a single gpu. with more gpus the tomograms are split into shards of about the same
+        # volume, one per gpu, that are predicted at the same time from their own folders with symlinks. all
+        # shards write to the same output folder
+        shards = plan_prediction_shards(self.tomos_even, len(gpu_ids)) if gpu_ids is not None else []
+        if len(shards) <= 1:
+            self.predict_shard(predict_file, cryocare_predict_config, memory_budget_gb)
+            return
+        shards_dir = self.project_tomograms.joinpath('predict_shards')
+        if shards_dir.exists():
+            shutil.rmtree(shards_dir)
+
+        def predict_on_gpu(gpu_id, names):
+            shard_dir = shards_dir.joinpath(f'gpu_{gpu_id}')
+            link_tomograms(names, self.tomos_even, shard_dir.joinpath('even'))
+            link_tomograms(names, self.tomos_odd, shard_dir.joinpath('odd'))
+            config = dict(cryocare_predict_config, even=str(shard_dir.joinpath('even')),
+                          odd=str(shard_dir.joinpath('odd')), gpu_id=gpu_id)
+            print(f'cryocare prediction of {len(names)} tomograms on gpu {gpu_id}')
+            self.predict_shard(self.project_main.joinpath(f'predict_config_gpu_{gpu_id}.json'), config,
+                               memory_budget_gb)
+
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [executor.submit(predict_on_gpu, gpu_id, names) for gpu_id, names in zip(gpu_ids, shards)]
+            for future in futures:
+                future.result()
+
+    def predict_shard(self, predict_file, config, memory_budget_gb=None):
+        if memory_budget_gb is None:
+            with open(predict_file, 'w') as js_file:
+                js_file.write(json.dumps(config, indent=2))
+            stage_log.run(f'cryoCARE_predict.py --conf {predict_file}', 'cryocare_predict', check=True,
+                          covers=[x.name for x in pathlib.Path(config['even']).glob('*.mrc')])
+            return
+        # plan n_tiles from the volume shapes, tomograms that need a different tiling are predicted in
+        # separate runs from folders with symlinks
+        even_dir, odd_dir = pathlib.Path(config['even']), pathlib.Path(config['odd'])
+        groups = plan_prediction_groups(even_dir, memory_budget_gb * 1024 ** 3, cryocare_train_config)
+        for i, (n_tiles, names) in enumerate(groups.items()):
+            group_config = dict(config, n_tiles=list(n_tiles))
+            group_file = predict_file
+            if len(groups) > 1:
+                group_dir = even_dir.parent.joinpath('predict_groups', f'group_{i}')
+                link_tomograms(names, even_dir, group_dir.joinpath('even'))
+                link_tomograms(names, odd_dir, group_dir.joinpath('odd'))
+                group_config['even'] = str(group_dir.joinpath('even'))
+                group_config['odd'] = str(group_dir.joinpath('odd'))
+                group_file = predict_file.with_name(f'{predict_file.stem}_group_{i}.json')
+            print(f'cryocare prediction with n_tiles {list(n_tiles)} for {len(names)} tomograms')
+            with open(group_file, 'w') as js_file:
+                js_file.write(json.dumps(group_config, indent=2))
+            stage_log.run(f'cryoCARE_predict.py --conf {group_file}', 'cryocare_predict', check=True, covers=names)
+            
+    def cryocare(self, training_subset_size, cryocare_model_name, gpu_id, training_selection='random',
+                 coverage_radius=1., predict_memory_gb=None, acquisition=None, reuse_model='never'):
         self.cryocare_folder.mkdir(exist_ok=True)
         self.tomos_denoised.mkdir(exist_ok=True)
         train_data_file = self.project_main.joinpath('train_data_config.json')
         train_file = self.project_main.joinpath('train_config.json')
         predict_file = self.project_main.joinpath('predict_config.json')
         
+        # tilt series that failed are not trained on, they have no volumes to predict on either. rejected ones
+        # have volumes, but no links in the even/odd folders
+        mdocs = [x for x in self.mdocs if x.stem not in self.failures.entries and x.stem not in self.rejected]
+        if len(mdocs) == 0:
+            print('no reconstructed tilt series for cryocare')
+            return
+        if training_subset_size > len(mdocs):
+            print(f'only {len(mdocs)} reconstructed tilt series, training on all of them')
+            training_subset_size = len(mdocs)
+        
         # select subset size indices
-        subset = np.random.choice(len(self.mdocs), training_subset_size, replace=False)
-        cryocare_train_data_config['path'] = str(self.cryocare_folder)
         # use the fact that the stem of tomoXXX.mrc.mdoc is tomoXXX.mrc
-        tomos_even = [str(self.tomos_even / self.mdocs[i].stem) for i in subset]
-        tomos_odd = [str(self.tomos_odd / self.mdocs[i].stem) for i in subset]
+        tomograms = [(x.stem, self.tomos_even / x.stem, self.tomos_odd / x.stem, self.stage_keys.get(x.stem, ''))
+                     for x in mdocs]
+        if training_selection == 'coverage':
+            subset = select_training_subset([(self.tomos_even / x.stem, self.tomos_odd / x.stem) for x in mdocs],
+                                            training_subset_size, coverage_radius, [x.stem for x in mdocs])
+        else:
+            subset = self.train_data_cache.draw(tomograms, training_subset_size)
+        subset = sorted(subset)
+        train_data, selection = self.train_data_cache.folder([tomograms[i] for i in subset])
+        cryocare_train_data_config['path'] = str(train_data)
+        tomos_even = [str(self.tomos_even / mdocs[i].stem) for i in subset]
+        tomos_odd = [str(self.tomos_odd / mdocs[i].stem) for i in subset]
 
         cryocare_train_data_config['even'] = tomos_even
         cryocare_train_data_config['odd'] = tomos_odd
@@ -219,7 +728,7 @@ class Project:
             js_file.write(json.dumps(cryocare_train_data_config, indent=2))
             
         # create training json
-        cryocare_train_config['train_data'] = str(self.cryocare_folder)
+        cryocare_train_config['train_data'] = str(train_data)
         cryocare_train_config['path'] = str(self.cryocare_folder)
         cryocare_train_config['model_name'] = cryocare_model_name
         cryocare_train_config['gpu_id'] = gpu_id
@@ -231,27 +740,197 @@ class Project:
         cryocare_predict_config['even'] = str(self.tomos_even)
         cryocare_predict_config['odd'] = str(self.tomos_odd)
         cryocare_predict_config['output'] = str(self.tomos_denoised)
-        cryocare_predict_config['gpu_id'] = gpu_id[0] #cryocare 0.3.0 does not handle multi-gpu predictions (yet)
+        # cryocare 0.3.0 does not handle multi-gpu predictions (yet), with more gpus each predicts a shard
+        cryocare_predict_config['gpu_id'] = gpu_id[0]
         with open(predict_file, 'w') as js_file:
             js_file.write(json.dumps(cryocare_predict_config, indent=2))
             
-        # run cryocare
-        subprocess.run(f'cryoCARE_extract_train_data.py --conf {train_data_file}', shell=True)
-        subprocess.run(f'cryoCARE_train.py --conf {train_file}', shell=True)
-        subprocess.run(f'cryoCARE_predict.py --conf {predict_file}', shell=True)
+        # the model only depends on the set of reconstructions and the training parameters, so it is
+        # reused as long as those did not change. where the training data was extracted to does not count
+        tomo_keys = sorted(self.stage_keys[x.stem] for x in mdocs if x.stem in self.stage_keys)
+        train_key = stage_key(tomo_keys, training_subset_size, training_selection, coverage_radius,
+                              {k: v for k, v in cryocare_train_data_config.items() if k not in ('even', 'odd', 'path')},
+                              {k: v for k, v in cryocare_train_config.items() if k not in ('gpu_id', 'train_data')})
+        predict_key = stage_key(train_key, cryocare_predict_config['n_tiles'], predict_memory_gb)
+        model = self.cryocare_folder.joinpath(cryocare_model_name + '.tar.gz')
+        denoised = [self.tomos_denoised.joinpath(x.stem) for x in mdocs]
+            
+        # run cryocare, a compatible model from the registry replaces training
+        registered = None
+        if self.registry is not None and reuse_model != 'never':
+            registered = self.registry.find(acquisition)
+        if registered is not None:
+            print(f'reusing registered cryocare model {registered}')
+            cryocare_predict_config['path'] = str(registered)
+            with open(predict_file, 'w') as js_file:
+                js_file.write(json.dumps(cryocare_predict_config, indent=2))
+            predict_key = stage_key(file_digest(registered), cryocare_predict_config['n_tiles'], predict_memory_gb)
+        elif self.manifest.is_done('_project', 'cryocare_train', train_key, [model]):
+            print('cryocare model is up to date')
+        else:
+            self.train_data_cache.extract(train_data, selection, train_data_file)
+            stage_log.run(f'cryoCARE_train.py --conf {train_file}', 'cryocare_train', check=True)
+            self.manifest.record('_project', 'cryocare_train', train_key)
+            if self.registry is not None and model.exists():
+                self.registry.register(model, cryocare_model_name, acquisition)
+        if self.manifest.is_done('_project', 'cryocare_predict', predict_key, denoised):
+            print('denoised tomograms are up to date')
+        else:
+            self.predict(predict_file, predict_memory_gb, gpu_id)
+            self.manifest.record('_project', 'cryocare_predict', predict_key)
         
             
+    def qc_previews(self, binning=4, n_workers=4):
+        # binned previews and thumbnails of the full, even and denoised tomograms with an html index, to pick the
+        # series worth keeping without opening every tomogram. binning and png encoding are cpu bound, so the
+        # tomograms are spread over worker processes
+        mdocs = [x for x in self.mdocs if x.stem not in self.failures.entries]
+        jobs = []
+        for mdoc in mdocs:
+            # use the fact that the stem of tomoXXX.mrc.mdoc is tomoXXX.mrc
+            name = pathlib.Path(mdoc.stem).stem
+            full, even, _ = self.volumes(mdoc)
+            denoised = self.tomos_denoised.joinpath(mdoc.stem)
+            for kind, source in (('full', full), ('even', even), ('denoised', denoised)):
+                target = self.project_qc.joinpath(name, kind + '.mrc')
+                key = stage_key(file_fingerprint(source), binning)
+                if source.exists() and not self.manifest.is_done(mdoc.stem, f'qc_{kind}', key, [target]):
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    jobs.append((mdoc.stem, kind, key, source, target))
+        if len(jobs) > 0:
+            print(f'------------- making {len(jobs)} previews ----------------')
+            with stage_log.measure('qc_previews'), ProcessPoolExecutor(max_workers=max(1, n_workers)) as executor:
+                futures = [executor.submit(make_preview, source, target, binning) for *_, source, target in jobs]
+                for (series_name, kind, key, source, _), future in zip(jobs, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'preview of {source} failed: {e}')
+                        continue
+                    self.manifest.record(series_name, f'qc_{kind}', key)
+        if self.project_qc.exists():
+            write_qc_index(self.project_qc, [pathlib.Path(x.stem).stem for x in mdocs])
+    
+    def export_zarr(self, n_workers=4, n_levels=4, chunk_size=64):
+        # chunked OME-Zarr copies of the denoised and full tomograms, for viewers and pickers that only need
+        # a slice or a binned overview
+        exports = []
+        for mdoc in self.mdocs:
+            if mdoc.stem in self.failures.entries:
+                continue
+            # use the fact that the stem of tomoXXX.mrc.mdoc is tomoXXX.mrc
+            name = pathlib.Path(mdoc.stem).stem
+            denoised, full = self.tomos_denoised.joinpath(mdoc.stem), self.volumes(mdoc)[0]
+            for kind, source in (('denoised', denoised), ('full', full)):
+                if source.exists():
+                    exports.append((mdoc.stem, kind, source, self.tomos_zarr.joinpath(kind, name + '.zarr')))
+        
+        def export(series_name, kind, source, target):
+            key = stage_key(file_fingerprint(source), n_levels, chunk_size)
+            if self.manifest.is_done(series_name, f'zarr_{kind}', key, [target]):
+                print(f'{kind} zarr for {series_name} is up to date')
+                return
+            target.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with stage_log.measure('zarr', series_name):
+                    write_ome_zarr(source, target, n_levels, chunk_size)
+            except Exception as e:
+                # the mrc is still there, so a failed export does not fail the tilt series
+                print(f'zarr export of {source} failed: {e}')
+                return
+            self.manifest.record(series_name, f'zarr_{kind}', key)
+        
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+            list(executor.map(lambda x: export(*x), exports))
+    
+    def select_series(self, mdoc_names):
+        # only these tilt series, in this order (a slurm job works on the list it was submitted with)
+        self.mdocs = [self.project_raw.joinpath(x) for x in mdoc_names]
+    
+    def series_sizes(self):
+        # (number of tilts, ny, nx) per tilt series, from the mdocs
+        return {x.stem: (len(parse_mdoc_subframes(x)), *(mdoc_image_size(x) or (0, 0))) for x in self.mdocs}
+
+    def plan(self, history, binning, vol_z, gpu_ids):
+        # predicts wall time and peak memory of every stage from the run history, and recommends how many gpus
+        # (aretomo3 and prediction shards) and worker processes to use
+        rows = history.stage_runs()
+        if len(rows) == 0:
+            print(f'no earlier runs in {history.path} to plan from')
+            return
+        sizes = self.series_sizes()
+        work = work_sizes(sizes.values(), binning, vol_z)
+        print(f'------------- plan from {len(rows)} earlier stage runs ----------------')
+        print(f'{len(sizes)} tilt series, {sum(x[0] for x in sizes.values())} tilts, binning {binning}, vol-z {vol_z}')
+        stages = plan_stages(rows, work, STAGE_WORK)
+        n_gpus = print_plan(stages, len(gpu_ids), GPU_STAGES)
+        options = [f'--gpu-id {" ".join(str(x) for x in gpu_ids[:n_gpus])}', f'--aretomo-shards {n_gpus}']
+        for stage, option in (('qc_previews', '--qc-workers'), ('zarr', '--zarr-workers')):
+            if stage in stages:
+                options.append(f'{option} {recommend_workers(stages[stage][2])}')
+        print('recommended: ' + ' '.join(options))
+
     def run(self, gain_file, defect_file, pixel_size, kV, cs, fm_dose, tilt_axis, vol_z,
             align_z, binning, out_imod, mc_patch, training_subset_size,
-            cryocare_model_name, gpu_id):
-        # run aretomo
-        self.aretomo(pixel_size, kV, cs, fm_dose, gpu_id, gain_file, mc_patch, tilt_axis,
-                     vol_z, binning, out_imod, defect_file, align_z)        
-        # create symlinks
+            cryocare_model_name, gpu_id, watch_raw=False, settle_time=60., poll_interval=30.,
+            idle_timeout=None, aretomo_shards=1, training_selection='random', coverage_radius=1.,
+            predict_memory_gb=None, reuse_model='never', sample_type=None,
+            series_index=None, cryocare_only=False, export_zarr=False, zarr_workers=4, disk_check=True,
+            qc_previews=False, qc_binning=4, qc_workers=4, quality_thresholds=None):
+        # sizes and parameters that go into the run history with every stage
+        stage_log.describe(self.series_sizes(), project=str(self.project_main), binning=binning, vol_z=vol_z,
+                           parameters={k: v for k, v in locals().items() if k != 'self'})
+        if series_index is not None:
+            # slurm array task: one shard of aretomo_shards, cryocare runs in a separate job
+            self.aretomo(pixel_size, kV, cs, fm_dose, gpu_id, gain_file, mc_patch, tilt_axis, vol_z, binning,
+                         out_imod, defect_file, align_z, shards=aretomo_shards, shard_index=series_index)
+            self.failures.report()
+            stage_log.summary()
+            return
+        if cryocare_only:
+            # slurm cryocare job: the reconstructions were made by the array tasks
+            self.stage_keys = {x.stem: self.manifest.entries.get(x.stem, {}).get('aretomo3', '') for x in self.mdocs}
+        elif watch_raw:
+            # run aretomo per tilt series while they are being acquired
+            self.watch_raw(lambda mdocs: self.aretomo(pixel_size, kV, cs, fm_dose, gpu_id, gain_file, mc_patch,
+                                                      tilt_axis, vol_z, binning, out_imod, defect_file,
+                                                      align_z, mdocs, aretomo_shards),
+                           settle_time, poll_interval, idle_timeout)
+        else:
+            # run aretomo, in batches when throttled for disk space
+            batch_size = self.check_disk_space(binning, vol_z, None, export_zarr, True,
+                                               training_size=training_subset_size) if disk_check else None
+            step = max(1, len(self.mdocs) if batch_size is None else batch_size)
+            for i in range(0, len(self.mdocs), step):
+                self.aretomo(pixel_size, kV, cs, fm_dose, gpu_id, gain_file, mc_patch, tilt_axis,
+                             vol_z, binning, out_imod, defect_file, align_z, self.mdocs[i:i + step],
+                             aretomo_shards)        
+        # drop tilt series with bad metrics, then create symlinks
+        self.quality_check(quality_thresholds)
         self.create_symlinks()
+        
+        # previews of the reconstructions, to look at while cryocare runs
+        if qc_previews:
+            self.qc_previews(qc_binning, qc_workers)
 
         # run cryocare
-        self.cryocare(training_subset_size, cryocare_model_name, gpu_id)
+        acquisition = {'pixel_size': pixel_size, 'kV': kV, 'binning': binning, 'vol_z': vol_z,
+                       'sample_type': sample_type}
+        try:
+            self.cryocare(training_subset_size, cryocare_model_name, gpu_id, training_selection, coverage_radius,
+                          predict_memory_gb, acquisition, reuse_model)
+        except StageError as e:
+            print(e)
+        
+        # and of the denoised tomograms
+        if qc_previews:
+            self.qc_previews(qc_binning, qc_workers)
+        
+        if export_zarr:
+            self.export_zarr(zarr_workers)
+        
+        self.failures.report()
+        stage_log.summary()
 
 
 if __name__ == '__main__':
@@ -301,7 +980,114 @@ if __name__ == '__main__':
                         help='give a name to your cryocare model, for example arctica_er_microsomes or krios_lamellae_yeast')
     parser.add_argument('--gpu-id', type=int, required=False, default=[0], nargs='+',
                         help='specify the gpu index to run on, you can specify more than one with a space in between')
+    parser.add_argument('--no-stage-cache', action='store_true',
+                        help='rerun every stage, even when its inputs and parameters did not change since the last run')
+    parser.add_argument('--watch', action='store_true',
+                        help='live mode: watch the raw folder and run aretomo3 on every tilt series as soon as its '
+                        'acquisition is complete, cryocare runs after watching stops (ctrl+c or --idle-timeout)')
+    parser.add_argument('--settle-time', type=float, required=False, default=60.,
+                        help='with --watch, seconds the mdoc and all its frames must be unchanged to count as complete')
+    parser.add_argument('--poll-interval', type=float, required=False, default=30.,
+                        help='with --watch, seconds between checks of the raw folder')
+    parser.add_argument('--idle-timeout', type=float, required=False,
+                        help='with --watch, stop watching when no new tilt series arrived for this many seconds')
+    parser.add_argument('--aretomo-shards', type=int, required=False, default=1,
+                        help='split the tilt series over this many concurrent aretomo3 processes, the gpus are divided '
+                        'over the shards (default 1, a single process on all gpus)')
+    parser.add_argument('--stage-log', type=str, required=False,
+                        help='json lines file with timing and resource use of every stage '
+                        '(default: stage_log.jsonl in the project directory)')
+    parser.add_argument('--training-selection', type=str, required=False, default='random',
+                        choices=['random', 'coverage'],
+                        help='random: draw --training-size tomograms at random. coverage: compute even/odd correlation, '
+                        'contrast and thickness on binned tomograms and pick the smallest set (at most --training-size) '
+                        'that covers the range of the dataset')
+    parser.add_argument('--coverage-radius', type=float, required=False, default=1.,
+                        help='with --training-selection coverage, every tomogram must be within this many standard '
+                        'deviations (of the statistics) of a training tomogram')
+    parser.add_argument('--predict-memory-gb', type=float, required=False,
+                        help='gpu memory budget for cryocare prediction, n_tiles is then planned from the tomogram '
+                        f'shapes and the u-net size instead of the fixed {cryocare_predict_config["n_tiles"]}')
+    parser.add_argument('--model-registry', type=str, required=False,
+                        help='folder with previously trained cryocare models, newly trained models are added to it')
+    parser.add_argument('--reuse-model', type=str, required=False, default='never',
+                        choices=['never', 'predict'],
+                        help='with --model-registry, predict with a registered model trained on the same pixel size, '
+                        'kV, binning, vol-z and sample type instead of training a new one (default: never)')
+    parser.add_argument('--sample-type', type=str, required=False,
+                        help='free text sample type stored with the model in the registry, '
+                        'only models with the same sample type are reused')
+    parser.add_argument('--retries', type=int, required=False, default=2,
+                        help='number of times tilt series that aretomo3 did not reconstruct are resubmitted before '
+                        'they are left out of cryocare')
+    parser.add_argument('--retry-backoff', type=float, required=False, default=30.,
+                        help='seconds before the first retry, doubled for every next retry')
+    parser.add_argument('--backend', type=str, required=False, default='local', choices=['local', 'slurm'],
+                        help='local: run everything in this process. slurm: submit a job array with one aretomo3 '
+                        'shard per task (--aretomo-shards tasks, or one per tilt series) and a cryocare job that '
+                        'starts when all tasks succeeded. --gpu-id then refers to the gpus slurm gives each job')
+    parser.add_argument('--sbatch-options', type=str, required=False, default='',
+                        help='with --backend slurm, extra sbatch options for both jobs, '
+                        'for example "--partition=gpu --gres=gpu:1 --time=04:00:00"')
+    parser.add_argument('--slurm-wait', action='store_true',
+                        help='with --backend slurm, wait (polling squeue) until the jobs finished')
+    parser.add_argument('--export-zarr', action='store_true',
+                        help='after cryocare, write the denoised and full tomograms as chunked OME-Zarr with a '
+                        '1x/2x/4x/8x pyramid to tomograms/zarr (needs zarr<3)')
+    parser.add_argument('--zarr-workers', type=int, required=False, default=4,
+                        help='number of tomograms converted to OME-Zarr at the same time')
+    parser.add_argument('--cleanup-intermediates', action='store_true',
+                        help='delete the even/odd stacks and ctf power spectra of a tilt series once aretomo3 '
+                        'made its volumes')
+    parser.add_argument('--disk-budget-gb', type=float, required=False,
+                        help='disk space the run may use (e.g. what is left of the project quota), by default the '
+                        'free space of the project filesystem. runs that do not fit are refused, or with '
+                        '--cleanup-intermediates run in smaller batches')
+    parser.add_argument('--no-disk-check', action='store_true',
+                        help='start the run without estimating its disk use first')
+    parser.add_argument('--qc-previews', action='store_true',
+                        help='write binned previews and png thumbnails (central xy/xz slices and projections) of the '
+                        'full, even and denoised tomograms to qc/, with an overview page qc/index.html')
+    parser.add_argument('--qc-binning', type=int, required=False, default=4, choices=[4, 8],
+                        help='binning of the previews, on top of the tomogram binning')
+    parser.add_argument('--qc-workers', type=int, required=False, default=4,
+                        help='number of processes making previews')
+    parser.add_argument('--max-align-residual', type=float, required=False,
+                        help='reject tilt series whose mean alignment residual in the aretomo3 log is above this '
+                        '(pixels). rejected series are listed in tilt_series_quality.csv and left out of cryocare')
+    parser.add_argument('--max-global-shift', type=float, required=False,
+                        help='reject tilt series with a Global_Shift (pixels, TiltSeries_Metric.csv) above this')
+    parser.add_argument('--max-bad-patches', type=float, required=False,
+                        help='reject tilt series with a Bad_Patch_All fraction (TiltSeries_Metric.csv) above this')
+    parser.add_argument('--min-thickness', type=float, required=False,
+                        help='reject tilt series with a Thickness (pixels, TiltSeries_Metric.csv) below this')
+    parser.add_argument('--max-thickness', type=float, required=False,
+                        help='reject tilt series with a Thickness (pixels, TiltSeries_Metric.csv) above this')
+    parser.add_argument('--max-ctf-resolution', type=float, required=False,
+                        help='reject tilt series whose CTF fit resolution (A, TiltSeries_Metric.csv or the '
+                        'median of the _CTF.txt) is worse than this')
+    parser.add_argument('--min-ctf-score', type=float, required=False,
+                        help='reject tilt series with a CTF_Score (TiltSeries_Metric.csv or the median cross '
+                        'correlation of the _CTF.txt) below this')
+    parser.add_argument('--history', type=str, required=False,
+                        help='sqlite file in which every stage run is recorded with its input sizes, parameters and '
+                        f'duration, can be shared between projects (default: {default_history_path()})')
+    parser.add_argument('--no-history', action='store_true',
+                        help='do not record this run in the run history')
+    parser.add_argument('--plan', action='store_true',
+                        help='only read the mdocs of the project and predict the wall time and peak memory of every '
+                        'stage from the run history, with a recommended number of gpus and parallel workers')
+    parser.add_argument('--series-index', type=int, required=False, help=argparse.SUPPRESS)
+    parser.add_argument('--cryocare-only', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--series-list', type=str, required=False, help=argparse.SUPPRESS)
     args = parser.parse_args()
+    if args.backend == 'slurm' and args.watch:
+        parser.error('--backend slurm can not be combined with --watch')
+    if args.export_zarr:
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            parser.error('--export-zarr needs the zarr package (pip install "zarr<3")')
     
     project_path = pathlib.Path(args.project_dir)
     if not project_path.is_dir():
@@ -324,13 +1110,43 @@ if __name__ == '__main__':
     else:
         defect_file = None
     
-    project = Project(project_path, args.pixel_size)
-    if args.training_size > len(project.mdocs):
+    history = None
+    if args.plan or not args.no_history:
+        history = RunHistory(pathlib.Path(args.history).expanduser() if args.history is not None
+                             else default_history_path(), pathlib.Path(__file__).stem)
+    stage_log.open(pathlib.Path(args.stage_log) if args.stage_log is not None
+                   else project_path.joinpath('stage_log.jsonl'))
+    if not args.plan:
+        stage_log.history = history
+    project = Project(project_path, args.pixel_size, not args.no_stage_cache,
+                      pathlib.Path(args.model_registry).expanduser() if args.model_registry is not None else None,
+                      args.retries, args.retry_backoff, args.cleanup_intermediates, args.disk_budget_gb)
+    if args.series_list is not None:
+        # slurm job: the tilt series of the submission, not whatever raw/ holds by now
+        project.select_series(read_series_list(pathlib.Path(args.series_list)))
+    if args.plan:
+        project.plan(history, args.tomogram_binning, args.aretomo_vol_z, args.gpu_id)
+        sys.exit(0)
+    if not args.watch and args.training_size > len(project.mdocs):
         print(f"Training size of {args.training_size} is bigger than the number of found mdocs: {len(project.mdocs)}")
         sys.exit(0)
+    if args.backend == 'slurm':
+        if not args.no_disk_check:
+            # the array tasks run at the same time, so the whole project has to fit
+            project.check_disk_space(args.tomogram_binning, args.aretomo_vol_z, None, args.export_zarr,
+                                     training_size=args.training_size)
+        n_tasks = min(args.aretomo_shards, len(project.mdocs)) if args.aretomo_shards > 1 else len(project.mdocs)
+        submit_to_slurm(__file__, project_path, project.mdocs, n_tasks, args.sbatch_options, args.slurm_wait,
+                        args.poll_interval, ['--aretomo-shards', str(n_tasks)])
+        sys.exit(0)
 
     project.run(gain_file, defect_file, args.pixel_size, args.kV, args.cs, 
                 args.fm_dose, args.tilt_axis, args.aretomo_vol_z,
                 args.aretomo_align_z, args.tomogram_binning, args.aretomo_outimod,
                 args.aretomo_mcpatch, args.training_size,
-                args.cryocare_model_name, args.gpu_id)
+                args.cryocare_model_name, args.gpu_id, args.watch, args.settle_time,
+                args.poll_interval, args.idle_timeout, args.aretomo_shards,
+                args.training_selection, args.coverage_radius, args.predict_memory_gb,
+                args.reuse_model, args.sample_type, args.series_index, args.cryocare_only,
+                args.export_zarr, args.zarr_workers, not args.no_disk_check, args.qc_previews, args.qc_binning,
+                args.qc_workers, {x: getattr(args, x) for x in QUALITY_THRESHOLDS})